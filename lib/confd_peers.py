@@ -0,0 +1,303 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Latency-aware confd master candidate selection
+
+Instead of sending each request to random master candidates, requests go to
+the ones with the lowest reply latency, measured from the confd upcalls. If
+no reply comes within a few round trip times, a copy of the request is sent
+to the next best master candidate.
+
+"""
+
+
+import logging
+import random
+import time
+
+from ganeti import confd
+
+# pylint: disable-msg=W0611
+import ganeti.confd.client
+
+
+# Number of master candidates each request is sent to
+DEFAULT_PREFERRED_PEERS = 2
+
+# Weight of each new sample in the moving averages
+EWMA_WEIGHT = 0.2
+
+# The score of a master candidate is its average RTT multiplied by
+# 1 + LOSS_PENALTY * its loss rate; the lowest scores are preferred
+LOSS_PENALTY = 10
+
+# Probability of sending a request to a random master candidate, instead of
+# the worst preferred one, so that the others get measured too
+EXPLORE_PROBABILITY = 0.05
+
+# A hedged copy of a request is sent to the next best master candidate if no
+# reply came after HEDGE_RTT_FACTOR times the RTT of the slowest targeted
+# one, bounded by HEDGE_MIN_DELAY and HEDGE_MAX_DELAY (seconds)
+HEDGE_RTT_FACTOR = 3
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_DELAY = 1.0
+MAX_HEDGES = 1
+
+
+class _PeerStats(object):
+  """Reply statistics of a master candidate.
+
+  """
+  def __init__(self):
+    self.rtt = None
+    self.loss = 0.0
+    self.sent = 0
+    self.replies = 0
+    self.lost = 0
+
+  def AddReply(self, rtt):
+    self.replies += 1
+    if self.rtt is None:
+      self.rtt = rtt
+    else:
+      self.rtt += EWMA_WEIGHT * (rtt - self.rtt)
+    self.loss -= EWMA_WEIGHT * self.loss
+
+  def AddLoss(self):
+    self.lost += 1
+    self.loss += EWMA_WEIGHT * (1 - self.loss)
+
+  def GetScore(self):
+    # Master candidates without replies yet are tried first
+    if self.rtt is None:
+      return 0
+    return self.rtt * (1 + LOSS_PENALTY * self.loss)
+
+
+class _RequestCopy(object):
+  """One copy of a request, sent to some master candidates.
+
+  """
+  def __init__(self, peers):
+    self.peers = peers
+    self.replied = set()
+    self.sent_time = time.time()
+
+
+class _LogicalRequest(object):
+  """A request made to the client, and its copies in flight.
+
+  """
+  def __init__(self, request, args):
+    self.request = request
+    self.args = args
+    # rsalt -> L{_RequestCopy}
+    self.copies = {}
+    self.tried = set()
+    self.answered = False
+    self.hedges = 0
+    self.hedge_event = None
+
+
+class LatencyAwareConfdClient(object):
+  """A confd client sending requests to the fastest master candidates.
+
+  It has the same interface as L{confd.client.ConfdClient}, and hides the
+  hedged copies of the requests from its callback: their replies look like
+  replies to the original request, and a request only expires once all its
+  copies did.
+
+  """
+  def __init__(self, hmac_key, peers, callback, scheduler,
+               preferred=DEFAULT_PREFERRED_PEERS):
+    """Constructor for LatencyAwareConfdClient
+
+    @type hmac_key: string
+    @param hmac_key: hmac key to talk to confd
+    @type peers: list
+    @param peers: master candidate IPs
+    @type callback: callable
+    @param callback: function called with the confd upcalls
+    @type scheduler: L{daemon.AsyncoreScheduler}
+    @param scheduler: scheduler used for the hedged requests
+    @type preferred: int
+    @param preferred: number of master candidates each request is sent to
+
+    """
+    self._callback = callback
+    self._scheduler = scheduler
+    self._preferred = preferred
+    self._peers = []
+    # peer -> L{_PeerStats}
+    self._stats = {}
+    # rsalt of every copy in flight -> L{_LogicalRequest}
+    self._copies = {}
+    self._client = confd.client.ConfdClient(hmac_key, list(peers),
+                                            self._HandleUpcall,
+                                            logger=logging)
+    self.UpdatePeerList(peers)
+
+  def UpdatePeerList(self, peers):
+    """Set the master candidates to use.
+
+    The statistics of the master candidates still in the list are kept.
+
+    """
+    self._peers = list(peers)
+    stats = {}
+    for peer in self._peers:
+      stats[peer] = self._stats.get(peer, None) or _PeerStats()
+    self._stats = stats
+
+  def GetPeerStats(self):
+    """Return the statistics of the master candidates.
+
+    @rtype: dict
+    @return: master candidate IP to dict of statistics (average RTT in
+        seconds or None if unknown, loss rate, requests sent, replies and
+        losses)
+
+    """
+    result = {}
+    for (peer, stats) in self._stats.iteritems():
+      result[peer] = {
+        "rtt": stats.rtt,
+        "loss": stats.loss,
+        "sent": stats.sent,
+        "replies": stats.replies,
+        "lost": stats.lost,
+        }
+    return result
+
+  def _SelectPeers(self, count, exclude):
+    """Return the best master candidates.
+
+    """
+    candidates = [peer for peer in self._peers if peer not in exclude]
+    # Ties (e.g. between unmeasured master candidates) are broken randomly
+    random.shuffle(candidates)
+    decorated = [(self._stats[peer].GetScore(), peer) for peer in candidates]
+    decorated.sort()
+    selected = [peer for (_, peer) in decorated[:count]]
+    others = [peer for (_, peer) in decorated[count:]]
+    if selected and others and random.random() < EXPLORE_PROBABILITY:
+      selected[-1] = random.choice(others)
+    return selected
+
+  def _HedgeDelay(self, peers):
+    rtts = [self._stats[peer].rtt for peer in peers]
+    if None in rtts:
+      return HEDGE_MAX_DELAY
+    return max(HEDGE_MIN_DELAY, min(HEDGE_MAX_DELAY,
+                                    HEDGE_RTT_FACTOR * max(rtts)))
+
+  def _SendCopy(self, logical, request, peers):
+    """Send a copy of a request to some master candidates.
+
+    """
+    self._client.UpdatePeerList(peers)
+    self._client.SendRequest(request, coverage=len(peers))
+    logical.copies[request.rsalt] = _RequestCopy(peers)
+    logical.tried.update(peers)
+    self._copies[request.rsalt] = logical
+    for peer in peers:
+      self._stats[peer].sent += 1
+    if peers and logical.hedges < MAX_HEDGES:
+      logical.hedge_event = \
+        self._scheduler.enter(self._HedgeDelay(peers), 1, self._Hedge,
+                              [logical])
+
+  def SendRequest(self, request, args=None, coverage=None):
+    """Send a request to the best master candidates.
+
+    @type request: L{confd.client.ConfdClientRequest}
+    @param request: the request
+    @param args: passed back in the upcalls for the request
+    @type coverage: int
+    @param coverage: number of master candidates to send the request to,
+        instead of the default
+
+    """
+    if coverage is None:
+      coverage = self._preferred
+    # Without any master candidate the request is sent nowhere, and expires
+    peers = self._SelectPeers(coverage, ())
+    self._SendCopy(_LogicalRequest(request, args), request, peers)
+
+  def _Hedge(self, logical):
+    """Send a copy of a request not answered yet to another candidate.
+
+    """
+    logical.hedge_event = None
+    if logical.answered or not logical.copies:
+      return
+    peers = self._SelectPeers(1, logical.tried)
+    if not peers:
+      return
+    logical.hedges += 1
+    orig = logical.request
+    logging.debug("No reply to confd request %s yet, sending a copy to %s",
+                  orig.rsalt, peers[0])
+    request = confd.client.ConfdClientRequest(type=orig.type,
+                                              query=orig.query)
+    self._SendCopy(logical, request, peers)
+
+  def _CancelHedge(self, logical):
+    if logical.hedge_event is not None:
+      self._scheduler.cancel(logical.hedge_event)
+      logical.hedge_event = None
+
+  def _HandleUpcall(self, up):
+    """Update the statistics, and pass the upcall on as for the original.
+
+    """
+    logical = self._copies.get(up.salt, None)
+    if logical is None:
+      up.client = self
+      self._callback(up)
+      return
+    copy = logical.copies[up.salt]
+
+    if up.type == confd.client.UPCALL_REPLY:
+      peer = up.server_ip
+      if peer in copy.peers and peer not in copy.replied:
+        copy.replied.add(peer)
+        if peer in self._stats:
+          self._stats[peer].AddReply(time.time() - copy.sent_time)
+      logical.answered = True
+      self._CancelHedge(logical)
+
+    elif up.type == confd.client.UPCALL_EXPIRE:
+      for peer in copy.peers:
+        if peer not in copy.replied and peer in self._stats:
+          self._stats[peer].AddLoss()
+      del logical.copies[up.salt]
+      del self._copies[up.salt]
+      # The request only expires when its last copy does
+      if logical.copies:
+        return
+      self._CancelHedge(logical)
+
+    up.salt = logical.request.rsalt
+    up.orig_request = logical.request
+    up.extra_args = logical.args
+    up.client = self
+    self._callback(up)
@@ -40,6 +40,11 @@ ENDPOINT_EXTIP_KEY = "endpoint_external_ip"
 INTERFACE_KEY = "gre_interface"
 TABLE_KEY = "routing_table"
 NFLOG_QUEUE_KEY = "nflog_queue"
+NETWORK_BACKEND_KEY = "network_backend"
+KERNEL_MONITOR_KEY = "kernel_monitor"
+FIREWALL_MODE_KEY = "firewall_mode"
+FIREWALL_COMMIT_DELAY_KEY = "firewall_commit_delay"
+SNAPSHOT_FILE_KEY = "snapshot_file"
 
 # Cluster-specific configuration keys
 CLUSTER_NAME_KEY = "cluster_name"
@@ -47,6 +52,9 @@ MC_LIST_FILE_KEY = "mc_list_file"
 MC_LIST_UPDATE_KEY = "mc_list_update"
 HMAC_KEY_FILE_KEY = "hmac_key_file"
 MASTER_NBMA_INTERFACE_KEY = "master_nbma_interface"
+UPDATE_MIN_INTERVAL_KEY = "update_min_interval"
+UPDATE_MAX_INTERVAL_KEY = "update_max_interval"
+MAPPING_PIPELINE_DEPTH_KEY = "mapping_pipeline_depth"
 
 
 class BashFragmentConfigParser(objects.SerializableConfigParser):
@@ -103,6 +111,11 @@ class NLDConfig(objects.ConfigObject):
     "tables_tunnels",
     "clusters",
     "nflog_queue",
+    "network_backend",
+    "kernel_monitor",
+    "firewall_mode",
+    "firewall_commit_delay",
+    "snapshot_file",
     ]
 
   @classmethod
@@ -118,6 +131,11 @@ class NLDConfig(objects.ConfigObject):
     endpoints = []
     tables_map = {}
     clusters = {}
+    network_backend = constants.DEFAULT_NETWORK_BACKEND
+    kernel_monitor = False
+    firewall_mode = constants.DEFAULT_FIREWALL_MODE
+    firewall_commit_delay = constants.DEFAULT_FIREWALL_COMMIT_DELAY
+    snapshot_file = constants.DEFAULT_SNAPSHOT_FILE
 
     ss = ssconf.SimpleStore()
     default_mclist = ss.KeyToFilename(gnt_constants.SS_MASTER_CANDIDATES_IPS)
@@ -125,7 +143,10 @@ class NLDConfig(objects.ConfigObject):
       'mc_list_file': default_mclist,
       'mc_list_update': False,
       'hmac_key_file': gnt_constants.CONFD_HMAC_KEY,
-      'master_neighbour_interface': constants.DEFAULT_NEIGHBOUR_INTERFACE
+      'master_neighbour_interface': constants.DEFAULT_NEIGHBOUR_INTERFACE,
+      'update_min_interval': constants.DEFAULT_UPDATE_MIN_INTERVAL,
+      'update_max_interval': constants.DEFAULT_UPDATE_MAX_INTERVAL,
+      'mapping_pipeline_depth': constants.DEFAULT_MAPPING_PIPELINE_DEPTH,
       }
 
     for config_file in files:
@@ -155,6 +176,28 @@ class NLDConfig(objects.ConfigObject):
       else:
         nflog_queue = constants.DEFAULT_NFLOG_QUEUE
 
+      if parser.has_option(DEFAULT_SECTION, NETWORK_BACKEND_KEY):
+        network_backend = parser.get(DEFAULT_SECTION, NETWORK_BACKEND_KEY)
+        if network_backend not in constants.NETWORK_BACKENDS:
+          raise errors.ConfigurationError('Invalid network backend %s' %
+                                          network_backend)
+
+      if parser.has_option(DEFAULT_SECTION, KERNEL_MONITOR_KEY):
+        kernel_monitor = parser.get(DEFAULT_SECTION, KERNEL_MONITOR_KEY) == '1'
+
+      if parser.has_option(DEFAULT_SECTION, FIREWALL_MODE_KEY):
+        firewall_mode = parser.get(DEFAULT_SECTION, FIREWALL_MODE_KEY)
+        if firewall_mode not in constants.FIREWALL_MODES:
+          raise errors.ConfigurationError('Invalid firewall mode %s' %
+                                          firewall_mode)
+
+      if parser.has_option(DEFAULT_SECTION, FIREWALL_COMMIT_DELAY_KEY):
+        firewall_commit_delay = \
+          int(parser.get(DEFAULT_SECTION, FIREWALL_COMMIT_DELAY_KEY))
+
+      if parser.has_option(DEFAULT_SECTION, SNAPSHOT_FILE_KEY):
+        snapshot_file = parser.get(DEFAULT_SECTION, SNAPSHOT_FILE_KEY)
+
       if (has_table or has_interface) and table not in tables_map:
         tables_map[table] = interface
       elif (has_table or has_interface) and tables_map[table] != interface:
@@ -164,7 +207,7 @@ class NLDConfig(objects.ConfigObject):
       # Parse per-cluster options
       if parser.has_option(DEFAULT_SECTION, CLUSTER_NAME_KEY):
         cluster_name = parser.get(DEFAULT_SECTION, CLUSTER_NAME_KEY)
-        clusters[cluster_name] = default_cluster_options
+        clusters[cluster_name] = default_cluster_options.copy()
 
         if parser.has_option(DEFAULT_SECTION, MC_LIST_FILE_KEY):
           clusters[cluster_name]['mc_list_file'] = (
@@ -182,6 +225,26 @@ class NLDConfig(objects.ConfigObject):
           clusters[cluster_name]['master_neighbour_interface'] = (
             parser.get(DEFAULT_SECTION, MASTER_NBMA_INTERFACE_KEY))
 
+        if parser.has_option(DEFAULT_SECTION, UPDATE_MIN_INTERVAL_KEY):
+          clusters[cluster_name]['update_min_interval'] = (
+            int(parser.get(DEFAULT_SECTION, UPDATE_MIN_INTERVAL_KEY)))
+
+        if parser.has_option(DEFAULT_SECTION, UPDATE_MAX_INTERVAL_KEY):
+          clusters[cluster_name]['update_max_interval'] = (
+            int(parser.get(DEFAULT_SECTION, UPDATE_MAX_INTERVAL_KEY)))
+
+        if (clusters[cluster_name]['update_min_interval'] >
+            clusters[cluster_name]['update_max_interval']):
+          raise errors.ConfigurationError('Minimum update interval greater'
+            ' than the maximum one for cluster %s' % cluster_name)
+
+        if parser.has_option(DEFAULT_SECTION, MAPPING_PIPELINE_DEPTH_KEY):
+          depth = int(parser.get(DEFAULT_SECTION, MAPPING_PIPELINE_DEPTH_KEY))
+          if depth < 1:
+            raise errors.ConfigurationError('Invalid mapping pipeline depth'
+              ' %s for cluster %s' % (depth, cluster_name))
+          clusters[cluster_name]['mapping_pipeline_depth'] = depth
+
     if not endpoints:
       raise errors.ConfigurationError('No endpoints found')
 
@@ -191,9 +254,14 @@ class NLDConfig(objects.ConfigObject):
 
     if not clusters:
       # Add a default cluster (name='default')
-      clusters['default'] = default_cluster_options
+      clusters['default'] = default_cluster_options.copy()
 
     return NLDConfig(endpoints=endpoints,
                      tables_tunnels=tables_map,
                      clusters=clusters,
-                     nflog_queue=nflog_queue)
+                     nflog_queue=nflog_queue,
+                     network_backend=network_backend,
+                     kernel_monitor=kernel_monitor,
+                     firewall_mode=firewall_mode,
+                     firewall_commit_delay=firewall_commit_delay,
+                     snapshot_file=snapshot_file)
@@ -29,11 +29,48 @@ NLD = "ganeti-nld"
 RELEASE_VERSION = _autoconf.PACKAGE_VERSION
 CONF_DIR = _autoconf.PKGSYSCONFDIR
 DEFAULT_CONF_FILE = CONF_DIR + "/common.conf"
+DATA_DIR = _autoconf.LOCALSTATEDIR + "/lib/ganeti-nbma"
+DEFAULT_SNAPSHOT_FILE = DATA_DIR + "/nld-state.json"
 
 DEFAULT_ROUTING_TABLE = "100"
 DEFAULT_NEIGHBOUR_INTERFACE = "gtun0"
 DEFAULT_NFLOG_QUEUE = 0
 
+# Backends used to program the kernel Neighbour and Routing tables
+NETWORK_BACKEND_IP = "ip"
+NETWORK_BACKEND_NETLINK = "netlink"
+NETWORK_BACKENDS = frozenset([
+  NETWORK_BACKEND_IP,
+  NETWORK_BACKEND_NETLINK,
+  ])
+DEFAULT_NETWORK_BACKEND = NETWORK_BACKEND_IP
+
+# How the trusted peers are matched in the GNT_TRUST chain: one rule per peer
+# in a chain, or a single rule matching an ipset
+FIREWALL_MODE_CHAIN = "chain"
+FIREWALL_MODE_IPSET = "ipset"
+FIREWALL_MODES = frozenset([
+  FIREWALL_MODE_CHAIN,
+  FIREWALL_MODE_IPSET,
+  ])
+DEFAULT_FIREWALL_MODE = FIREWALL_MODE_CHAIN
+
+# Seconds to wait for further peer changes before committing them to the
+# firewall, so that bursts of updates result in a single transaction
+DEFAULT_FIREWALL_COMMIT_DELAY = 2
+
+# A failed firewall commit is retried after this many seconds, doubled after
+# each consecutive failure up to the maximum
+FIREWALL_COMMIT_RETRY_DELAY = 1
+FIREWALL_COMMIT_MAX_RETRY_DELAY = 60
+
+# Bounds (seconds) of the adaptive confd polling intervals of each cluster
+DEFAULT_UPDATE_MIN_INTERVAL = 2
+DEFAULT_UPDATE_MAX_INTERVAL = 600
+
+# Number of instance mapping queries sent in parallel to the confd of a cluster
+DEFAULT_MAPPING_PIPELINE_DEPTH = 4
+
 # NLD communication protocol related constants below
 
 # A few common errors for NLD
@@ -46,21 +83,41 @@ NLD_ERROR_ARGUMENT = 3
 # TODO: make this a default and allow the value to be more configurable
 NLD_MAX_CLOCK_SKEW = 2 * gnt_constants.NODE_MAX_CLOCK_SKEW
 
-NLD_PROTOCOL_VERSION = 1
+# Maximum number of replies remembered per cluster, to answer retransmitted
+# or replayed requests without processing them again
+NLD_REPLY_CACHE_SIZE = 4096
+
+# Version 1 messages are signed JSON, version 2 ones are binary (see
+# nld_wire.py). Version 2 is used with the peers announcing it in their ping
+# answers, and both are accepted.
+NLD_PROTOCOL_VERSION_1 = 1
+NLD_PROTOCOL_VERSION_2 = 2
+NLD_PROTOCOL_VERSION = NLD_PROTOCOL_VERSION_2
+
+NLD_PROTOCOL_VERSIONS = frozenset([
+  NLD_PROTOCOL_VERSION_1,
+  NLD_PROTOCOL_VERSION_2,
+  ])
 
 NLD_REQ_PING = 0
 NLD_REQ_ROUTE_INVALIDATE = 1
+NLD_REQ_ROUTE_INVALIDATE_BATCH = 2
 
 # NLD request query fields. These are used to pass parameters.
 # These must be strings rather than integers, because json-encoding
 # converts them to strings anyway, as they're used as dict-keys.
-NLD_REQQ_LINK = "0" # FIXME: rename or remove
+NLD_REQQ_LINK = "0"
+NLD_REQQ_IPLIST = "1"
 
 NLD_REQFIELD_NAME = "0" # FIXME: rename or remove
 
+# Ping answer field listing the supported protocol versions
+NLD_REPL_VERSIONS = "versions"
+
 NLD_REQS = frozenset([
   NLD_REQ_PING,
   NLD_REQ_ROUTE_INVALIDATE,
+  NLD_REQ_ROUTE_INVALIDATE_BATCH,
   ])
 
 NLD_REPL_STATUS_OK = 0
@@ -78,8 +135,27 @@ NLD_REPL_STATUSES = frozenset([
 # them. For example by changing this we can move the whole payload to be
 # compressed, or move away from json.
 NLD_MAGIC_FOURCC = 'plj0'
+NLD_MAGIC_FOURCC_V2 = 'plb2'
 
 # Timeout in seconds to expire pending query request in the nld client
 # library. We don't actually expect any answer more than 10 seconds after we
 # sent a request.
 NLD_CLIENT_EXPIRE_TIMEOUT = 10
+
+# NLD requests without a reply are retransmitted after this many seconds,
+# doubled after each retransmission, at most NLD_CLIENT_MAX_RETRIES times
+# per request and NLD_CLIENT_RETRY_RATE times per second overall
+NLD_CLIENT_RETRY_TIMEOUT = 0.5
+NLD_CLIENT_MAX_RETRIES = 4
+NLD_CLIENT_RETRY_RATE = 50
+
+# Seconds after which the protocol version of a peer is probed again
+NLD_VERSION_PROBE_INTERVAL = 600
+
+# Maximum number of NLD requests waiting for a reply; more are refused until
+# some are answered or expire
+NLD_CLIENT_MAX_PENDING_REQUESTS = 4096
+
+# Route invalidations for the same destination within this many seconds are
+# sent together, in as few batch requests as possible
+NLD_ROUTE_INVALIDATE_BATCH_WINDOW = 0.2
@@ -47,3 +47,20 @@ class NLDMagicError(ganeti_errors.GenericError):
   Errors processing the fourcc in Ganeti NLD datagrams.
 
   """
+
+
+class NLDDecodeError(ganeti_errors.GenericError):
+  """A datagram decoding error in Ganeti NLD.
+
+  Datagrams which are malformed, or fail their authentication.
+
+  """
+
+
+class NetlinkError(ganeti_errors.GenericError):
+  """An rtnetlink error in Ganeti NLD.
+
+  Errors talking to the kernel over a NETLINK_ROUTE socket. The second
+  argument, if present, is the errno reported by the kernel.
+
+  """
@@ -0,0 +1,240 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Compact instance IP to node IP maps
+
+With tens of thousands of instances a plain dict of address strings uses
+hundreds of bytes per entry. Here IPv4 instance addresses are stored as 32-bit
+integers in a sorted array, next to an array of indexes into a small table of
+node addresses. Changes go to a dict overlay, which is merged into the arrays
+when it grows too big. Non-IPv4 addresses are kept in a plain dict.
+
+"""
+
+
+import array
+import bisect
+import socket
+import struct
+
+
+# The overlay is merged into the arrays when it has more entries than this,
+# or than a fraction of the entries in the arrays
+_MIN_OVERLAY_SIZE = 1024
+_OVERLAY_RATIO = 8
+
+# Overlay value of a removed entry
+_REMOVED = -1
+
+
+def _PackAddress(address):
+  """Convert an IPv4 address to an integer.
+
+  @rtype: int
+  @return: the address as an integer, or None for non-IPv4 addresses
+
+  """
+  if address.count(".") != 3:
+    return None
+  try:
+    return struct.unpack("!I", socket.inet_aton(address))[0]
+  except (socket.error, struct.error):
+    return None
+
+
+def _UnpackAddress(packed):
+  return socket.inet_ntoa(struct.pack("!I", packed))
+
+
+class InstanceNodeMap(object):
+  """A compact instance IP to node IP mapping, with a dict-like interface.
+
+  """
+  def __init__(self, entries=None):
+    """Constructor for InstanceNodeMap
+
+    @type entries: dict
+    @param entries: initial instance to node mapping
+
+    """
+    self._keys = array.array("I")
+    self._values = array.array("I")
+    # packed instance address -> node index, or _REMOVED
+    self._overlay = {}
+    # non-IPv4 instance address -> node address
+    self._other = {}
+    self._nodes = []
+    self._node_index = {}
+    self._len = 0
+    if entries:
+      for (instance, node) in entries.iteritems():
+        self[instance] = node
+
+  def _InternNode(self, node):
+    index = self._node_index.get(node, None)
+    if index is None:
+      index = len(self._nodes)
+      self._nodes.append(node)
+      self._node_index[node] = index
+    return index
+
+  def _FindPacked(self, packed):
+    """Return the node index of a packed instance address, or None.
+
+    """
+    index = self._overlay.get(packed, None)
+    if index is not None:
+      if index == _REMOVED:
+        return None
+      return index
+    pos = bisect.bisect_left(self._keys, packed)
+    if pos < len(self._keys) and self._keys[pos] == packed:
+      return self._values[pos]
+    return None
+
+  def _Compact(self):
+    """Merge the overlay into the arrays.
+
+    """
+    overlay_keys = self._overlay.keys()
+    overlay_keys.sort()
+    old_keys = self._keys
+    old_values = self._values
+    keys = array.array("I")
+    values = array.array("I")
+    pos = 0
+    for packed in overlay_keys:
+      end = bisect.bisect_left(old_keys, packed, pos)
+      keys.extend(old_keys[pos:end])
+      values.extend(old_values[pos:end])
+      pos = end
+      if pos < len(old_keys) and old_keys[pos] == packed:
+        pos += 1
+      index = self._overlay[packed]
+      if index != _REMOVED:
+        keys.append(packed)
+        values.append(index)
+    keys.extend(old_keys[pos:])
+    values.extend(old_values[pos:])
+    self._keys = keys
+    self._values = values
+    self._overlay = {}
+
+  def _IterPacked(self):
+    """Iterate over the (packed instance address, node index) pairs.
+
+    """
+    for (pos, packed) in enumerate(self._keys):
+      if packed not in self._overlay:
+        yield (packed, self._values[pos])
+    for (packed, index) in self._overlay.iteritems():
+      if index != _REMOVED:
+        yield (packed, index)
+
+  def __len__(self):
+    return self._len
+
+  def __contains__(self, instance):
+    return self.get(instance, None) is not None
+
+  def __getitem__(self, instance):
+    node = self.get(instance, None)
+    if node is None:
+      raise KeyError(instance)
+    return node
+
+  def get(self, instance, default=None):
+    """Return the node of an instance, or default if it's unknown.
+
+    """
+    packed = _PackAddress(instance)
+    if packed is None:
+      return self._other.get(instance, default)
+    index = self._FindPacked(packed)
+    if index is None:
+      return default
+    return self._nodes[index]
+
+  def __setitem__(self, instance, node):
+    packed = _PackAddress(instance)
+    if packed is None:
+      if instance not in self._other:
+        self._len += 1
+      self._other[instance] = node
+      self._InternNode(node)
+      return
+    if self._FindPacked(packed) is None:
+      self._len += 1
+    self._overlay[packed] = self._InternNode(node)
+    if len(self._overlay) > max(_MIN_OVERLAY_SIZE,
+                                len(self._keys) / _OVERLAY_RATIO):
+      self._Compact()
+
+  def __delitem__(self, instance):
+    packed = _PackAddress(instance)
+    if packed is None:
+      del self._other[instance]
+      self._len -= 1
+      return
+    if self._FindPacked(packed) is None:
+      raise KeyError(instance)
+    self._overlay[packed] = _REMOVED
+    self._len -= 1
+    if len(self._overlay) > max(_MIN_OVERLAY_SIZE,
+                                len(self._keys) / _OVERLAY_RATIO):
+      self._Compact()
+
+  def iteritems(self):
+    """Iterate over the (instance, node) pairs.
+
+    """
+    for (packed, index) in self._IterPacked():
+      yield (_UnpackAddress(packed), self._nodes[index])
+    for item in self._other.iteritems():
+      yield item
+
+  def items(self):
+    return list(self.iteritems())
+
+  def __iter__(self):
+    for (instance, _) in self.iteritems():
+      yield instance
+
+  def iterkeys(self):
+    return self.__iter__()
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def values(self):
+    return [node for (_, node) in self.iteritems()]
+
+  def copy(self):
+    """Return a copy of the map.
+
+    """
+    return InstanceNodeMap(dict(self.iteritems()))
+
+  def __eq__(self, other):
+    return dict(self.iteritems()) == dict(other.iteritems())
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
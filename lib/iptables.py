@@ -31,23 +31,35 @@ of network traffic only if it is accepted by the chain.
 The functions in this module expect to find a pre-configured GNT_TRUST chain in
 the filter table containing this kind of rules: "-j CHAINNAME"
 
+Alternatively, with the UpdateIpset* functions, the trusted IPs are kept in an
+ipset of type hash:ip, matched by a single rule, so that the set can be
+changed incrementally and packets are matched in constant time.
+
 """
 
 
+import os
 import random
 # pylint: disable-msg=W0402
 # Uses of a deprecated module 'string'
 import string
+import tempfile
 import netfilter.table
-import netfilter.rule
 
 from ganeti import errors
+from ganeti import utils
 
 
 _TABLE_FILTER = "filter"
 _TARGET_ACCEPT = "ACCEPT"
 _CHAIN_TRUST = "GNT_TRUST"
 _CHAIN_NAME_LEN = 30
+_SET_TRUST = "gnt_trust"
+_IPSET_TYPE = "hash:ip"
+
+# Cache of the IPs chains linked from each trust chain, as last committed by
+# us: (table name, trust chain) -> list of chain names
+_trust_subchains = {}
 
 
 def _GenRandomString(length):
@@ -71,6 +83,8 @@ def CheckIptablesChain(table_name, chain_name):
   @type chain_name: str
   @param chain_name: the name of the chain
 
+  @rtype: list
+  @return: the rules in the chain
   @raise errors.ConfigurationError: if a check fails
   @raise errors.CommandError: if an error occurs during check
 
@@ -98,12 +112,107 @@ def CheckIptablesChain(table_name, chain_name):
       raise errors.ConfigurationError("In %s non-well formed rule: %r" %
                                       (chain_name, rule_args))
 
+  return rules
+
+
+def _GetTrustSubchains(table_name, trust_chain):
+  """Return the IPs chains currently linked from the trust chain.
+
+  The chain is only checked and listed the first time; afterwards the state
+  we committed ourselves is used.
+
+  @rtype: list
+  @return: names of the chains jumped to from the trust chain
+
+  """
+  key = (table_name, trust_chain)
+  if key not in _trust_subchains:
+    rules = CheckIptablesChain(table_name, trust_chain)
+    _trust_subchains[key] = [rule.specbits()[1] for rule in rules]
+  return _trust_subchains[key]
+
+
+def _BuildRestoreInput(table_name, trust_chain, new_chain, old_chains,
+                       rules, link=True):
+  """Build the iptables-restore input replacing the trusted IPs chain.
+
+  @type rules: list
+  @param rules: rule specifications to put in the new chain
+  @type link: boolean
+  @param link: whether to link the new chain from the trust chain, i.e.
+      whether it isn't linked already
+
+  """
+  lines = [
+    "*%s" % table_name,
+    ":%s - [0:0]" % new_chain,
+    ]
+  for rule in rules:
+    lines.append("-A %s %s" % (new_chain, rule))
+  if link:
+    lines.append("-I %s 1 -j %s" % (trust_chain, new_chain))
+  for old_chain in old_chains:
+    lines.append("-D %s -j %s" % (trust_chain, old_chain))
+    lines.append("-F %s" % old_chain)
+    lines.append("-X %s" % old_chain)
+  lines.append("COMMIT")
+  return "\n".join(lines) + "\n"
+
+
+def _RunRestore(command, data):
+  """Run a restore command, feeding it the given data.
+
+  @type command: str
+  @param command: the command to run, e.g. "iptables-restore --noflush"
+  @type data: str
+  @param data: the command input
+
+  @raise errors.CommandError: if the command fails
+
+  """
+  (fd, restore_file) = tempfile.mkstemp(prefix="nld-restore-")
+  try:
+    os.write(fd, data)
+    os.close(fd)
+    result = utils.RunCmd("%s < %s" % (command,
+                                       utils.ShellQuote(restore_file)))
+  finally:
+    utils.RemoveFile(restore_file)
+  if result.failed:
+    raise errors.CommandError("%s failed: %s" % (command, result.output))
+
+
+def _ReplaceTrustSubchains(table_name, trust_chain, new_chain, rules):
+  """Replace the chains linked from the trust chain with a new one.
+
+  This is done in a single "iptables-restore --noflush" transaction.
+
+  @raise errors.CommandError: if the transaction fails
+
+  """
+  linked_chains = _GetTrustSubchains(table_name, trust_chain)
+  # The new chain may be linked already (e.g. the ipset chain, next to IPs
+  # chains): it's refilled in place, and must not be removed
+  old_chains = [chain for chain in linked_chains if chain != new_chain]
+  data = _BuildRestoreInput(table_name, trust_chain, new_chain, old_chains,
+                            rules, link=new_chain not in linked_chains)
+  try:
+    _RunRestore("iptables-restore --noflush", data)
+  except errors.CommandError:
+    # We don't know what the current state is anymore
+    del _trust_subchains[(table_name, trust_chain)]
+    raise
+  _trust_subchains[(table_name, trust_chain)] = [new_chain]
+
 
 def UpdateIptablesRules(ip_addresses, table_name=_TABLE_FILTER,
                         trust_chain=_CHAIN_TRUST, jump_chain=_TARGET_ACCEPT,
                         chain_name_len=_CHAIN_NAME_LEN):
   """Update rules allowing the given list of ip_addresses.
 
+  The new IPs chain is created, populated and linked from the trust chain,
+  and the old ones removed, in a single iptables-restore transaction.
+
   @type ip_addresses: list
   @param ip_addresses: the IPs to allow
   @type table_name: str
@@ -118,41 +227,84 @@ def UpdateIptablesRules(ip_addresses, table_name=_TABLE_FILTER,
   @raise errors.CommandError: if an error occurs while using iptables
 
   """
-  CheckIptablesChain(table_name, trust_chain)
-  table = netfilter.table.Table(table_name)
-  try:
-    old_rules = table.list_rules(trust_chain)
-  except netfilter.table.IptablesError, err:
-    raise errors.CommandError("Cannot lookup %s: %s" %
-                              (trust_chain, err))
-
   # Create new IPs chain
   ips_prefix = "%s_IPS_" % trust_chain
   ips_suffix = _GenRandomString(chain_name_len - len(ips_prefix))
   new_ips = "%s%s" % (ips_prefix, ips_suffix)
-  try:
-    table.create_chain(new_ips)
-    try:
-      # Populate new chain
-      for addr in ip_addresses:
-        rule = netfilter.rule.Rule(source=addr, jump=jump_chain)
-        table.append_rule(new_ips, rule)
-      # Add new chain to trust chain
-      new_ips_rule = netfilter.rule.Rule(jump=new_ips)
-      table.prepend_rule(trust_chain, new_ips_rule)
-    except netfilter.table.IptablesError, err:
-      table.flush_chain(new_ips)
-      table.delete_chain(new_ips)
-      raise
-  except netfilter.table.IptablesError, err:
-    raise errors.CommandError("Cannot create new IPs table: %s" % err)
-
-  # Deactivate old chains
-  for rule in old_rules:
-    try:
-      old_chain = rule.specbits()[1]
-      table.delete_rule(trust_chain, rule)
-      table.flush_chain(old_chain)
-      table.delete_chain(old_chain)
-    except netfilter.table.IptablesError, err:
-      raise errors.CommandError("Cannot remove old IPs tables: %s" % err)
+
+  rules = ["-s %s -j %s" % (addr, jump_chain) for addr in ip_addresses]
+  _ReplaceTrustSubchains(table_name, trust_chain, new_ips, rules)
+
+
+def _EnsureIpsetLinked(table_name, trust_chain, set_name, jump_chain):
+  """Make sure the trust chain matches the ipset, instead of IPs chains.
+
+  The set is matched from a "<trust_chain>_SET" chain, so that the trust
+  chain keeps containing only "-j CHAINNAME" rules.
+
+  """
+  set_chain = "%s_SET" % trust_chain
+  if _GetTrustSubchains(table_name, trust_chain) == [set_chain]:
+    return
+  rule = "-m set --match-set %s src -j %s" % (set_name, jump_chain)
+  _ReplaceTrustSubchains(table_name, trust_chain, set_chain, [rule])
+
+
+def SyncIpsetRules(ip_addresses, set_name=_SET_TRUST,
+                   table_name=_TABLE_FILTER, trust_chain=_CHAIN_TRUST,
+                   jump_chain=_TARGET_ACCEPT):
+  """Replace the content of the trusted IPs set.
+
+  A new set is filled and then swapped with the current one, so the change is
+  atomic for the packets being matched.
+
+  @type ip_addresses: list
+  @param ip_addresses: the IPs to allow
+  @type set_name: str
+  @param set_name: the name of the ipset to use
+  @type table_name: str
+  @param table_name: the name of the table to work in
+  @type trust_chain: str
+  @param trust_chain: the name of the chain to modify
+  @type jump_chain: str
+  @param jump_chain: the name of the chain to jump in the matching rule
+
+  @raise errors.CommandError: if an error occurs while using ipset/iptables
+
+  """
+  tmp_set = "%s_tmp" % set_name
+  lines = [
+    "create %s %s -exist" % (set_name, _IPSET_TYPE),
+    "create %s %s -exist" % (tmp_set, _IPSET_TYPE),
+    "flush %s" % tmp_set,
+    ]
+  for addr in ip_addresses:
+    lines.append("add %s %s -exist" % (tmp_set, addr))
+  lines.append("swap %s %s" % (tmp_set, set_name))
+  lines.append("destroy %s" % tmp_set)
+  _RunRestore("ipset restore", "\n".join(lines) + "\n")
+  _EnsureIpsetLinked(table_name, trust_chain, set_name, jump_chain)
+
+
+def UpdateIpsetMembers(added, removed, set_name=_SET_TRUST,
+                       table_name=_TABLE_FILTER, trust_chain=_CHAIN_TRUST,
+                       jump_chain=_TARGET_ACCEPT):
+  """Add and remove IPs to/from the trusted IPs set.
+
+  @type added: list
+  @param added: the IPs to allow
+  @type removed: list
+  @param removed: the IPs not to allow anymore
+
+  See L{SyncIpsetRules} for the other parameters.
+
+  @raise errors.CommandError: if an error occurs while using ipset/iptables
+
+  """
+  lines = ["create %s %s -exist" % (set_name, _IPSET_TYPE)]
+  for addr in added:
+    lines.append("add %s %s -exist" % (set_name, addr))
+  for addr in removed:
+    lines.append("del %s %s -exist" % (set_name, addr))
+  _RunRestore("ipset restore", "\n".join(lines) + "\n")
+  _EnsureIpsetLinked(table_name, trust_chain, set_name, jump_chain)
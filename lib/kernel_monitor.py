@@ -0,0 +1,182 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Async kernel table monitor
+
+Keeps a shadow copy of the Neighbour and Routing table entries of the NBMA
+interfaces, driven by rtnetlink multicast events, and repairs the entries we
+manage when they drift from what we wrote (e.g. after an "ip neigh flush").
+As with L{networktables.ROUTING_CONTEXT}, only the routes of the main routing
+table are watched.
+
+"""
+
+import asyncore
+import errno
+import logging
+
+from ganeti_nbma import errors
+from ganeti_nbma import instancemap
+from ganeti_nbma import networktables
+from ganeti_nbma import rtnetlink
+
+
+class AsyncKernelTableMonitor(asyncore.file_dispatcher):
+  """An asyncore dispatcher of rtnetlink neighbour and route events.
+
+  """
+  def __init__(self, ifaces, table_writer):
+    """Constructor for AsyncKernelTableMonitor
+
+    @type ifaces: list
+    @param ifaces: names of the interfaces to monitor
+    @type table_writer: L{table_writer.TableWriter}
+    @param table_writer: the writer holding the desired table state, and used
+        to repair drifted entries
+
+    """
+    groups = rtnetlink.RTMGRP_NEIGH | rtnetlink.RTMGRP_IPV4_ROUTE
+    self._socket = rtnetlink.RtNetlinkSocket(groups=groups)
+    asyncore.file_dispatcher.__init__(self, self._socket.fileno())
+    self._ifaces = frozenset(ifaces)
+    self._table_writer = table_writer
+    # ifindex -> interface name
+    self._ifindexes = {}
+    # (context, iface) -> L{instancemap.InstanceNodeMap} of the destinations
+    self._shadow = {}
+    self.Resync()
+
+  def GetShadowTable(self, context, iface):
+    """Return our copy of a kernel table.
+
+    @rtype: dict
+    @return: address to destination mapping
+
+    """
+    return dict(self._shadow.get((context, iface), {}).iteritems())
+
+  def _CheckEntry(self, ip_address, dest_address, context, iface):
+    """Repair an entry if the kernel state differs from the desired one.
+
+    """
+    desired = self._table_writer.GetDesiredEntry(ip_address, context, iface)
+    if desired is None or desired == dest_address:
+      return
+    if self._table_writer.RepairEntry(ip_address, context, iface):
+      logging.info("Repairing drifted %s entry %s on %s (kernel: %s,"
+                   " wanted: %s)", context, ip_address, iface, dest_address,
+                   desired)
+
+  def Resync(self):
+    """Reload the shadow tables from the kernel and repair them.
+
+    This is done at startup, and whenever some events might have been lost.
+
+    """
+    self._ifindexes = {}
+    for iface in self._ifaces:
+      try:
+        self._ifindexes[rtnetlink.GetInterfaceIndex(iface)] = iface
+      except errors.NetlinkError, err:
+        logging.warning("Not monitoring interface %s: %s", iface, err)
+
+    shadow = {}
+    try:
+      dump_socket = rtnetlink.RtNetlinkSocket()
+    except errors.NetlinkError, err:
+      logging.error("Cannot dump the kernel tables: %s", err)
+      return
+    try:
+      for (ifindex, iface) in self._ifindexes.iteritems():
+        try:
+          shadow[(networktables.NEIGHBOUR_CONTEXT, iface)] = \
+            instancemap.InstanceNodeMap(
+              rtnetlink.DumpNeighbourTable(dump_socket, ifindex))
+          shadow[(networktables.ROUTING_CONTEXT, iface)] = \
+            instancemap.InstanceNodeMap(
+              rtnetlink.DumpRouteTable(dump_socket, ifindex))
+        except errors.NetlinkError, err:
+          logging.warning("Cannot dump the kernel tables for %s: %s", iface,
+                          err)
+    finally:
+      dump_socket.close()
+    self._shadow = shadow
+
+    for ((context, iface), table) in shadow.iteritems():
+      desired = self._table_writer.GetDesiredTable(context, iface)
+      for (ip_address, dest_address) in desired.iteritems():
+        if table.get(ip_address, None) != dest_address:
+          self._CheckEntry(ip_address, table.get(ip_address, None), context,
+                           iface)
+
+  def _HandleEvent(self, msg_type, body):
+    """Update the shadow tables with a single event.
+
+    """
+    if msg_type in (rtnetlink.RTM_NEWNEIGH, rtnetlink.RTM_DELNEIGH):
+      context = networktables.NEIGHBOUR_CONTEXT
+      (ifindex, _, ip_address, dest_address) = \
+        rtnetlink.ParseNeighbourMessage(body)
+      removed = (msg_type == rtnetlink.RTM_DELNEIGH)
+    elif msg_type in (rtnetlink.RTM_NEWROUTE, rtnetlink.RTM_DELROUTE):
+      context = networktables.ROUTING_CONTEXT
+      (rt_table, ifindex, ip_address, dest_address) = \
+        rtnetlink.ParseRouteMessage(body)
+      if rt_table != rtnetlink.RT_TABLE_MAIN:
+        return
+      removed = (msg_type == rtnetlink.RTM_DELROUTE)
+    else:
+      return
+
+    iface = self._ifindexes.get(ifindex, None)
+    if iface is None or ip_address is None:
+      return
+
+    table = self._shadow.setdefault((context, iface),
+                                    instancemap.InstanceNodeMap())
+    if removed:
+      if ip_address in table:
+        del table[ip_address]
+      dest_address = None
+    else:
+      table[ip_address] = dest_address
+    self._CheckEntry(ip_address, dest_address, context, iface)
+
+  def handle_read(self):
+    try:
+      messages = self._socket.Receive()
+    except errors.NetlinkError, err:
+      if len(err.args) > 1 and err.args[1] == errno.ENOBUFS:
+        logging.warning("Lost kernel table events, resynchronizing")
+        self.Resync()
+      elif len(err.args) < 2 or err.args[1] != errno.EAGAIN:
+        logging.error("Error receiving kernel table events: %s", err)
+      return
+
+    for (msg_type, _, _, body) in messages:
+      try:
+        self._HandleEvent(msg_type, body)
+      except errors.NetlinkError, err:
+        logging.debug("Ignoring malformed kernel table event: %s", err)
+
+  # We don't need to check for the socket to be ready for writing
+  def writable(self):
+    return False
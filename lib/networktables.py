@@ -27,17 +27,37 @@ Besides adding and removing individual entries, it can also be used to
 add (or replace, if necessary) the entries in a given dictionary with
 src_ip:dest_addr mapping.
 
+Changes are applied either by running the ip command or, with the netlink
+backend, by sending messages over a single rtnetlink socket (see
+L{SetBackend}).
+
 """
 
 
+import errno
+import logging
+import os
+import re
+import tempfile
+
+from ganeti_nbma import constants
+from ganeti_nbma import errors
+from ganeti_nbma import rtnetlink
+
 from ganeti import errors as ganeti_errors
 from ganeti import utils
 
 
 NEIGHBOUR_CONTEXT = "neigh"
+# Routes are read and written in the main routing table only, by both
+# backends (as "ip route" does without "table"); routes in other tables are
+# neither listed nor changed
 ROUTING_CONTEXT = "route"
 CONTEXTS = frozenset([NEIGHBOUR_CONTEXT, ROUTING_CONTEXT])
 
+# Failed commands reported by "ip -force -batch"
+_BATCH_FAILURE_RE = re.compile(r"^Command failed \S+:(\d+)$", re.M)
+
 
 def _CheckValidContext(context):
   """Verify if the context is valid.
@@ -52,6 +72,303 @@ def _CheckValidContext(context):
     raise ganeti_errors.ParameterError("Invalid context '%s'" % context)
 
 
+def _DestToken(context):
+  """Return the token introducing the destination address in ip(8) output.
+
+  """
+  if context == NEIGHBOUR_CONTEXT:
+    return "lladdr"
+  else:
+    return "via"
+
+
+def ParseNetworkTable(output, context):
+  """Parse the output of "ip <context> show dev <iface>".
+
+  @type output: str
+  @param output: the command output
+  @type context: str
+  @param context: one of CONTEXTS
+  @rtype: dict
+  @return: address to destination address mapping; entries without a
+      destination (e.g. failed neighbours, link routes) map to None
+
+  """
+  dest_token = _DestToken(context)
+  table = {}
+  for entry in output.splitlines():
+    parts = entry.split()
+    # Skip empty lines
+    if not parts:
+      continue
+    dest_address = None
+    for idx in range(1, len(parts) - 1):
+      if parts[idx] == dest_token:
+        dest_address = parts[idx + 1]
+        break
+    table[parts[0]] = dest_address
+  return table
+
+
+def ComputeNetworkTableChanges(current, desired, prune=False):
+  """Compute the changes needed to turn a table into the desired one.
+
+  @type current: dict
+  @param current: address to destination mapping, as in the kernel
+  @type desired: dict
+  @param desired: address to destination mapping to be installed
+  @type prune: boolean
+  @param prune: whether to remove entries missing from the desired table
+  @rtype: list
+  @return: sorted list of (address, destination) changes, where a destination
+      of None means the entry has to be removed
+
+  """
+  changes = []
+  for (ip_address, dest_address) in desired.iteritems():
+    if current.get(ip_address, None) != dest_address:
+      changes.append((ip_address, dest_address))
+  if prune:
+    for ip_address in current:
+      if ip_address not in desired:
+        changes.append((ip_address, None))
+  changes.sort()
+  return changes
+
+
+class _IpCommandBackend(object):
+  """Table backend forking the ip(8) command.
+
+  Multiple changes are applied with a single "ip -batch" run.
+
+  """
+  name = constants.NETWORK_BACKEND_IP
+
+  # pylint: disable-msg=R0201
+  def _BuildArgs(self, ip_address, dest_address, context, iface):
+    """Build the ip(8) arguments to update or remove an entry.
+
+    A dest_address of None means the entry has to be removed.
+
+    """
+    if dest_address is None:
+      return [context, "del", ip_address, "dev", iface]
+
+    args = [context, "replace", ip_address, _DestToken(context), dest_address,
+            "dev", iface]
+    # Context-specific args
+    if context == NEIGHBOUR_CONTEXT:
+      args.extend(["nud", "permanent"])
+    return args
+
+  def RemoveEntry(self, ip_address, context, iface):
+    result = utils.RunCmd(["ip"] +
+                          self._BuildArgs(ip_address, None, context, iface))
+
+    # Check the command return code.
+    #   0: success
+    #   2: non-existent entry, we're fine with that
+    #   something else: unknown, raise error
+    if result.exit_code not in (0, 2):
+      raise ganeti_errors.CommandError("Can't remove network entry")
+
+  def UpdateEntry(self, ip_address, dest_address, context, iface):
+    result = utils.RunCmd(["ip"] + self._BuildArgs(ip_address, dest_address,
+                                                   context, iface))
+    if result.failed:
+      raise ganeti_errors.CommandError("Could not update table, error %s" %
+                                       result.output)
+
+  def DumpTable(self, context, iface):
+    result = utils.RunCmd(["ip", context, "show", "dev", iface])
+    if result.failed:
+      raise ganeti_errors.CommandError("Could not list table, error %s" %
+                                       result.output)
+    return ParseNetworkTable(result.output, context)
+
+  def ApplyChanges(self, changes, context, iface):
+    lines = [" ".join(self._BuildArgs(ip_address, dest_address, context,
+                                      iface))
+             for (ip_address, dest_address) in changes]
+    (fd, batch_file) = tempfile.mkstemp(prefix="nld-batch-")
+    try:
+      os.write(fd, "\n".join(lines) + "\n")
+      os.close(fd)
+      result = utils.RunCmd(["ip", "-force", "-batch", batch_file])
+    finally:
+      utils.RemoveFile(batch_file)
+
+    if not result.failed:
+      return []
+
+    # With -force ip goes on after a failure, and reports the line number of
+    # each failed command; only those get retried one by one, so that they
+    # get the same error handling as single updates
+    failed_lines = [int(line_no) - 1 for line_no in
+                    _BATCH_FAILURE_RE.findall(result.output)]
+    if not failed_lines:
+      failed_lines = range(len(changes))
+    failures = []
+    for idx in failed_lines:
+      (ip_address, dest_address) = changes[idx]
+      try:
+        if dest_address is None:
+          self.RemoveEntry(ip_address, context, iface)
+        else:
+          self.UpdateEntry(ip_address, dest_address, context, iface)
+      except ganeti_errors.CommandError, err:
+        failures.append((ip_address, str(err)))
+    return failures
+
+
+class _NetlinkBackend(object):
+  """Table backend talking to the kernel over a single rtnetlink socket.
+
+  Multiple changes are sent to the kernel in a single burst of messages. As
+  the socket is shared, the backend must only be used by one thread at a time
+  (normally the L{table_writer.TableWriter} thread).
+
+  """
+  name = constants.NETWORK_BACKEND_NETLINK
+
+  def __init__(self):
+    self._socket = rtnetlink.RtNetlinkSocket()
+    self._ifindexes = {}
+
+  def _GetIfindex(self, iface):
+    try:
+      return self._ifindexes[iface]
+    except KeyError:
+      ifindex = rtnetlink.GetInterfaceIndex(iface)
+      self._ifindexes[iface] = ifindex
+      return ifindex
+
+  def _BuildMessage(self, ip_address, dest_address, context, iface):
+    """Build a (type, flags, body) message to update or remove an entry.
+
+    A dest_address of None means the entry has to be removed.
+
+    """
+    ifindex = self._GetIfindex(iface)
+    if dest_address is None:
+      flags = 0
+      if context == NEIGHBOUR_CONTEXT:
+        msg_type = rtnetlink.RTM_DELNEIGH
+      else:
+        msg_type = rtnetlink.RTM_DELROUTE
+    else:
+      flags = rtnetlink.NLM_F_CREATE | rtnetlink.NLM_F_REPLACE
+      if context == NEIGHBOUR_CONTEXT:
+        msg_type = rtnetlink.RTM_NEWNEIGH
+      else:
+        msg_type = rtnetlink.RTM_NEWROUTE
+
+    if context == NEIGHBOUR_CONTEXT:
+      body = rtnetlink.BuildNeighbourMessage(msg_type, ip_address, ifindex,
+                                             lladdr=dest_address)
+    else:
+      body = rtnetlink.BuildRouteMessage(msg_type, ip_address, ifindex,
+                                         gateway=dest_address)
+    return (msg_type, flags, body)
+
+  def _Apply(self, changes, context, iface):
+    """Send a burst of changes, returning the errno for each of them.
+
+    """
+    try:
+      messages = [self._BuildMessage(ip_address, dest_address, context, iface)
+                  for (ip_address, dest_address) in changes]
+      results = self._socket.Transaction(messages)
+    except errors.NetlinkError, err:
+      raise ganeti_errors.CommandError("Netlink error: %s" % err)
+    if errno.ENODEV in results:
+      # The interface might have been recreated with a different index
+      self._ifindexes.pop(iface, None)
+    return results
+
+  @staticmethod
+  def _IsFailure(dest_address, error):
+    # Removing non-existent entries is fine, as with the ip command
+    if dest_address is None:
+      return error not in (0, errno.ENOENT, errno.ESRCH)
+    return error != 0
+
+  def RemoveEntry(self, ip_address, context, iface):
+    (error, ) = self._Apply([(ip_address, None)], context, iface)
+    if self._IsFailure(None, error):
+      raise ganeti_errors.CommandError("Can't remove network entry: %s" %
+                                       errno.errorcode.get(error, error))
+
+  def UpdateEntry(self, ip_address, dest_address, context, iface):
+    (error, ) = self._Apply([(ip_address, dest_address)], context, iface)
+    if self._IsFailure(dest_address, error):
+      raise ganeti_errors.CommandError("Could not update table, error %s" %
+                                       errno.errorcode.get(error, error))
+
+  def DumpTable(self, context, iface):
+    try:
+      ifindex = self._GetIfindex(iface)
+      if context == NEIGHBOUR_CONTEXT:
+        return rtnetlink.DumpNeighbourTable(self._socket, ifindex)
+      else:
+        return rtnetlink.DumpRouteTable(self._socket, ifindex)
+    except errors.NetlinkError, err:
+      raise ganeti_errors.CommandError("Could not list table, error %s" % err)
+
+  def ApplyChanges(self, changes, context, iface):
+    results = self._Apply(changes, context, iface)
+    failures = []
+    for ((ip_address, dest_address), error) in zip(changes, results):
+      if self._IsFailure(dest_address, error):
+        failures.append((ip_address, errno.errorcode.get(error, error)))
+    return failures
+
+
+_BACKENDS = {
+  constants.NETWORK_BACKEND_IP: _IpCommandBackend,
+  constants.NETWORK_BACKEND_NETLINK: _NetlinkBackend,
+  }
+
+assert frozenset(_BACKENDS) == constants.NETWORK_BACKENDS, \
+  "_BACKENDS is unaligned with NETWORK_BACKENDS"
+
+_backend = _IpCommandBackend()
+
+
+def SetBackend(name):
+  """Select the backend used to program the Neighbour and Routing tables.
+
+  If the netlink backend cannot be initialized the ip command is used
+  instead.
+
+  @type name: str
+  @param name: one of L{constants.NETWORK_BACKENDS}
+
+  @raise L{ganeti.errors.ParameterError}: invalid backend
+
+  """
+  global _backend # pylint: disable-msg=W0603
+
+  try:
+    backend_class = _BACKENDS[name]
+  except KeyError:
+    raise ganeti_errors.ParameterError("Invalid network backend '%s'" % name)
+
+  try:
+    _backend = backend_class()
+  except errors.NetlinkError, err:
+    logging.warning("Cannot use the %s network backend (%s), falling back to"
+                    " %s", name, err, constants.NETWORK_BACKEND_IP)
+    _backend = _IpCommandBackend()
+
+
+def GetBackendName():
+  """Return the name of the backend in use.
+
+  """
+  return _backend.name
+
+
 def RemoveNetworkEntry(ip_address, context, iface):
   """Remove an entry in the local Neighbour or Routing table.
 
@@ -66,14 +383,7 @@ def RemoveNetworkEntry(ip_address, context, iface):
 
   """
   _CheckValidContext(context)
-  result = utils.RunCmd(["ip", context, "del", ip_address, "dev", iface])
-
-  # Check the command return code.
-  #   0: success
-  #   2: non-existent entry, we're fine with that
-  #   something else: unknown, raise error
-  if result.exit_code not in (0, 2):
-    raise ganeti_errors.CommandError("Can't remove network entry")
+  _backend.RemoveEntry(ip_address, context, iface)
 
 
 def UpdateNetworkEntry(ip_address, dest_address, context, iface):
@@ -92,30 +402,55 @@ def UpdateNetworkEntry(ip_address, dest_address, context, iface):
 
   """
   _CheckValidContext(context)
+  _backend.UpdateEntry(ip_address, dest_address, context, iface)
 
-  # Context-specific args
-  if context == NEIGHBOUR_CONTEXT:
-    dest_token = "lladdr"
-    extra_args = ["nud", "permanent"]
-  else:
-    dest_token = "via"
-    extra_args = []
 
-  cmd = ["ip", context, "replace", ip_address, dest_token, dest_address,
-         "dev", iface]
+def GetNetworkTable(context, iface):
+  """Return a snapshot of the local Neighbour or Routing table.
+
+  @type context: str
+  @param context: one of CONTEXTS
+  @type iface: str
+  @param iface: network interface to use
+  @rtype: dict
+  @return: address to destination address mapping
+
+  @raise L{ganeti.errors.CommandError}: if an error occurs when listing a table
+
+  """
+  _CheckValidContext(context)
+  return _backend.DumpTable(context, iface)
+
+
+def ApplyNetworkChanges(changes, context, iface):
+  """Apply a batch of changes to the local Neighbour or Routing table.
+
+  All changes are attempted, even if some of them fail.
+
+  @type changes: list
+  @param changes: list of (address, destination) tuples, as returned by
+      L{ComputeNetworkTableChanges}; a destination of None removes the entry
+  @type context: str
+  @param context: one of CONTEXTS
+  @type iface: str
+  @param iface: network interface to use
+  @rtype: list
+  @return: list of (address, error message) tuples for the failed changes
+
+  @raise L{ganeti.errors.CommandError}: if the batch cannot be run at all
 
-  if extra_args:
-    cmd.extend(extra_args)
-  result = utils.RunCmd(cmd)
-  if result.failed:
-    raise ganeti_errors.CommandError("Could not update table, error %s" %
-                                     result.output)
+  """
+  _CheckValidContext(context)
+  if not changes:
+    return []
+  return _backend.ApplyChanges(changes, context, iface)
 
 
-def UpdateNetworkTable(instances, context, iface):
+def UpdateNetworkTable(instances, context, iface, prune=False):
   """Add or replace the entries in instances in the Neigh|Routing table.
 
-  If the instance's IP is not there, add it.
+  The current table is read once, and only the entries which are missing or
+  point to a different destination are changed, in a single batch.
 
   @type instances: dict
   @param instances: dict with instance:dest_address mapping
@@ -123,32 +458,19 @@ def UpdateNetworkTable(instances, context, iface):
   @param context: one of CONTEXTS
   @type iface: str
   @param iface: network interface to use
+  @type prune: boolean
+  @param prune: also remove the entries on iface which are not in instances
+  @rtype: int
+  @return: the number of entries changed
 
   @raise L{ganeti.errors.CommandError}: if an error occurs when listing a table
+      or if some entries couldn't be changed
 
   """
-  _CheckValidContext(context)
-  # Check the local table
-  result = utils.RunCmd(["ip", context, "show", "dev", iface])
-  if result.failed:
-    raise ganeti_errors.CommandError("Could not list table, error %s" %
-                                     result.output)
-  table = result.output.splitlines()
-
-  # Check if the local entries are up to date.
-  for entry in table:
-    # Skip empty lines
-    if not entry.strip():
-      continue
-    parts = entry.split()
-    # Get the address (first field)
-    src_ip = parts[0]
-    if src_ip in instances:
-      dest_addr = instances[src_ip]
-      UpdateNetworkEntry(src_ip, dest_addr, context, iface)
-
-  # Check the instance list, to make sure we're not missing anything
-  for instance_ip in instances:
-    if instance_ip not in table:
-      UpdateNetworkEntry(instance_ip, instances[instance_ip],
-                         context, iface)
+  current = GetNetworkTable(context, iface)
+  changes = ComputeNetworkTableChanges(current, instances, prune=prune)
+  failures = ApplyNetworkChanges(changes, context, iface)
+  if failures:
+    raise ganeti_errors.CommandError("Could not update %d entries: %s" %
+                                     (len(failures), failures))
+  return len(changes)
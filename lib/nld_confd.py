@@ -22,8 +22,13 @@
 
 """
 
+import collections
 import logging
+import random
+import time
 
+from ganeti_nbma import confd_peers
+from ganeti_nbma import instancemap
 from ganeti_nbma import networktables
 
 from ganeti import confd
@@ -51,13 +56,522 @@ MASTER_UPDATE_TIMEOUT = 30
 # time to get a confd response.
 INSTANCE_MAP_UPDATE_TIMEOUT = 5
 
+# Adaptive polling
+#
+# The periods above are the base polling intervals. While the replies show no
+# change an interval is multiplied by UPDATE_BACKOFF_FACTOR, up to
+# UPDATE_MAX_BACKOFF times its base, and it gets back to its base after a
+# change. A misrouted packet brings the instance map interval down to the
+# cluster minimum. The cluster minimum and maximum intervals are always
+# enforced.
+UPDATE_BACKOFF_FACTOR = 2
+UPDATE_MAX_BACKOFF = 8
+
+# Each delay is randomly spread by this fraction, so that nodes drift apart
+# instead of polling confd in lockstep
+UPDATE_JITTER = 0.1
+
+# At startup the updates of a cluster are spread over this many seconds,
+# after the cluster startup delay
+STARTUP_JITTER = 2.0
+
+# Seconds between the startup of the updaters of successive clusters
+CLUSTER_STARTUP_STAGGER = 1.0
+
+# Instance map refreshes triggered by misrouted packets and route
+# invalidations are coalesced: at most one refresh is started in each window
+# of this many seconds, and while a refresh is in flight further triggers
+# queue a single follow-up refresh.
+INSTANCE_REFRESH_COALESCE_WINDOW = 1.0
+
+# Update names
+UPDATE_NODES = "nodes"
+UPDATE_MCS = "mcs"
+UPDATE_INSTANCES = "instances"
+UPDATE_MASTER = "master"
+
+# Stale instance entries removal
+#
+# An instance IP must be missing from this many consecutive instance list
+# replies, and for at least this number of seconds, before its neighbour entry
+# is removed. This protects us from dropping live routes because of a
+# flapping or partially configured confd.
+STALE_ENTRY_GRACE_GENERATIONS = 3
+STALE_ENTRY_GRACE_PERIOD = 60
+
+# Mapping queries
+#
+# The instance to node mapping of a link is fetched in chunks, each small
+# enough for the query and its reply to fit in a confd datagram. The size of
+# a chunk is estimated from the length of its IP addresses, plus a fixed
+# overhead per entry covering the encoding and the node address in the
+# reply.
+MAPPING_QUERY_MAX_SIZE = 16384
+MAPPING_QUERY_ENTRY_OVERHEAD = 48
+
+# Negative lookup cache
+#
+# Instances confd reported as unknown are not looked up again for this many
+# seconds, unless the cluster config changes. At most NEGATIVE_CACHE_MAX_SIZE
+# addresses are remembered per cluster.
+NEGATIVE_CACHE_TTL = 60
+NEGATIVE_CACHE_MAX_SIZE = 4096
+
+# Maximum duration of an instance map refresh cycle (seconds). A cycle needs
+# two confd round trips per link, each of which can take up to the confd
+# client expire timeout.
+INSTANCE_REFRESH_CYCLE_TIMEOUT = 2 * gnt_constants.CONFD_CLIENT_EXPIRE_TIMEOUT
+
+
+def ChunkInstances(iplist, max_size=None):
+  """Split a list of instance IPs into size-bounded chunks.
+
+  @type iplist: list
+  @param iplist: instance IP addresses
+  @type max_size: int
+  @param max_size: maximum estimated size of a chunk, by default
+      L{MAPPING_QUERY_MAX_SIZE}
+  @rtype: list
+  @return: list of non-empty lists of IP addresses
+
+  """
+  if max_size is None:
+    max_size = MAPPING_QUERY_MAX_SIZE
+  chunks = []
+  chunk = []
+  size = 0
+  for instance in iplist:
+    entry_size = len(instance) + MAPPING_QUERY_ENTRY_OVERHEAD
+    if chunk and size + entry_size > max_size:
+      chunks.append(chunk)
+      chunk = []
+      size = 0
+    chunk.append(instance)
+    size += entry_size
+  if chunk:
+    chunks.append(chunk)
+  return chunks
+
+
+class _MappingFetch(object):
+  """The chunked mapping queries fetching the instance map of a link.
+
+  """
+  def __init__(self, link, serial, chunks, cycle, client):
+    self.link = link
+    # Config serial of the instance list the chunks were built from
+    self.serial = serial
+    self.cycle = cycle
+    self.client = client
+    self.chunks = chunks
+    # rsalt -> chunk, for the queries in flight
+    self.outstanding = {}
+    # IPs which couldn't be mapped, to be fetched again
+    self.failed = set()
+
+
+class NegativeLookupCache(object):
+  """Remember the instance IPs a cluster doesn't know about.
+
+  Entries expire after a while, and are all dropped when the config serial
+  of the cluster changes. When the cache is full the oldest entries are
+  dropped first.
+
+  """
+  def __init__(self, ttl=NEGATIVE_CACHE_TTL, max_size=NEGATIVE_CACHE_MAX_SIZE):
+    """Constructor for NegativeLookupCache
+
+    @type ttl: int
+    @param ttl: lifetime of the entries (seconds)
+    @type max_size: int
+    @param max_size: maximum number of entries
+
+    """
+    self._ttl = ttl
+    self._max_size = max_size
+    # key -> expiry time
+    self._entries = {}
+    # (expiry time, key), in insertion order
+    self._queue = collections.deque()
+    self._serial = None
+    self.hits = 0
+    self.misses = 0
+
+  def _Expire(self, now):
+    while self._queue and self._queue[0][0] <= now:
+      (expiry, key) = self._queue.popleft()
+      if self._entries.get(key, None) == expiry:
+        del self._entries[key]
+
+  def Add(self, key, now=None):
+    """Add an entry.
+
+    """
+    if now is None:
+      now = time.time()
+    self._Expire(now)
+    while len(self._entries) >= self._max_size:
+      (expiry, old_key) = self._queue.popleft()
+      if self._entries.get(old_key, None) == expiry:
+        del self._entries[old_key]
+    expiry = now + self._ttl
+    self._entries[key] = expiry
+    self._queue.append((expiry, key))
+
+  def Contains(self, key, now=None):
+    """Check for an entry, without affecting the counters.
+
+    """
+    if now is None:
+      now = time.time()
+    return self._entries.get(key, now) > now
+
+  def Lookup(self, key, now=None):
+    """Check for an entry, updating the hit and miss counters.
+
+    """
+    found = self.Contains(key, now=now)
+    if found:
+      self.hits += 1
+    else:
+      self.misses += 1
+    return found
+
+  def SetSerial(self, serial):
+    """Drop all the entries if the config serial changed.
+
+    """
+    if serial != self._serial:
+      if self._entries:
+        logging.debug("Config serial changed, dropping %d negative lookup"
+                      " cache entries", len(self._entries))
+      self.Invalidate()
+      self._serial = serial
+
+  def Remove(self, key):
+    """Forget a key, so that it's looked up again.
+
+    """
+    self._entries.pop(key, None)
+
+  def Invalidate(self):
+    """Drop all the entries.
+
+    """
+    self._entries = {}
+    self._queue.clear()
+
+  def GetStats(self):
+    """Return the cache statistics.
+
+    @rtype: dict
+    @return: number of hits, misses and entries
+
+    """
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "size": len(self._entries),
+      }
+
+
+class InstanceLookup(object):
+  """A single instance mapping query, triggered by traffic to the instance.
+
+  """
+  def __init__(self, link, ip, callback):
+    """Constructor for InstanceLookup
+
+    @type link: string
+    @param link: link the instance is looked up on
+    @type ip: string
+    @param ip: instance IP address
+    @type callback: callable
+    @param callback: function called with the lookup as argument when it
+        completes
+
+    """
+    self.link = link
+    self.ip = ip
+    self.rsalt = None
+    self.finished = False
+    self.failed = False
+    self.found = False
+    self._callback = callback
+
+  def Complete(self, rsalt, failed, found=False):
+    """Complete the lookup, if rsalt is its request.
+
+    @type failed: boolean
+    @param failed: whether no answer was received
+    @type found: boolean
+    @param found: whether the instance is known to the cluster
+
+    """
+    if self.finished or rsalt != self.rsalt:
+      return
+    self.finished = True
+    self.failed = failed
+    self.found = found
+    self._callback(self)
+
+
+class InstanceRefreshCycle(object):
+  """Track the confd requests making up an instance map refresh.
+
+  A refresh sends an instance IP list request for every link, followed by
+  the mapping queries for each list received. Every link has at most one
+  outstanding step (the list request, or the mapping fetch), and the cycle
+  completes when all the links got their mapping, or had a request expire.
+
+  """
+  def __init__(self, links, callback):
+    """Constructor for InstanceRefreshCycle
+
+    @type links: list
+    @param links: links to refresh
+    @type callback: callable
+    @param callback: function called with the cycle as argument when it
+        completes
+
+    """
+    # link -> rsalt of the outstanding request
+    self._pending = dict.fromkeys(links)
+    self._callback = callback
+    self.failed_links = []
+    self.finished = False
+    # Whether any link had its config changed since the previous refresh
+    self.changed = False
+
+  def SetRequest(self, link, rsalt):
+    """Record the outstanding request for a link.
+
+    @param rsalt: rsalt of the request, or any other object identifying the
+        outstanding step
+
+    """
+    if not self.finished and link in self._pending:
+      self._pending[link] = rsalt
+
+  def CompleteLink(self, link, rsalt, failed=False):
+    """Mark a link as done, if rsalt is its outstanding request.
+
+    @type failed: boolean
+    @param failed: whether the link couldn't be refreshed
+
+    """
+    if self.finished or link not in self._pending:
+      return
+    if self._pending[link] != rsalt:
+      return
+    del self._pending[link]
+    if failed:
+      self.failed_links.append(link)
+    if not self._pending:
+      self.Finish()
+
+  def Finish(self):
+    """Complete the cycle, even if some links are still pending.
+
+    """
+    if self.finished:
+      return
+    self.finished = True
+    self.failed_links.extend(self._pending.keys())
+    self._pending = {}
+    self._callback(self)
+
+
+class AdaptiveInterval(object):
+  """A polling interval adapting to the rate of changes.
+
+  """
+  def __init__(self, base, min_interval, max_interval):
+    """Constructor for AdaptiveInterval
+
+    @type base: int
+    @param base: interval used after a change
+    @type min_interval: int
+    @param min_interval: minimum interval
+    @type max_interval: int
+    @param max_interval: maximum interval
+
+    """
+    self._base = base
+    self._min = min_interval
+    self._max = max_interval
+    self._backoff_limit = min(base * UPDATE_MAX_BACKOFF, max_interval)
+    self._current = base
+
+  def GetInterval(self):
+    """Return the current interval, within the configured bounds.
+
+    """
+    return max(self._min, min(self._max, self._current))
+
+  def GetDelay(self):
+    """Return the delay until the next update, including jitter.
+
+    """
+    jitter = random.uniform(-UPDATE_JITTER, UPDATE_JITTER)
+    return self.GetInterval() * (1 + jitter)
+
+  def Backoff(self):
+    """Lengthen the interval after an update bringing no change.
+
+    """
+    self._current = min(self._current * UPDATE_BACKOFF_FACTOR,
+                        max(self._base, self._backoff_limit))
+
+  def Reset(self):
+    """Get back to the base interval after a change.
+
+    """
+    self._current = self._base
+
+  def Tighten(self):
+    """Poll as fast as allowed, e.g. when we know something changed.
+
+    """
+    self._current = self._min
+
+
+class KernelTableReconciler(object):
+  """Remove the neighbour entries no cluster wants from the tunnels.
+
+  The stale entry sweep only knows the instances cached by this daemon, and
+  misses the entries we wrote which aren't cached anymore, e.g. those whose
+  removal failed, or those left by an earlier run for clusters which aren't
+  configured anymore. Each time all the clusters fully refreshed the links
+  of a tunnel, its neighbour table is dumped, and the leftover entries of
+  the table writer are removed, with the same grace as in the sweep.
+
+  Only the entries written by ganeti-nld are removed: those written by
+  others, such as the endpoint entry set up by gre_setup or static entries
+  added by hand, are left alone.
+
+  """
+  def __init__(self, nld_config, table_writer):
+    """Constructor for KernelTableReconciler
+
+    @type nld_config: L{lib.config.NLDConfig}
+    @param nld_config: ganeti-nld configuration
+    @type table_writer: L{table_writer.TableWriter}
+    @param table_writer: writer for the neighbour table entries
+
+    """
+    self.table_writer = table_writer
+    self._link_tunnels = nld_config.tables_tunnels
+    # tunnel -> links
+    self._tunnel_links = {}
+    for (link, tunnel) in nld_config.tables_tunnels.iteritems():
+      self._tunnel_links.setdefault(tunnel, set()).add(link)
+    self._clusters = set()
+    # tunnel -> (cluster name, link) refreshed since the last dump
+    self._refreshed = {}
+    # tunnels being dumped
+    self._dumping = set()
+    # tunnel -> {ip: (number of dumps, timestamp) unwanted since}
+    self._unwanted = {}
+
+  def RegisterCluster(self, cluster_name):
+    """Register a cluster, whose refreshes are waited for.
+
+    """
+    self._clusters.add(cluster_name)
+
+  def LinkRefreshed(self, cluster_name, link):
+    """Record a complete refresh of a link by a cluster.
+
+    The tunnel of the link is reconciled once all the clusters refreshed
+    all its links.
+
+    """
+    tunnel = self._link_tunnels.get(link, None)
+    if tunnel is None:
+      return
+    refreshed = self._refreshed.setdefault(tunnel, set())
+    refreshed.add((cluster_name, link))
+    if tunnel in self._dumping:
+      return
+    for cluster in self._clusters:
+      for tunnel_link in self._tunnel_links[tunnel]:
+        if (cluster, tunnel_link) not in refreshed:
+          return
+    self._refreshed[tunnel] = set()
+    self._dumping.add(tunnel)
+
+    def _Callback(table, error):
+      self._TableDumped(tunnel, table, error)
+    self.table_writer.DumpTable(networktables.NEIGHBOUR_CONTEXT, tunnel,
+                                _Callback)
+
+  def _TableDumped(self, tunnel, table, error):
+    """Remove the entries of a tunnel unwanted for long enough.
+
+    """
+    self._dumping.discard(tunnel)
+    if error is not None:
+      logging.warning("Cannot dump the neighbour table of %s: %s",
+                      tunnel, error)
+      return
+
+    desired = self.table_writer.GetDesiredTable(
+      networktables.NEIGHBOUR_CONTEXT, tunnel)
+    leftovers = self.table_writer.GetLeftoverEntries(
+      networktables.NEIGHBOUR_CONTEXT, tunnel)
+    changes = networktables.ComputeNetworkTableChanges(table, desired,
+                                                       prune=True)
+    now = time.time()
+    min_timestamp = now - STALE_ENTRY_GRACE_PERIOD
+    old_unwanted = self._unwanted.get(tunnel, {})
+    unwanted = {}
+    stale = []
+    for (ip_address, dest_address) in changes:
+      # Entries we want with another destination are left to the repairs,
+      # and those we didn't write aren't ours to remove
+      if dest_address is not None or ip_address not in leftovers:
+        continue
+      (dumps, timestamp) = old_unwanted.get(ip_address, (0, now))
+      dumps += 1
+      if (dumps >= STALE_ENTRY_GRACE_GENERATIONS and
+          timestamp <= min_timestamp):
+        stale.append(ip_address)
+      else:
+        unwanted[ip_address] = (dumps, timestamp)
+    self._unwanted[tunnel] = unwanted
+    if not stale:
+      return
+
+    logging.info("Removing %d leftover neighbour entries from %s",
+                 len(stale), tunnel)
+    for ip_address in stale:
+      self.table_writer.RemoveEntry(ip_address,
+                                    networktables.NEIGHBOUR_CONTEXT, tunnel)
+
 
 class NLDConfdCallback(object):
   """NLD callback for confd queries.
 
   """
   def __init__(self, cluster_name, nld_config, peer_manager,
-               instance_node_map):
+               instance_node_map, table_writer, update_fn=None,
+               negative_cache=None, state_fn=None, reconciler=None):
+    """Constructor for NLDConfdCallback
+
+    @type update_fn: callable
+    @param update_fn: function called with an update name (one of the
+        UPDATE_* constants) and whether its reply brought any change
+    @type negative_cache: L{NegativeLookupCache}
+    @param negative_cache: cache of the unknown instances, invalidated when
+        the config serial changes
+    @type state_fn: callable
+    @param state_fn: function called when the state returned by
+        L{GetState} changes
+    @type reconciler: L{KernelTableReconciler}
+    @param reconciler: reconciler told about the complete link refreshes
+
+    """
     self.dispatch_table = {
       gnt_constants.CONFD_REQ_NODE_PIP_LIST:
         self.UpdateNodeIPList,
@@ -75,10 +589,112 @@ class NLDConfdCallback(object):
     self.cluster_config = nld_config.clusters[cluster_name]
     self.peer_manager = peer_manager
     self.peer_manager.RegisterPeerSet(cluster_name)
+    self.cached_node_list = None
     self.cached_mc_list = None
     self.cached_instance_node_map = instance_node_map
     self.cached_master_ip = None
     self.cached_master_node_ip = None
+    self.table_writer = table_writer
+    self.update_fn = update_fn
+    self.negative_cache = negative_cache
+    self.state_fn = state_fn
+    self.reconciler = reconciler
+    if reconciler is not None:
+      reconciler.RegisterCluster(cluster_name)
+    # link -> number of instance list replies received
+    self._generations = {}
+    # link -> {instance ip: (generation, timestamp) of the first reply
+    # missing it}, for the cached instances missing from the last reply only,
+    # so that it's small in the steady state
+    self._missing = {}
+    # link -> config serial the instance map was last fetched at
+    self._link_serials = {}
+    # link -> IPs which couldn't be mapped at that serial
+    self._link_retry = {}
+    # link -> L{_MappingFetch} in progress
+    self._mapping_fetches = {}
+    # link -> IPs dropped from the cache by L{ForgetInstance}, whose kernel
+    # entry is still there until they're resolved again
+    self._forgotten = {}
+
+  def _LinkRefreshed(self, link):
+    if self.reconciler is not None:
+      self.reconciler.LinkRefreshed(self.cluster_name, link)
+
+  def _ReportUpdate(self, name, changed):
+    if self.update_fn is not None:
+      self.update_fn(name, changed)
+
+  def _StateChanged(self):
+    if self.state_fn is not None:
+      self.state_fn()
+
+  def GetState(self):
+    """Return the cached state, to be saved in a snapshot.
+
+    The instance maps are not copied, so the state must be used right away.
+
+    @rtype: dict
+    @return: see L{snapshot}
+
+    """
+    master = None
+    if (self.cached_master_ip is not None and
+        self.cached_master_node_ip is not None):
+      master = (self.cached_master_ip, self.cached_master_node_ip)
+    links = {}
+    for (link, link_map) in self.cached_instance_node_map.iteritems():
+      links[link] = link_map
+    return {
+      "links": links,
+      "master": master,
+      "mcs": self.cached_mc_list,
+      }
+
+  def LoadState(self, state, client):
+    """Restore the state saved in a snapshot.
+
+    The saved entries are written to the kernel tables again, and are then
+    reconciled with confd by the regular updates: the instance map is fully
+    fetched at the first refresh, and instances which disappeared get swept
+    like any other stale entry.
+
+    @type state: dict
+    @param state: see L{snapshot}
+    @type client: L{confd_peers.LatencyAwareConfdClient}
+    @param client: confd client, whose peers are set to the saved master
+        candidates
+
+    """
+    for (link, saved_map) in state["links"].iteritems():
+      if link not in self.nld_config.tables_tunnels:
+        continue
+      tunnel = self.nld_config.tables_tunnels[link]
+      link_map = self.cached_instance_node_map.setdefault(
+        link, instancemap.InstanceNodeMap())
+      for (instance, node) in saved_map.iteritems():
+        queued = self.table_writer.UpdateEntry(
+          instance, node, networktables.NEIGHBOUR_CONTEXT, tunnel,
+          callback=self._InstanceEntryWritten)
+        if queued:
+          link_map[instance] = node
+      logging.info("Restored %d instance entries [cluster: %s] [link: %s]",
+                   len(link_map), self.cluster_name, link)
+
+    if state["master"] is not None:
+      (master_ip, master_node_ip) = state["master"]
+      queued = self.table_writer.UpdateEntry(
+        master_ip, master_node_ip,
+        networktables.NEIGHBOUR_CONTEXT,
+        self.cluster_config['master_neighbour_interface'],
+        callback=self._MasterEntryWritten)
+      if queued:
+        self.cached_master_ip = master_ip
+        self.cached_master_node_ip = master_node_ip
+
+    if state["mcs"]:
+      self.cached_mc_list = state["mcs"]
+      client.UpdatePeerList(state["mcs"])
 
   def UpdateNodeIPList(self, up):
     """Update dynamic iptables rules from the node list
@@ -86,6 +702,9 @@ class NLDConfdCallback(object):
     """
     logging.debug("Received node IP list reply [cluster: %s]",
                   self.cluster_name)
+    self._ReportUpdate(UPDATE_NODES,
+                       up.server_reply.answer != self.cached_node_list)
+    self.cached_node_list = up.server_reply.answer
     self.peer_manager.UpdatePeerSetNodes(self.cluster_name,
                                          up.server_reply.answer)
 
@@ -96,8 +715,11 @@ class NLDConfdCallback(object):
     logging.debug("Received master candidate IP list reply [cluster: %s]",
                   self.cluster_name)
     if up.server_reply.answer == self.cached_mc_list:
+      self._ReportUpdate(UPDATE_MCS, False)
       return
+    self._ReportUpdate(UPDATE_MCS, True)
     self.cached_mc_list = up.server_reply.answer
+    self._StateChanged()
     mc_list = up.server_reply.answer
     logging.debug("Updating confd peers [cluster: %s]: %s",
                   self.cluster_name, mc_list)
@@ -105,58 +727,281 @@ class NLDConfdCallback(object):
     if self.cluster_config["mc_list_update"]:
       utils.WriteFile(self.cluster_config["mc_list_file"],
                       data="%s\n" % "\n".join(mc_list))
+    # The new master candidates may have missed config updates the old ones
+    # saw, so the serials are not trusted anymore
+    self.InvalidateSerials()
+
+  def InvalidateSerials(self):
+    """Forget the config serials, forcing a full refetch of the instance map.
+
+    """
+    self._link_serials = {}
+    self._link_retry = {}
 
   def UpdateInstanceIPList(self, up):
     """Update the instances list
 
+    If the cluster config didn't change since the instance map of the link
+    was last fetched only the IPs which couldn't be mapped then are queried,
+    otherwise the whole list is.
+
     """
-    logging.debug("Received instance IP list reply [cluster: %s]."
-                  " Sending mapping query.", self.cluster_name)
     link = up.orig_request.query
     iplist = up.server_reply.answer
+    serial = up.server_reply.serial
+    cycle = up.extra_args
 
-    mapping_query = {
-      gnt_constants.CONFD_REQQ_IPLIST: iplist,
-      gnt_constants.CONFD_REQQ_LINK: link,
-      }
+    self._MarkInstances(link, iplist)
+    self._SweepStaleInstances(link)
 
-    req = confd.client.ConfdClientRequest(
-      type=gnt_constants.CONFD_REQ_NODE_PIP_BY_INSTANCE_IP,
-      query=mapping_query,
-      )
-    up.client.SendRequest(req, args=link)
+    if serial is not None and self._link_serials.get(link, None) == serial:
+      retry = self._link_retry.get(link, set())
+      query_list = [instance for instance in iplist if instance in retry]
+      if not query_list:
+        logging.debug("Received instance IP list reply [cluster: %s]."
+                      " Config serial %s unchanged, skipping mapping query.",
+                      self.cluster_name, serial)
+        self._LinkRefreshed(link)
+        if cycle is not None:
+          cycle.CompleteLink(link, up.salt)
+        return
+    else:
+      query_list = iplist
+      if cycle is not None:
+        cycle.changed = True
+
+    chunks = ChunkInstances(query_list)
+    logging.debug("Received instance IP list reply [cluster: %s]."
+                  " Sending %d mapping queries for %d instances.",
+                  self.cluster_name, len(chunks), len(query_list))
+    # A fetch still in progress for the link is superseded; its replies are
+    # still applied, but it's not tracked anymore
+    fetch = _MappingFetch(link, serial, chunks, cycle, up.client)
+    self._mapping_fetches[link] = fetch
+    if cycle is not None:
+      cycle.SetRequest(link, fetch)
+    self._SendMappingQueries(fetch)
+
+  def _SendMappingQueries(self, fetch):
+    """Send the next chunks of a fetch, up to the pipeline depth.
+
+    """
+    depth = self.cluster_config["mapping_pipeline_depth"]
+    while fetch.chunks and len(fetch.outstanding) < depth:
+      chunk = fetch.chunks.pop(0)
+      mapping_query = {
+        gnt_constants.CONFD_REQQ_IPLIST: chunk,
+        gnt_constants.CONFD_REQQ_LINK: fetch.link,
+        }
+      req = confd.client.ConfdClientRequest(
+        type=gnt_constants.CONFD_REQ_NODE_PIP_BY_INSTANCE_IP,
+        query=mapping_query,
+        )
+      fetch.outstanding[req.rsalt] = chunk
+      fetch.client.SendRequest(req, args=fetch)
+
+  def _MappingQueryDone(self, fetch, rsalt, failed):
+    """Account for a completed (or expired) mapping query.
+
+    @type failed: list
+    @param failed: IPs of the query which couldn't be mapped
+
+    """
+    if rsalt not in fetch.outstanding:
+      return
+    del fetch.outstanding[rsalt]
+    fetch.failed.update(failed)
+    if self._mapping_fetches.get(fetch.link, None) is not fetch:
+      return
+
+    self._SendMappingQueries(fetch)
+    if fetch.outstanding:
+      return
+
+    link = fetch.link
+    del self._mapping_fetches[link]
+    if fetch.serial is None:
+      self._link_serials.pop(link, None)
+      self._link_retry.pop(link, None)
+    else:
+      self._link_serials[link] = fetch.serial
+      self._link_retry[link] = fetch.failed
+    if fetch.failed:
+      logging.warning("Could not map %d instances [cluster: %s] [link: %s]",
+                      len(fetch.failed), self.cluster_name, link)
+    else:
+      self._LinkRefreshed(link)
+    if fetch.cycle is not None:
+      fetch.cycle.CompleteLink(link, fetch, failed=bool(fetch.failed))
+
+  def _MarkInstances(self, link, iplist):
+    """Start a new generation for a link, noting the instances it lacks.
+
+    Only the cached instances missing from the instance list are tracked.
+
+    """
+    generation = self._generations.get(link, 0) + 1
+    self._generations[link] = generation
+    mark = (generation, time.time())
+    present = frozenset(iplist)
+    old_missing = self._missing.get(link, {})
+    missing = {}
+    for instances in (self.cached_instance_node_map.get(link, {}),
+                      self._forgotten.get(link, set())):
+      for instance in instances:
+        if instance not in present:
+          missing[instance] = old_missing.get(instance, mark)
+    self._missing[link] = missing
+
+  def _SweepStaleInstances(self, link):
+    """Remove the entries not seen for a while in the instance list of a link.
+
+    """
+    generation = self._generations[link]
+    link_missing = self._missing[link]
+    link_map = self.cached_instance_node_map.get(link, {})
+    min_generation = generation - STALE_ENTRY_GRACE_GENERATIONS + 1
+    min_timestamp = time.time() - STALE_ENTRY_GRACE_PERIOD
+
+    stale = []
+    for (instance, (missing_generation, missing_timestamp)) in \
+        link_missing.items():
+      if (missing_generation <= min_generation and
+          missing_timestamp <= min_timestamp):
+        del link_missing[instance]
+        stale.append(instance)
+    if not stale:
+      return
+
+    logging.info("Removing %d stale instance entries [cluster: %s]"
+                 " [link: %s]", len(stale), self.cluster_name, link)
+    tunnel = self.nld_config.tables_tunnels[link]
+    for instance in stale:
+      if instance in link_map:
+        del link_map[instance]
+      self._forgotten.get(link, set()).discard(instance)
+      self.table_writer.RemoveEntry(instance,
+                                    networktables.NEIGHBOUR_CONTEXT,
+                                    tunnel)
+    self._StateChanged()
 
   def UpdateInstanceNodeMapping(self, up):
     """Update the instances mapping
 
+    Each reply covers a chunk of the instance list, and is applied as soon
+    as it arrives.
+
     """
     logging.debug("Received instance node mapping reply [cluster: %s]",
                   self.cluster_name)
     instances = up.orig_request.query[gnt_constants.CONFD_REQQ_IPLIST]
     link = up.orig_request.query[gnt_constants.CONFD_REQQ_LINK]
     replies = up.server_reply.answer
+    failed = []
+    changed = False
+    # Lookups are sent to all clusters, and usually fail on most of them
+    if isinstance(up.extra_args, InstanceLookup):
+      log_error = logging.debug
+    else:
+      log_error = logging.warning
 
     for instance, reply in zip(instances, replies):
       status, node = reply
       if status != gnt_constants.CONFD_REPL_STATUS_OK:
-        logging.warning("Error %s retrieving node for instance %s: %s"
-                        " [cluster: %s]",
-                        status, instance, node, self.cluster_name)
+        log_error("Error %s retrieving node for instance %s: %s"
+                  " [cluster: %s]",
+                  status, instance, node, self.cluster_name)
+        failed.append(instance)
         continue
       if not node:
         logging.warning("Empty answer retrieving node for instance %s"
                         " [cluster: %s]",
                         instance, self.cluster_name)
+        failed.append(instance)
         continue
       if link not in self.cached_instance_node_map:
-        self.cached_instance_node_map[link] = {}
-      if self.cached_instance_node_map[link].get(instance, None) == node:
+        self.cached_instance_node_map[link] = instancemap.InstanceNodeMap()
+      link_map = self.cached_instance_node_map[link]
+      if link_map.get(instance, None) == node:
         continue
-      self.cached_instance_node_map[link][instance] = node
       tunnel = self.nld_config.tables_tunnels[link]
-      networktables.UpdateNetworkEntry(instance, node,
-                                       networktables.NEIGHBOUR_CONTEXT,
-                                       tunnel)
+      queued = self.table_writer.UpdateEntry(
+        instance, node, networktables.NEIGHBOUR_CONTEXT, tunnel,
+        callback=self._InstanceEntryWritten)
+      if queued:
+        link_map[instance] = node
+        self._forgotten.get(link, set()).discard(instance)
+        changed = True
+      else:
+        failed.append(instance)
+
+    if changed:
+      self._StateChanged()
+
+    if isinstance(up.extra_args, _MappingFetch):
+      self._MappingQueryDone(up.extra_args, up.salt, failed)
+    elif isinstance(up.extra_args, InstanceLookup):
+      found = False
+      if replies:
+        (status, node) = replies[0]
+        found = status == gnt_constants.CONFD_REPL_STATUS_OK and bool(node)
+      if not found:
+        self._RemoveForgottenInstance(link, up.extra_args.ip)
+      up.extra_args.Complete(up.salt, False, found=found)
+
+  def ForgetInstance(self, link, instance):
+    """Drop an instance from the cache, so that its next lookup rewrites it.
+
+    The kernel entry is kept until the lookup completes: it is rewritten if
+    confd still knows the instance, and removed otherwise. If the lookup
+    gets no answer, the entry is left to the stale entry sweep.
+
+    @type link: string
+    @param link: link of the instance
+    @type instance: string
+    @param instance: instance IP address
+
+    """
+    link_map = self.cached_instance_node_map.get(link, None)
+    if link_map is not None and instance in link_map:
+      del link_map[instance]
+      self._forgotten.setdefault(link, set()).add(instance)
+      self._StateChanged()
+
+  def _RemoveForgottenInstance(self, link, instance):
+    """Remove the kernel entry of a forgotten instance confd doesn't know.
+
+    """
+    forgotten = self._forgotten.get(link, set())
+    if instance not in forgotten:
+      return
+    forgotten.discard(instance)
+    logging.info("Removing the entry of unknown instance %s [cluster: %s]"
+                 " [link: %s]", instance, self.cluster_name, link)
+    self._missing.get(link, {}).pop(instance, None)
+    self.table_writer.RemoveEntry(instance, networktables.NEIGHBOUR_CONTEXT,
+                                  self.nld_config.tables_tunnels[link])
+
+  def _InstanceEntryWritten(self, instance, node, error):
+    """Table writer callback for instance entries.
+
+    On failure the entry is dropped from the cache, and marked to be fetched
+    again, so that it gets written again at the next update.
+
+    """
+    if error is None:
+      return
+    logging.warning("Failed to route instance %s to node %s: %s"
+                    " [cluster: %s]", instance, node, error,
+                    self.cluster_name)
+    for (link, link_map) in self.cached_instance_node_map.items():
+      if link_map.get(instance, None) == node:
+        del link_map[instance]
+        self._StateChanged()
+        if link in self._mapping_fetches:
+          self._mapping_fetches[link].failed.add(instance)
+        elif link in self._link_retry:
+          self._link_retry[link].add(instance)
 
   def UpdateMasterNodeIP(self, up):
     """Update the IP address of the master node
@@ -183,11 +1028,45 @@ class NLDConfdCallback(object):
       master_route_changed = True
       self.cached_master_node_ip = master_node_ip
 
+    self._ReportUpdate(UPDATE_MASTER, master_route_changed)
     if master_route_changed:
-      networktables.UpdateNetworkEntry(
+      queued = self.table_writer.UpdateEntry(
         master_ip, master_node_ip,
         networktables.NEIGHBOUR_CONTEXT,
-        self.cluster_config['master_neighbour_interface'])
+        self.cluster_config['master_neighbour_interface'],
+        callback=self._MasterEntryWritten)
+      if not queued:
+        self.cached_master_node_ip = None
+      self._StateChanged()
+
+  def _MasterEntryWritten(self, master_ip, master_node_ip, error):
+    """Table writer callback for the master IP entry.
+
+    """
+    if error is None:
+      return
+    logging.warning("Failed to route master IP %s to node %s: %s"
+                    " [cluster: %s]", master_ip, master_node_ip, error,
+                    self.cluster_name)
+    if self.cached_master_node_ip == master_node_ip:
+      self.cached_master_node_ip = None
+      self._StateChanged()
+
+  def _FailRefreshRequest(self, up):
+    """Account for a failed instance map request.
+
+    """
+    if up.extra_args is None:
+      return
+    rtype = up.orig_request.type
+    if rtype == gnt_constants.CONFD_REQ_INSTANCES_IPS_LIST:
+      up.extra_args.CompleteLink(up.orig_request.query, up.salt, failed=True)
+    elif isinstance(up.extra_args, InstanceLookup):
+      up.extra_args.Complete(up.salt, True)
+    elif rtype == gnt_constants.CONFD_REQ_NODE_PIP_BY_INSTANCE_IP:
+      self._MappingQueryDone(up.extra_args, up.salt,
+                             up.orig_request.query[
+                               gnt_constants.CONFD_REQQ_IPLIST])
 
   def __call__(self, up):
     """NLD confd callback.
@@ -196,20 +1075,29 @@ class NLDConfdCallback(object):
     @param up: upper callback
 
     """
-    if up.type == confd.client.UPCALL_REPLY:
+    if up.type == confd.client.UPCALL_EXPIRE:
+      self._FailRefreshRequest(up)
+
+    elif up.type == confd.client.UPCALL_REPLY:
       if up.server_reply.status != gnt_constants.CONFD_REPL_STATUS_OK:
         logging.warning("Received error '%s' to confd request %s"
                         " [cluster: %s]",
                         up.server_reply.answer, up.orig_request,
                         self.cluster_name)
+        self._FailRefreshRequest(up)
         return
 
+      serial = up.server_reply.serial
+      if self.negative_cache is not None and serial is not None:
+        self.negative_cache.SetSerial(serial)
+
       rtype = up.orig_request.type
       try:
         dispatcher = self.dispatch_table[rtype]
       except KeyError, err: # pylint: disable-msg=W0612
         logging.warning("Unhandled confd response type: %s [cluster: %s]",
                         rtype, self.cluster_name)
+        return
       dispatcher(up)
 
 
@@ -218,7 +1106,8 @@ class NLDPeriodicUpdater(object):
 
   """
   def __init__(self, cluster_name, mainloop, nld_config,
-               hmac_key, mc_list, peer_manager, instance_node_map):
+               hmac_key, mc_list, peer_manager, instance_node_map,
+               table_writer, startup_delay=0, state_fn=None, reconciler=None):
     """Constructor for NLDPeriodicUpdater
 
     @type cluster_name: string
@@ -234,64 +1123,271 @@ class NLDPeriodicUpdater(object):
     @type peer_manager: L{server.PeerSetManager}
     @param peer_manager: ganeti-nld peer manager
     @type instance_node_map: dictionary
-    @param instance_node_map: an instance->node map
+    @param instance_node_map: link to L{instancemap.InstanceNodeMap} mapping,
+        filled in by the updater
+    @type table_writer: L{table_writer.TableWriter}
+    @param table_writer: writer for the neighbour table entries
+    @type startup_delay: float
+    @param startup_delay: seconds to wait before the first updates, used to
+        stagger the clusters
+    @type state_fn: callable
+    @param state_fn: function called when the state returned by
+        L{GetState} changes
+    @type reconciler: L{KernelTableReconciler}
+    @param reconciler: reconciler of the tunnel neighbour tables, shared by
+        all the clusters
 
     """
     self.cluster_name = cluster_name
     self.mainloop = mainloop
     self.nld_config = nld_config
+    self.negative_cache = NegativeLookupCache()
     my_callback = NLDConfdCallback(cluster_name,
                                    nld_config,
                                    peer_manager,
-                                   instance_node_map)
+                                   instance_node_map,
+                                   table_writer,
+                                   update_fn=self._UpdateDone,
+                                   negative_cache=self.negative_cache,
+                                   state_fn=state_fn,
+                                   reconciler=reconciler)
+    self._confd_callback = my_callback
     callback = confd.client.ConfdFilterCallback(my_callback, logger=logging)
-    self.confd_client = confd.client.ConfdClient(hmac_key, mc_list,
-                                                 callback, logger=logging)
-
-    self.node_timer_handle = None
-    self.mc_timer_handle = None
-    self.instance_timer_handle = None
-    self.master_timer_handle = None
-    self._EnableTimers(immediate_schedule=True)
-
-  def _EnableTimers(self, immediate_schedule=False):
-    """Schedule the update events on the main loop.
-
-    @type immediate_schedule: boolean
-    @param immediate_schedule: If set to True, all unscheduled events get
-        scheduled with no delay.
-
-    """
-    timeout_update_nodes = NODE_LIST_UPDATE_TIMEOUT
-    timeout_update_mcs = MC_LIST_UPDATE_TIMEOUT
-    timeout_update_instances = INSTANCE_MAP_UPDATE_TIMEOUT
-    timeout_update_master = MASTER_UPDATE_TIMEOUT
-
-    if immediate_schedule:
-      timeout_update_nodes = 0
-      timeout_update_mcs = 0
-      timeout_update_instances = 0
-      timeout_update_master = 0
-
-    if self.node_timer_handle is None:
-      self.node_timer_handle = \
-        self.mainloop.scheduler.enter(timeout_update_nodes,
-                                      1, self.UpdateNodes, [])
-
-    if self.mc_timer_handle is None:
-      self.mc_timer_handle = \
-        self.mainloop.scheduler.enter(timeout_update_mcs,
-                                      1, self.UpdateMCs, [])
-
-    if self.instance_timer_handle is None:
-      self.instance_timer_handle = \
-        self.mainloop.scheduler.enter(timeout_update_instances,
-                                      1, self.UpdateInstances, [])
-
-    if self.master_timer_handle is None:
-      self.master_timer_handle = \
-        self.mainloop.scheduler.enter(timeout_update_master,
-                                      1, self.UpdateMaster, [])
+    self.confd_client = \
+      confd_peers.LatencyAwareConfdClient(hmac_key, mc_list, callback,
+                                          mainloop.scheduler)
+
+    cluster_config = nld_config.clusters[cluster_name]
+    min_interval = cluster_config["update_min_interval"]
+    max_interval = cluster_config["update_max_interval"]
+    self._intervals = {
+      UPDATE_NODES: AdaptiveInterval(NODE_LIST_UPDATE_TIMEOUT,
+                                     min_interval, max_interval),
+      UPDATE_MCS: AdaptiveInterval(MC_LIST_UPDATE_TIMEOUT,
+                                   min_interval, max_interval),
+      UPDATE_INSTANCES: AdaptiveInterval(INSTANCE_MAP_UPDATE_TIMEOUT,
+                                         min_interval, max_interval),
+      UPDATE_MASTER: AdaptiveInterval(MASTER_UPDATE_TIMEOUT,
+                                      min_interval, max_interval),
+      }
+    self._update_fns = {
+      UPDATE_NODES: self.UpdateNodes,
+      UPDATE_MCS: self.UpdateMCs,
+      UPDATE_INSTANCES: self.UpdateInstances,
+      UPDATE_MASTER: self.UpdateMaster,
+      }
+    # update name -> scheduler event
+    self._timer_handles = {}
+    self._instance_cycle = None
+    self._instance_cycle_timer_handle = None
+    self._last_instance_refresh = None
+    self._queued_refresh = False
+    self._queued_refresh_handle = None
+    # (link, instance ip) -> L{InstanceLookup} in flight
+    self._lookups = {}
+
+    for name in self._update_fns:
+      self._ScheduleUpdate(name,
+                           startup_delay + random.uniform(0, STARTUP_JITTER))
+
+  def GetState(self):
+    """Return the cluster state, to be saved in a snapshot.
+
+    """
+    return self._confd_callback.GetState()
+
+  def LoadState(self, state):
+    """Restore the cluster state saved in a snapshot.
+
+    """
+    self._confd_callback.LoadState(state, self.confd_client)
+
+  def GetPeerStats(self):
+    """Return the reply statistics of the master candidates.
+
+    @rtype: dict
+    @return: see L{confd_peers.LatencyAwareConfdClient.GetPeerStats}
+
+    """
+    return self.confd_client.GetPeerStats()
+
+  def GetIntervals(self):
+    """Return the current polling intervals.
+
+    @rtype: dict
+    @return: update name to interval (seconds) mapping
+
+    """
+    intervals = {}
+    for (name, interval) in self._intervals.iteritems():
+      intervals[name] = interval.GetInterval()
+    return intervals
+
+  def _ScheduleUpdate(self, name, delay=None):
+    """Schedule an update on the main loop, unless it's already scheduled.
+
+    @type name: string
+    @param name: one of the UPDATE_* constants
+    @type delay: float
+    @param delay: seconds until the update, by default the current interval
+        of the update plus jitter
+
+    """
+    if name in self._timer_handles:
+      return
+    if delay is None:
+      delay = self._intervals[name].GetDelay()
+    self._timer_handles[name] = \
+      self.mainloop.scheduler.enter(delay, 1, self._TimerExpired, [name])
+
+  def _CancelUpdate(self, name):
+    handle = self._timer_handles.pop(name, None)
+    if handle is not None:
+      self.mainloop.scheduler.cancel(handle)
+
+  def _TimerExpired(self, name):
+    del self._timer_handles[name]
+    # The next instance map refresh is only scheduled once the current one is
+    # over
+    if name != UPDATE_INSTANCES:
+      self._ScheduleUpdate(name)
+    self._update_fns[name]()
+
+  def _UpdateDone(self, name, changed):
+    """Adapt the polling interval of an update to its outcome.
+
+    """
+    interval = self._intervals[name]
+    if changed:
+      interval.Reset()
+    else:
+      interval.Backoff()
+    logging.debug("Polling interval for %s is now %s seconds [cluster: %s]",
+                  name, interval.GetInterval(), self.cluster_name)
+
+  def ReportMisroute(self):
+    """Refresh the instance map quickly after a misrouted packet.
+
+    """
+    self._intervals[UPDATE_INSTANCES].Tighten()
+    self.TriggerInstanceRefresh()
+
+  def LookupInstance(self, ip, links=None):
+    """Look up the node of a single instance, and route it.
+
+    This is much faster than refreshing the whole instance map when we see
+    traffic for an instance we don't know about, or route wrongly. A lookup
+    already in flight for the same IP is shared, and the links where confd
+    recently reported the IP as unknown are skipped. If the lookup gets no
+    answer an instance map refresh is triggered instead.
+
+    @type ip: string
+    @param ip: instance IP address
+    @type links: list
+    @param links: links to look the instance up on, instead of all of them
+
+    """
+    if links is None:
+      links = self.nld_config.tables_tunnels.keys()
+    for link in links:
+      key = (link, ip)
+      if key in self._lookups or self.negative_cache.Contains(key):
+        continue
+      logging.debug("Looking up instance %s [cluster: %s] [link: %s]",
+                    ip, self.cluster_name, link)
+      lookup = InstanceLookup(link, ip, self._InstanceLookupDone)
+      query = {
+        gnt_constants.CONFD_REQQ_IPLIST: [ip],
+        gnt_constants.CONFD_REQQ_LINK: link,
+        }
+      req = confd.client.ConfdClientRequest(
+        type=gnt_constants.CONFD_REQ_NODE_PIP_BY_INSTANCE_IP,
+        query=query)
+      lookup.rsalt = req.rsalt
+      self._lookups[key] = lookup
+      self.confd_client.SendRequest(req, args=lookup)
+
+  def InvalidateInstances(self, ips, link=None):
+    """Re-resolve instances another node reported as routed wrongly.
+
+    The cached entries of the instances are dropped, so that they're written
+    again even if confd still gives the same node.
+
+    @type ips: list
+    @param ips: instance IP addresses
+    @type link: string
+    @param link: link of the instances, or None if unknown
+
+    """
+    if link in self.nld_config.tables_tunnels:
+      links = [link]
+    else:
+      links = self.nld_config.tables_tunnels.keys()
+    for ip in ips:
+      logging.debug("Invalidating the route to instance %s [cluster: %s]",
+                    ip, self.cluster_name)
+      for link in links:
+        self.negative_cache.Remove((link, ip))
+        self._confd_callback.ForgetInstance(link, ip)
+      self.LookupInstance(ip, links=links)
+
+  def IsUnknownInstance(self, ip):
+    """Check whether confd recently reported an instance as unknown.
+
+    @type ip: string
+    @param ip: instance IP address
+    @rtype: boolean
+    @return: whether the IP is unknown on all the links of the cluster
+
+    """
+    for link in self.nld_config.tables_tunnels:
+      if not self.negative_cache.Lookup((link, ip)):
+        return False
+    return True
+
+  def _InstanceLookupDone(self, lookup):
+    """Instance lookup completion callback.
+
+    """
+    key = (lookup.link, lookup.ip)
+    if self._lookups.get(key, None) is lookup:
+      del self._lookups[key]
+    if not lookup.failed and not lookup.found:
+      self.negative_cache.Add(key)
+    if lookup.failed:
+      logging.debug("Lookup of instance %s failed, refreshing the instance"
+                    " map [cluster: %s]", lookup.ip, self.cluster_name)
+      self.TriggerInstanceRefresh()
+
+  def TriggerInstanceRefresh(self):
+    """Request an instance map refresh, coalescing it with the other ones.
+
+    The refresh is started right away if none was started in the last
+    L{INSTANCE_REFRESH_COALESCE_WINDOW} seconds; otherwise a single follow-up
+    refresh is queued, to run after the window, or after the refresh in
+    flight.
+
+    """
+    if self._instance_cycle is not None:
+      self._queued_refresh = True
+      return
+    if self._queued_refresh_handle is not None:
+      return
+
+    if self._last_instance_refresh is None:
+      wait = 0
+    else:
+      wait = (self._last_instance_refresh + INSTANCE_REFRESH_COALESCE_WINDOW -
+              time.time())
+    if wait <= 0:
+      self.UpdateInstances()
+    else:
+      self._queued_refresh_handle = \
+        self.mainloop.scheduler.enter(wait, 1, self._RunQueuedRefresh, [])
+
+  def _RunQueuedRefresh(self):
+    self._queued_refresh_handle = None
+    self.UpdateInstances()
 
   def UpdateNodes(self):
     """Periodically update the node list.
@@ -299,8 +1395,6 @@ class NLDPeriodicUpdater(object):
     The updated node list will be handled by the iptables module.
 
     """
-    self.node_timer_handle = None
-    self._EnableTimers()
     logging.debug("Sending node IP list request [cluster: %s]",
                   self.cluster_name)
     req = confd.client.ConfdClientRequest(
@@ -311,36 +1405,96 @@ class NLDPeriodicUpdater(object):
     """Periodically update the MC list.
 
     """
-    self.mc_timer_handle = None
-    self._EnableTimers()
     logging.debug("Sending master candidate IP list request [cluster: %s]",
                   self.cluster_name)
+    for (peer, stats) in sorted(self.GetPeerStats().items()):
+      logging.debug("Confd peer %s [cluster: %s]: rtt %s, loss %.2f,"
+                    " %d sent, %d replies", peer, self.cluster_name,
+                    stats["rtt"], stats["loss"], stats["sent"],
+                    stats["replies"])
+    intervals = self.GetIntervals()
+    logging.debug("Polling intervals [cluster: %s]: %s", self.cluster_name,
+                  ", ".join(["%s %ss" % (name, intervals[name])
+                             for name in sorted(intervals)]))
     req = confd.client.ConfdClientRequest(
       type=gnt_constants.CONFD_REQ_MC_PIP_LIST)
     self.confd_client.SendRequest(req)
 
   def UpdateInstances(self):
-    """Periodically update the instance list.
+    """Update the instance list of all links.
 
-    The updated instance ip list will be used to build an instance map.
+    The updated instance ip lists will be used to build an instance map. The
+    requests for all links are sent together, and tracked as one refresh
+    cycle; nothing is done if a cycle is already in progress.
 
     """
-    self.instance_timer_handle = None
-    self._EnableTimers()
-    logging.debug("Sending instance IP list request [cluster: %s]",
+    if self._instance_cycle is not None:
+      logging.debug("Instance map refresh already in progress [cluster: %s]",
+                    self.cluster_name)
+      return
+
+    self._CancelUpdate(UPDATE_INSTANCES)
+    if self._queued_refresh_handle is not None:
+      self.mainloop.scheduler.cancel(self._queued_refresh_handle)
+      self._queued_refresh_handle = None
+    self._queued_refresh = False
+    self._last_instance_refresh = time.time()
+
+    links = self.nld_config.tables_tunnels.keys()
+    cycle = InstanceRefreshCycle(links, self._InstanceCycleDone)
+    self._instance_cycle = cycle
+    self._instance_cycle_timer_handle = \
+      self.mainloop.scheduler.enter(INSTANCE_REFRESH_CYCLE_TIMEOUT,
+                                    1, self._ExpireInstanceCycle, [cycle])
+
+    stats = self.negative_cache.GetStats()
+    logging.debug("Negative lookup cache [cluster: %s]: %d entries,"
+                  " %d hits, %d misses", self.cluster_name, stats["size"],
+                  stats["hits"], stats["misses"])
+    logging.debug("Sending instance IP list requests [cluster: %s]",
                   self.cluster_name)
-    for link in self.nld_config.tables_tunnels:
+    for link in links:
       req = confd.client.ConfdClientRequest(
               type=gnt_constants.CONFD_REQ_INSTANCES_IPS_LIST,
               query=link)
-    self.confd_client.SendRequest(req)
+      cycle.SetRequest(link, req.rsalt)
+      self.confd_client.SendRequest(req, args=cycle)
+
+  def _ExpireInstanceCycle(self, cycle):
+    """Give up on the links which didn't complete an instance map refresh.
+
+    """
+    self._instance_cycle_timer_handle = None
+    if not cycle.finished:
+      cycle.Finish()
+
+  def _InstanceCycleDone(self, cycle):
+    """Instance map refresh cycle completion callback.
+
+    """
+    if cycle.failed_links:
+      # Failures tell us nothing about the rate of changes, so the interval
+      # is kept as it is, unless some other link changed
+      logging.warning("Instance map refresh failed for links %s"
+                      " [cluster: %s]", cycle.failed_links,
+                      self.cluster_name)
+      if cycle.changed:
+        self._UpdateDone(UPDATE_INSTANCES, True)
+    else:
+      self._UpdateDone(UPDATE_INSTANCES, cycle.changed)
+    if self._instance_cycle_timer_handle is not None:
+      self.mainloop.scheduler.cancel(self._instance_cycle_timer_handle)
+      self._instance_cycle_timer_handle = None
+    self._instance_cycle = None
+    self._ScheduleUpdate(UPDATE_INSTANCES)
+    if self._queued_refresh:
+      self._queued_refresh = False
+      self.TriggerInstanceRefresh()
 
   def UpdateMaster(self):
     """Periodically update the master node IP.
 
     """
-    self.master_timer_handle = None
-    self._EnableTimers()
     logging.debug("Sending master node IP request [cluster: %s]",
                   self.cluster_name)
     query = {
@@ -29,13 +29,17 @@
 # objects.py which doesn't explicitely initialise its members
 
 
+import collections
+import heapq
 import logging
 import time
 
 from ganeti_nbma import constants
 from ganeti_nbma import errors
+from ganeti_nbma import nld_wire
 from ganeti_nbma import objects
 
+from ganeti import constants as gnt_constants
 from ganeti import errors as gnt_errors
 from ganeti import objects as gnt_objects
 from ganeti import serializer
@@ -45,6 +49,13 @@ from ganeti import utils
 
 _FOURCC_LEN = 4
 
+# Estimated size of a signed route invalidation batch request without its
+# entries, and added by each IP address and each link in it. The query is
+# quoted twice, in the message and in its signed envelope.
+_BATCH_REQUEST_OVERHEAD = 1024
+_BATCH_IP_OVERHEAD = 8
+_BATCH_LINK_OVERHEAD = 32
+
 
 def PackMagic(payload):
   """Prepend the NLD magic fourcc to a payload.
@@ -68,104 +79,347 @@ def UnpackMagic(payload):
   return payload[_FOURCC_LEN:]
 
 
+def CheckTimestamp(salt, now=None):
+  """Check whether a request salt is a timestamp within the allowed skew.
+
+  @rtype: boolean
+
+  """
+  if now is None:
+    now = time.time()
+  try:
+    return abs(now - int(salt)) <= constants.NLD_MAX_CLOCK_SKEW
+  except (ValueError, TypeError):
+    return False
+
+
+class NLDEnvelope(gnt_objects.ConfigObject):
+  """A decoded and authenticated NLD datagram.
+
+  @type message: dict
+  @ivar message: the signed message
+  @type salt: string
+  @ivar salt: salt of the signature
+  @type cluster: string
+  @ivar cluster: cluster whose key signed the message
+  @type version: int
+  @ivar version: protocol version of the encoding
+
+  """
+  __slots__ = [
+    "message",
+    "salt",
+    "cluster",
+    "version",
+    ]
+
+
+def UnpackEnvelope(payload_in, cluster_keys, salt_fn):
+  """Decode and authenticate an NLD datagram.
+
+  The cheap checks come first, so that garbage and foreign traffic are
+  rejected quickly: the size, the magic fourcc, the key selector and the
+  salt are checked before the HMAC, and the message itself is only parsed
+  once the HMAC matches.
+
+  @type payload_in: string
+  @param payload_in: datagram, including the magic fourcc
+  @type cluster_keys: dict
+  @param cluster_keys: cluster name to hmac key mapping
+  @type salt_fn: callable
+  @param salt_fn: function returning whether a salt is acceptable
+  @rtype: L{NLDEnvelope}
+  @raise errors.NLDDecodeError: if the datagram is rejected
+
+  """
+  if len(payload_in) > gnt_constants.MAX_UDP_DATA_SIZE:
+    raise errors.NLDDecodeError("datagram too big (%d bytes)" %
+                                len(payload_in))
+  magic_number = payload_in[:_FOURCC_LEN]
+  if magic_number == constants.NLD_MAGIC_FOURCC_V2:
+    (message, salt, cluster) = nld_wire.UnpackDatagram(payload_in,
+                                                       cluster_keys, salt_fn)
+    return NLDEnvelope(message=message, salt=salt, cluster=cluster,
+                       version=constants.NLD_PROTOCOL_VERSION_2)
+  if magic_number != constants.NLD_MAGIC_FOURCC:
+    raise errors.NLDDecodeError("UDP payload contains an unknown fourcc")
+
+  payload = payload_in[_FOURCC_LEN:]
+  # The envelope is a JSON object; anything else is rejected without
+  # running the parser on it
+  if payload.lstrip()[:1] != "{":
+    raise errors.NLDDecodeError("invalid envelope")
+  try:
+    signed = serializer.LoadJson(payload)
+  except ValueError, err:
+    raise errors.NLDDecodeError("invalid envelope: %s" % err)
+  if not isinstance(signed, dict):
+    raise errors.NLDDecodeError("invalid envelope")
+  text = signed.get("msg", None)
+  salt = signed.get("salt", None)
+  hmac_sign = signed.get("hmac", None)
+  key_selector = signed.get("key_selector", None)
+  for field in (text, salt, hmac_sign, key_selector):
+    if not isinstance(field, basestring):
+      raise errors.NLDDecodeError("missing or invalid envelope field")
+
+  hmac_key = cluster_keys.get(key_selector, None)
+  if not hmac_key:
+    raise errors.NLDDecodeError("unknown key selector '%s'" % key_selector)
+  if not salt_fn(salt):
+    raise errors.NLDDecodeError("unexpected salt '%s'" % salt)
+  if not utils.VerifySha1Hmac(hmac_key, text, hmac_sign,
+                              salt=salt + key_selector):
+    raise errors.NLDDecodeError("invalid signature")
+
+  try:
+    message = serializer.LoadJson(text)
+  except ValueError, err:
+    raise errors.NLDDecodeError("invalid message: %s" % err)
+  if not isinstance(message, dict):
+    raise errors.NLDDecodeError("invalid message")
+
+  return NLDEnvelope(message=message, salt=salt, cluster=key_selector,
+                     version=constants.NLD_PROTOCOL_VERSION_1)
+
+
+class _ReplyCache(object):
+  """The replies recently sent for one cluster, by request rsalt.
+
+  A signed request is accepted as long as its timestamp is within the
+  allowed clock skew, so its reply is kept until then: a retransmitted or
+  replayed request gets the same reply, without being processed again.
+  When the cache is full the oldest replies are dropped first.
+
+  """
+  def __init__(self, max_size):
+    self._max_size = max_size
+    # rsalt -> (reply datagram, expiry time)
+    self._replies = {}
+    # (expiry time, rsalt), in insertion order
+    self._queue = collections.deque()
+
+  def _Expire(self, now):
+    # Expiry times only roughly follow the insertion order, so expired
+    # entries further in the queue are also checked in Get
+    while self._queue and (self._queue[0][0] < now or
+                           len(self._replies) > self._max_size):
+      (_, rsalt) = self._queue.popleft()
+      del self._replies[rsalt]
+
+  def Get(self, rsalt, now):
+    """Return the reply sent to a request, or None.
+
+    """
+    self._Expire(now)
+    (payload, expiry) = self._replies.get(rsalt, (None, None))
+    if payload is None or expiry < now:
+      return None
+    return payload
+
+  def Add(self, rsalt, payload, expiry, now):
+    """Remember the reply sent to a request, until the given time.
+
+    """
+    if rsalt in self._replies:
+      return
+    self._replies[rsalt] = (payload, expiry)
+    self._queue.append((expiry, rsalt))
+    self._Expire(now)
+
+
 class NLDRequestProcessor(object):
   """A processor for NLD requests.
 
   """
-  def __init__(self, cluster_keys, updaters):
+  def __init__(self, cluster_keys, updaters,
+               reply_cache_size=constants.NLD_REPLY_CACHE_SIZE):
     """Constructor for NLDRequestProcessor
 
+    @type reply_cache_size: int
+    @param reply_cache_size: maximum number of replies remembered per
+        cluster, to answer retransmitted requests
+
     """
     self.cluster_keys = cluster_keys
     self.updaters = updaters
+    self._reply_cache_size = reply_cache_size
+    # cluster name -> L{_ReplyCache}
+    self._reply_caches = {}
 
     self.dispatch_table = {
       constants.NLD_REQ_PING: self._Ping,
       constants.NLD_REQ_ROUTE_INVALIDATE: self._RouteInvalidate,
+      constants.NLD_REQ_ROUTE_INVALIDATE_BATCH: self._RouteInvalidateBatch,
       }
 
     assert \
       not constants.NLD_REQS.symmetric_difference(self.dispatch_table), \
       "dispatch_table is unaligned with NLD_REQS"
 
-  # pylint: disable-msg=R0201
-  def _Ping(self, query):
+  # pylint: disable-msg=R0201,W0613
+  def _Ping(self, query, cluster_name):
     if query is None:
       status = constants.NLD_REPL_STATUS_OK
-      answer = 'ok'
+      answer = {
+        constants.NLD_REPL_VERSIONS: sorted(constants.NLD_PROTOCOL_VERSIONS),
+        }
     else:
       status = constants.NLD_REPL_STATUS_ERROR
       answer = 'non-empty ping query'
 
     return status, answer
 
-  def _RouteInvalidate(self, query):
+  def _RouteInvalidate(self, query, cluster_name):
     if not query:
       logging.debug("missing body from route invalidation query")
       return constants.NLD_REPL_STATUS_ERROR, constants.NLD_ERROR_ARGUMENT
 
-    logging.debug("executing route invalidation query: [%s]", query)
-    # TODO: can we make it cluster-aware to avoid a mass-update like this?
-    for _, updater in self.updaters.iteritems():
-      updater.UpdateInstances()
+    logging.debug("executing route invalidation query: [%s] [cluster: %s]",
+                  query, cluster_name)
+    if not isinstance(query, dict):
+      # Older senders only pass a single IP, without its link: refresh the
+      # whole instance maps
+      for _, updater in self.updaters.iteritems():
+        updater.ReportMisroute()
+      return constants.NLD_REPL_STATUS_OK, 'done'
+
+    invalidation = self._ParseInvalidation(query)
+    if invalidation is None:
+      return constants.NLD_REPL_STATUS_ERROR, constants.NLD_ERROR_ARGUMENT
+    self._InvalidateRoutes([invalidation], cluster_name)
     answer = 'done'
     return constants.NLD_REPL_STATUS_OK, answer
 
-  def ExecQuery(self, payload, ip, port):
+  def _RouteInvalidateBatch(self, query, cluster_name):
+    if not query or not isinstance(query, list):
+      logging.debug("missing body from route invalidation batch query")
+      return constants.NLD_REPL_STATUS_ERROR, constants.NLD_ERROR_ARGUMENT
+
+    logging.debug("executing route invalidation batch query with %d entries"
+                  " [cluster: %s]", len(query), cluster_name)
+    invalidations = []
+    for entry in query:
+      invalidation = self._ParseInvalidation(entry)
+      if invalidation is None:
+        return constants.NLD_REPL_STATUS_ERROR, constants.NLD_ERROR_ARGUMENT
+      invalidations.append(invalidation)
+    self._InvalidateRoutes(invalidations, cluster_name)
+    answer = 'done'
+    return constants.NLD_REPL_STATUS_OK, answer
+
+  @staticmethod
+  def _ParseInvalidation(query):
+    """Extract the IP list and link from a route invalidation query.
+
+    @rtype: tuple
+    @return: (IP list, link or None), or None if the query is invalid
+
+    """
+    if not isinstance(query, dict):
+      logging.debug("invalid route invalidation query: %s", query)
+      return None
+    ips = query.get(constants.NLD_REQQ_IPLIST, None)
+    if not ips or not isinstance(ips, list):
+      logging.debug("missing IP list from route invalidation query")
+      return None
+    for ip in ips:
+      if not isinstance(ip, basestring):
+        logging.debug("invalid IP in route invalidation query: %s", ip)
+        return None
+    link = query.get(constants.NLD_REQQ_LINK, None)
+    if link is not None and not isinstance(link, basestring):
+      logging.debug("invalid link in route invalidation query: %s", link)
+      return None
+    return (ips, link)
+
+  def _InvalidateRoutes(self, invalidations, cluster_name):
+    """Re-resolve the instances of route invalidation queries.
+
+    """
+    # Endpoints are notified with the default cluster, and look the
+    # instances up in all their clusters
+    if cluster_name in self.updaters:
+      updaters = [self.updaters[cluster_name]]
+    else:
+      updaters = self.updaters.values()
+    for (ips, link) in invalidations:
+      for updater in updaters:
+        updater.InvalidateInstances(ips, link=link)
+
+  def ExecQuery(self, envelope, ip, port):
     """Process a single NLD request.
 
-    @type payload: string
-    @param payload: request raw data
+    @type envelope: L{NLDEnvelope}
+    @param envelope: decoded request
     @type ip: string
     @param ip: source ip address
     @param port: integer
     @type port: source port
 
+    Requests already answered (retransmitted or replayed ones) get the same
+    reply again, without being processed.
+
     """
     try:
-      cluster_name, request = self.ExtractRequest(payload)
+      cluster_name, request = self.ExtractRequest(envelope)
+      now = time.time()
+      cache = self._reply_caches.get(cluster_name, None)
+      if cache is None:
+        cache = self._reply_caches[cluster_name] = \
+          _ReplyCache(self._reply_cache_size)
+      if request.rsalt:
+        payload_out = cache.Get(request.rsalt, now)
+        if payload_out is not None:
+          logging.debug("Resending the reply to request %s from %s:%d",
+                        request.rsalt, ip, port)
+          return payload_out
       reply, rsalt = self.ProcessRequest(request)
-      payload_out = self.PackReply(reply, rsalt, cluster_name)
+      payload_out = self.PackReply(reply, rsalt, cluster_name,
+                                   version=envelope.version)
+      # The request is accepted until its timestamp is too old
+      cache.Add(rsalt, payload_out,
+                int(envelope.salt) + constants.NLD_MAX_CLOCK_SKEW, now)
       return payload_out
     except errors.NLDRequestError, err:
       logging.info('Ignoring broken query from %s:%d: %s', ip, port, err)
       return None
 
-  def ExtractRequest(self, payload):
-    """Extracts an NLDRequest object from a serialized hmac signed string.
+  def ExtractRequest(self, envelope):
+    """Extracts an NLDRequest object from a decoded datagram.
 
-    This function also performs signature/timestamp validation.
+    The signature was already checked by L{UnpackEnvelope}; this function
+    performs the timestamp validation.
 
     """
-    current_time = time.time()
-    logging.debug("Extracting request with size: %d", len(payload))
-    try:
-      (message, salt) = serializer.LoadSigned(payload,
-                                              key=self.cluster_keys.get)
-    except gnt_errors.SignatureError, err:
-      msg = "invalid signature: %s" % err
-      raise errors.NLDRequestError(msg)
-    try:
-      message_timestamp = int(salt)
-    except (ValueError, TypeError):
-      msg = "non-integer timestamp: %s" % salt
-      raise errors.NLDRequestError(msg)
-
-    skew = abs(current_time - message_timestamp)
-    if skew > constants.NLD_MAX_CLOCK_SKEW:
-      msg = "outside time range (skew: %d)" % skew
+    if not CheckTimestamp(envelope.salt):
+      msg = "invalid or outside time range timestamp: %s" % envelope.salt
       raise errors.NLDRequestError(msg)
 
+    message = envelope.message
     try:
       cluster_name = message["cluster"]
     except KeyError:
       raise errors.NLDRequestError("Cluster name is missing from NLD request")
+    if cluster_name != envelope.cluster:
+      msg = "request for cluster %s signed with the key of %s" % \
+            (cluster_name, envelope.cluster)
+      raise errors.NLDRequestError(msg)
 
     try:
       request = objects.NLDRequest.FromDict(message)
-    except AttributeError, err:
+    except (AttributeError, TypeError), err:
       raise errors.NLDRequestError('%s' % err)
 
+    # The fields are used as dict keys and formatted in messages, so their
+    # types are checked before anything else
+    for (name, value, types) in [("protocol", request.protocol, (int, long)),
+                                 ("type", request.type, (int, long)),
+                                 ("rsalt", request.rsalt,
+                                  (basestring, type(None)))]:
+      if not isinstance(value, types):
+        raise errors.NLDRequestError("invalid request %s: %r" % (name, value))
+
     return cluster_name, request
 
   def ProcessRequest(self, request):
@@ -177,12 +431,12 @@ class NLDRequestProcessor(object):
 
     """
     logging.debug("Processing request: %s", request)
-    if request.protocol != constants.NLD_PROTOCOL_VERSION:
-      msg = "wrong protocol version %d" % request.protocol
+    if request.protocol not in constants.NLD_PROTOCOL_VERSIONS:
+      msg = "wrong protocol version %s" % request.protocol
       raise errors.NLDRequestError(msg)
 
     if request.type not in constants.NLD_REQS:
-      msg = "wrong request type %d" % request.type
+      msg = "wrong request type %s" % request.type
       raise errors.NLDRequestError(msg)
 
     rsalt = request.rsalt
@@ -190,9 +444,10 @@ class NLDRequestProcessor(object):
       msg = "missing requested salt"
       raise errors.NLDRequestError(msg)
 
-    status, answer = self.dispatch_table[request.type](request.query)
+    status, answer = self.dispatch_table[request.type](request.query,
+                                                       request.cluster)
     reply = objects.NLDReply(
-      protocol=constants.NLD_PROTOCOL_VERSION,
+      protocol=request.protocol,
       is_request=False,
       status=status,
       answer=answer,
@@ -202,29 +457,69 @@ class NLDRequestProcessor(object):
 
     return (reply, rsalt)
 
-  def PackReply(self, reply, rsalt, cluster_name):
+  def PackReply(self, reply, rsalt, cluster_name,
+                version=constants.NLD_PROTOCOL_VERSION_1):
     """Serialize and sign the given reply, with salt rsalt
 
     @type reply: L{objects.NLDReply}
     @type rsalt: string
     @param cluster_name: name of the cluster
+    @type version: int
+    @param version: protocol version to encode the reply with, the one of
+        the request
+    @rtype: string
+    @return: the datagram, including the magic fourcc
 
     """
+    if version == constants.NLD_PROTOCOL_VERSION_2:
+      return nld_wire.PackReply(reply, rsalt, cluster_name,
+                                self.cluster_keys[cluster_name])
     message = reply.ToDict()
     message['cluster'] = cluster_name
-    return serializer.DumpSigned(
+    return PackMagic(serializer.DumpSigned(
       message,
       self.cluster_keys[cluster_name],
       salt=rsalt,
       key_selector=cluster_name
-      )
+      ))
+
+
+_TIMER_RETRY = "retry"
+_TIMER_EXPIRE = "expire"
+
+
+class _PendingRequest(object):
+  """An NLD request waiting for a reply.
+
+  """
+  def __init__(self, request, args, destination, version, payload,
+               dedup_key):
+    self.request = request
+    self.args = args
+    self.destination = destination
+    self.version = version
+    self.payload = payload
+    self.dedup_key = dedup_key
+    self.retries = 0
+    # (request, args) of the identical requests made meanwhile
+    self.duplicates = []
+
+  def GetRequests(self):
+    """Return the (request, args) pairs waiting for the reply.
+
+    """
+    return [(self.request, self.args)] + self.duplicates
 
 
 class NLDAsyncUDPServer(daemon.AsyncUDPSocket):
   """The NLD UDP server, suitable for use with asyncore.
 
   """
-  def __init__(self, bind_address, port, processor, callback, cluster_keys):
+  def __init__(self, bind_address, port, processor, callback, cluster_keys,
+               scheduler,
+               max_requests=constants.NLD_CLIENT_MAX_PENDING_REQUESTS,
+               max_retries=constants.NLD_CLIENT_MAX_RETRIES,
+               retry_rate=constants.NLD_CLIENT_RETRY_RATE):
     """Constructor for NLDAsyncUDPServer
 
     @type bind_address: string
@@ -235,6 +530,15 @@ class NLDAsyncUDPServer(daemon.AsyncUDPSocket):
     @param processor: NLDRequestProcessor to use to handle queries
     @param callback: NLDResponseCallback to use to handle responses
     @param cluster_keys: dictinary with the cluster hmac keys
+    @type scheduler: L{daemon.AsyncoreScheduler}
+    @param scheduler: scheduler used to retransmit and expire the requests
+    @type max_requests: int
+    @param max_requests: maximum number of requests waiting for a reply
+    @type max_retries: int
+    @param max_retries: maximum number of retransmissions of a request
+    @type retry_rate: int
+    @param retry_rate: maximum number of retransmissions per second, over
+        all the requests
 
     """
     daemon.AsyncUDPSocket.__init__(self)
@@ -244,93 +548,263 @@ class NLDAsyncUDPServer(daemon.AsyncUDPSocket):
     self.bind((bind_address, port))
     self._callback = callback
     self._cluster_keys = cluster_keys
+    self._scheduler = scheduler
+    self._max_requests = max_requests
+    self._max_retries = max_retries
+    self._retry_rate = retry_rate
+    self._retry_tokens = float(retry_rate)
+    self._retry_time = time.time()
+    # rsalt -> L{_PendingRequest}
     self._requests = {}
-    self._expire_requests = []
+    # number of requests waiting for a reply, including the duplicate ones
+    self._request_count = 0
+    # (destination, cluster, type, query) -> rsalt of the request sent
+    self._dedup = {}
+    # heap of (time, rsalt, action) timers; the timers of requests already
+    # answered are skipped when they reach the top
+    self._timers = []
+    self._timer_event = None
+    self._timer_time = None
+    # destination -> (protocol version, time of the last version probe)
+    self._peer_versions = {}
+    # rsalt of the version probes in flight -> destination
+    self._version_probes = {}
 
     logging.debug("listening on ('%s':%d)", bind_address, port)
 
   # this method is overriding the daemon.AsyncUDPSocket method
   def handle_datagram(self, payload_in, ip, port):
     try:
-      payload = UnpackMagic(payload_in)
-    except errors.NLDMagicError, err:
-      logging.debug(err)
+      envelope = UnpackEnvelope(payload_in, self._cluster_keys,
+                                self._CheckSalt)
+    except errors.NLDDecodeError, err:
+      logging.debug("Discarding datagram from %s:%d: %s", ip, port, err)
       return
 
-    signed_message = serializer.LoadJson(payload)
-    message = serializer.LoadJson(signed_message['msg'])
-
-    message_is_request = message.get('is_request', None)
+    message_is_request = envelope.message.get('is_request', None)
     if message_is_request is None:
       logging.error("Message request/response discriminator field is missing."
-                    " Message: [%s]", message)
+                    " Message: [%s]", envelope.message)
       return
 
     if message_is_request:
-      self.HandleRequest(payload, ip, port)
+      self.HandleRequest(envelope, ip, port)
     else:
-      self.HandleResponse(payload, ip, port)
+      self.HandleResponse(envelope, ip, port)
+
+  def _CheckSalt(self, salt):
+    """Check whether a salt belongs to a request or a reply we expect.
+
+    Requests are salted with their timestamp, and replies with the rsalt of
+    the request.
 
-  def HandleRequest(self, payload, ip, port):
-    answer =  self.processor.ExecQuery(payload, ip, port)
+    """
+    return salt in self._requests or CheckTimestamp(salt)
+
+  def HandleRequest(self, envelope, ip, port):
+    answer =  self.processor.ExecQuery(envelope, ip, port)
     if answer is not None:
       try:
-        self.enqueue_send(ip, port, PackMagic(answer))
+        self.enqueue_send(ip, port, answer)
       except gnt_errors.UdpDataSizeError:
         logging.error("Reply too big to fit in an udp packet.")
 
-  def _PackRequest(self, request, cluster_name, timestamp=None):
+  def _PackRequest(self, request, cluster_name, timestamp=None,
+                   version=constants.NLD_PROTOCOL_VERSION_1):
     """Prepare a request to be sent on the wire.
 
     This function puts a proper salt in an NLD request and adds the correct
-    magic number.
+    magic number. Requests which can't be encoded with the version 2 are
+    sent with the version 1.
+
+    @rtype: tuple
+    @return: (datagram, protocol version used)
 
     """
     if timestamp is None:
       timestamp = time.time()
+    key = self._cluster_keys[cluster_name]
+    if version == constants.NLD_PROTOCOL_VERSION_2:
+      req = nld_wire.PackRequest(request, cluster_name, key, timestamp)
+      if req is not None:
+        return (req, constants.NLD_PROTOCOL_VERSION_2)
+
     tstamp = '%d' % timestamp
-    req = serializer.DumpSignedJson(request.ToDict(),
-                                    self._cluster_keys[cluster_name],
-                                    tstamp,
+    message = request.ToDict()
+    message["protocol"] = constants.NLD_PROTOCOL_VERSION_1
+    req = serializer.DumpSignedJson(message, key, tstamp,
                                     key_selector=cluster_name)
-    return PackMagic(req)
+    return (PackMagic(req), constants.NLD_PROTOCOL_VERSION_1)
 
-  def _UnpackReply(self, payload):
-    (dict_answer, salt) = serializer.LoadSignedJson(payload,
-                                                    key=self._cluster_keys.get)
-    answer = objects.NLDReply.FromDict(dict_answer)
-    return answer, salt
+  def GetPeerVersion(self, cluster_name, destination):
+    """Return the protocol version to use with a peer.
 
-  def ExpireRequests(self):
-    """Delete all the expired requests.
+    Peers are assumed to only know the version 1 until they announce more
+    in their answer to a ping, which is sent when first talking to them and
+    again every L{constants.NLD_VERSION_PROBE_INTERVAL}.
 
     """
     now = time.time()
-    while self._expire_requests:
-      expire_time, rsalt = self._expire_requests[0]
-      if now >= expire_time:
-        self._expire_requests.pop(0)
-        (request, args) = self._requests[rsalt]
-        del self._requests[rsalt]
-        client_reply = NLDUpcallPayload(salt=rsalt,
-                                        type=UPCALL_EXPIRE,
-                                        orig_request=request,
-                                        extra_args=args,
-                                        client=self,
-                                        )
-        self._callback(client_reply)
-      else:
+    (version, probe_time) = \
+      self._peer_versions.get(destination,
+                              (constants.NLD_PROTOCOL_VERSION_1, None))
+    if (probe_time is None or
+        now - probe_time > constants.NLD_VERSION_PROBE_INTERVAL):
+      self._peer_versions[destination] = (version, now)
+      request = NLDClientRequest(type=constants.NLD_REQ_PING)
+      try:
+        # The probe may be merged with a ping already waiting for a reply
+        rsalt = self.SendRequest(request, cluster_name, destination)
+        self._version_probes[rsalt] = destination
+      except errors.NLDClientError, err:
+        logging.debug("Cannot probe the protocol version of %s: %s",
+                      destination, err)
+    return version
+
+  def _SetPeerVersion(self, destination, answer):
+    """Record the protocol version of a peer from its ping answer.
+
+    """
+    versions = [constants.NLD_PROTOCOL_VERSION_1]
+    if isinstance(answer, dict):
+      announced = answer.get(constants.NLD_REPL_VERSIONS, None)
+      if isinstance(announced, list):
+        versions.extend(constants.NLD_PROTOCOL_VERSIONS.intersection(announced))
+    version = max(versions)
+    (_, probe_time) = self._peer_versions.get(destination, (None, None))
+    self._peer_versions[destination] = (version, probe_time)
+    logging.debug("Using protocol version %d with %s", version, destination)
+
+  def _AddTimer(self, when, rsalt, action):
+    heapq.heappush(self._timers, (when, rsalt, action))
+    self._ScheduleTimers()
+
+  def _ScheduleTimers(self):
+    """Schedule the scheduler event for the first timer to fire.
+
+    """
+    while self._timers and self._timers[0][1] not in self._requests:
+      heapq.heappop(self._timers)
+    if not self._timers:
+      return
+    when = self._timers[0][0]
+    if self._timer_event is not None:
+      if self._timer_time <= when:
+        return
+      self._scheduler.cancel(self._timer_event)
+    self._timer_time = when
+    self._timer_event = self._scheduler.enter(max(0, when - time.time()), 1,
+                                              self._TimersExpired, [])
+
+  def _TimersExpired(self):
+    self._timer_event = None
+    self.RunTimers()
+
+  def _DropRequest(self, rsalt):
+    """Forget a request, e.g. because it was answered.
+
+    @rtype: L{_PendingRequest}
+
+    """
+    pending = self._requests.pop(rsalt)
+    if self._dedup.get(pending.dedup_key, None) == rsalt:
+      del self._dedup[pending.dedup_key]
+    self._request_count -= 1 + len(pending.duplicates)
+    self._version_probes.pop(rsalt, None)
+    # Rebuild the heap when it's mostly made of answered requests' timers
+    if len(self._timers) > 4 * len(self._requests) + 16:
+      self._timers = [timer for timer in self._timers
+                      if timer[1] in self._requests]
+      heapq.heapify(self._timers)
+    return pending
+
+  def _TakeRetryToken(self, now):
+    """Check the global retransmission budget.
+
+    """
+    self._retry_tokens = min(self._retry_rate,
+                             self._retry_tokens +
+                             (now - self._retry_time) * self._retry_rate)
+    self._retry_time = now
+    if self._retry_tokens < 1:
+      return False
+    self._retry_tokens -= 1
+    return True
+
+  def _Retransmit(self, rsalt, pending, now):
+    """Send a request again, and schedule its next retransmission.
+
+    The datagram is sent unchanged, so that the peer can recognise it.
+
+    """
+    if self._TakeRetryToken(now):
+      logging.debug("Retransmitting NLD request %s to %s", rsalt,
+                    pending.destination)
+      self.enqueue_send(pending.destination, self.port, pending.payload)
+    else:
+      logging.debug("Retransmission budget exhausted, not retransmitting"
+                    " NLD request %s", rsalt)
+    pending.retries += 1
+    if pending.retries < self._max_retries:
+      delay = constants.NLD_CLIENT_RETRY_TIMEOUT * 2 ** pending.retries
+      self._AddTimer(now + delay, rsalt, _TIMER_RETRY)
+
+  def _Expire(self, rsalt):
+    """Expire a request which got no reply.
+
+    """
+    pending = self._DropRequest(rsalt)
+    if pending.version != constants.NLD_PROTOCOL_VERSION_1:
+      # The peer may have been downgraded: fall back to the version 1
+      # until the next probe
+      (_, probe_time) = self._peer_versions.get(pending.destination,
+                                                (None, None))
+      self._peer_versions[pending.destination] = \
+        (constants.NLD_PROTOCOL_VERSION_1, probe_time)
+    for (request, args) in pending.GetRequests():
+      client_reply = NLDUpcallPayload(salt=request.rsalt,
+                                      type=UPCALL_EXPIRE,
+                                      orig_request=request,
+                                      extra_args=args,
+                                      client=self,
+                                      )
+      self._callback(client_reply)
+
+  def RunTimers(self):
+    """Retransmit the requests due, and delete the expired ones.
+
+    """
+    now = time.time()
+    while self._timers:
+      (when, rsalt, action) = self._timers[0]
+      if now < when:
         break
+      heapq.heappop(self._timers)
+      pending = self._requests.get(rsalt, None)
+      if pending is None:
+        continue
+      if action == _TIMER_RETRY:
+        self._Retransmit(rsalt, pending, now)
+      else:
+        self._Expire(rsalt)
+    self._ScheduleTimers()
 
   def SendRequest(self, request, cluster_name, destination, args=None):
     """Send an NLD request to another NLD instance
 
+    The request is retransmitted, with exponential backoff, until it gets a
+    reply. A request identical to one already waiting for a reply from the
+    same destination isn't sent again, but gets the same reply.
+
     @type request: L{objects.NLDRequest}
     @param request: the request to send
     @param cluster_name: name of the cluster
     @param destination: the address of the target NLD instance
     @type args: tuple
     @keyword args: additional callback arguments
+    @rtype: string
+    @return: the rsalt of the request whose reply will be used, i.e. the one
+        of the request already waiting if this one is a duplicate
 
     """
     request.cluster = cluster_name
@@ -338,47 +812,73 @@ class NLDAsyncUDPServer(daemon.AsyncUDPSocket):
     if not request.rsalt:
       raise errors.NLDClientError("Missing request rsalt")
 
-    self.ExpireRequests()
     if request.rsalt in self._requests:
       raise errors.NLDClientError("Duplicate request rsalt")
 
+    if self._request_count >= self._max_requests:
+      raise errors.NLDClientError("Too many outstanding requests")
+
     if request.type not in constants.NLD_REQS:
       raise errors.NLDClientError("Invalid request type")
 
+    dedup_key = (destination, cluster_name, request.type,
+                 serializer.DumpJson(request.query, indent=False))
+    if dedup_key in self._dedup:
+      rsalt = self._dedup[dedup_key]
+      logging.debug("NLD request %s is a duplicate of %s", request.rsalt,
+                    rsalt)
+      self._requests[rsalt].duplicates.append((request, args))
+      self._request_count += 1
+      return rsalt
+
+    version = self.GetPeerVersion(cluster_name, destination)
     now = time.time()
-    payload = self._PackRequest(request, cluster_name, timestamp=now)
+    (payload, version) = self._PackRequest(request, cluster_name,
+                                           timestamp=now, version=version)
 
     try:
       self.enqueue_send(destination, self.port, payload)
     except gnt_errors.UdpDataSizeError:
       raise errors.NLDClientError("Request too big")
 
-    self._requests[request.rsalt] = (request, args)
-    expire_time = now + constants.NLD_CLIENT_EXPIRE_TIMEOUT
-    self._expire_requests.append((expire_time, request.rsalt))
-
-  def HandleResponse(self, payload, ip, port):
+    self._requests[request.rsalt] = _PendingRequest(request, args,
+                                                    destination, version,
+                                                    payload, dedup_key)
+    self._request_count += 1
+    self._dedup[dedup_key] = request.rsalt
+    if self._max_retries > 0:
+      self._AddTimer(now + constants.NLD_CLIENT_RETRY_TIMEOUT, request.rsalt,
+                     _TIMER_RETRY)
+    self._AddTimer(now + constants.NLD_CLIENT_EXPIRE_TIMEOUT, request.rsalt,
+                   _TIMER_EXPIRE)
+    return request.rsalt
+
+  def HandleResponse(self, envelope, ip, port):
     """Asynchronous handler for an NLD reply
 
-    Call the relevant callback associated with the original request.
+    Call the relevant callback associated with the original request, and
+    with its duplicates.
 
     """
+    salt = envelope.salt
+    if salt not in self._requests:
+      logging.debug("Discarding unknown (expired?) reply from %s:%d", ip, port)
+      return
+
     try:
-      try:
-        answer, salt = self._UnpackReply(payload)
-      except (gnt_errors.SignatureError, errors.NLDMagicError), err:
-        if self._logger:
-          self._logger.debug("Discarding broken package: %s" % err)
-        return
+      answer = objects.NLDReply.FromDict(envelope.message)
+    except (AttributeError, TypeError), err:
+      logging.debug("Discarding broken reply from %s:%d: %s", ip, port, err)
+      return
 
-      try:
-        (request, args) = self._requests[salt]
-      except KeyError:
-        if self._logger:
-          self._logger.debug("Discarding unknown (expired?) reply: %s" % err)
-        return
+    destination = self._version_probes.get(salt, None)
+    if (destination is not None and
+        answer.status == constants.NLD_REPL_STATUS_OK):
+      self._SetPeerVersion(destination, answer.answer)
+    pending = self._DropRequest(salt)
 
-      client_reply = NLDUpcallPayload(salt=salt,
+    for (request, args) in pending.GetRequests():
+      client_reply = NLDUpcallPayload(salt=request.rsalt,
                                       type=UPCALL_REPLY,
                                       server_reply=answer,
                                       orig_request=request,
@@ -389,8 +889,138 @@ class NLDAsyncUDPServer(daemon.AsyncUDPSocket):
                                       )
       self._callback(client_reply)
 
-    finally:
-      self.ExpireRequests()
+
+def _BatchItemSize(ip, link, new_entry):
+  """Estimate the size added to a batch request by an IP address.
+
+  """
+  size = len(ip) + _BATCH_IP_OVERHEAD
+  if new_entry:
+    size += _BATCH_LINK_OVERHEAD + len(link or "")
+  return size
+
+
+def BuildRouteInvalidateBatches(links, max_size):
+  """Pack route invalidations in batch request queries.
+
+  @type links: dict
+  @param links: link (or None if unknown) to IP addresses mapping
+  @type max_size: int
+  @param max_size: maximum size of a packed request
+  @rtype: list
+  @return: list of L{constants.NLD_REQ_ROUTE_INVALIDATE_BATCH} queries
+
+  """
+  items = []
+  for (link, ips) in links.iteritems():
+    for ip in ips:
+      items.append((link, ip))
+  items.sort()
+
+  queries = []
+  query = []
+  size = _BATCH_REQUEST_OVERHEAD
+  for (link, ip) in items:
+    new_entry = not query or query[-1].get(constants.NLD_REQQ_LINK) != link
+    item_size = _BatchItemSize(ip, link, new_entry)
+    if query and size + item_size > max_size:
+      queries.append(query)
+      query = []
+      size = _BATCH_REQUEST_OVERHEAD
+      new_entry = True
+      item_size = _BatchItemSize(ip, link, new_entry)
+    if new_entry:
+      entry = {constants.NLD_REQQ_IPLIST: []}
+      if link is not None:
+        entry[constants.NLD_REQQ_LINK] = link
+      query.append(entry)
+    query[-1][constants.NLD_REQQ_IPLIST].append(ip)
+    size += item_size
+  if query:
+    queries.append(query)
+  return queries
+
+
+class RouteInvalidationBatcher(object):
+  """Coalesce the route invalidations sent to the same NLD instance.
+
+  Invalidations are held for a short window, and then sent together in as
+  few batch requests as fit in UDP packets, instead of one request each.
+  Peers which don't announce the protocol version 2 may not know batch
+  requests, and get one route invalidation request per link instead.
+
+  """
+  def __init__(self, nld_server, scheduler,
+               window=constants.NLD_ROUTE_INVALIDATE_BATCH_WINDOW,
+               max_size=gnt_constants.MAX_UDP_DATA_SIZE):
+    """Constructor for RouteInvalidationBatcher
+
+    @type nld_server: L{NLDAsyncUDPServer}
+    @param nld_server: server used to send the requests
+    @type scheduler: L{daemon.AsyncoreScheduler}
+    @param scheduler: scheduler used for the coalescing window
+    @type window: float
+    @param window: seconds to wait for more invalidations to the same
+        destination
+    @type max_size: int
+    @param max_size: maximum size of a request
+
+    """
+    self._server = nld_server
+    self._scheduler = scheduler
+    self._window = window
+    self._max_size = max_size
+    # (cluster name, destination) -> {link: set of IPs}
+    self._pending = {}
+    # (cluster name, destination) -> scheduler event
+    self._events = {}
+
+  def Add(self, cluster_name, destination, ip, link=None):
+    """Queue a route invalidation.
+
+    @type cluster_name: string
+    @param cluster_name: cluster to send the request as
+    @type destination: string
+    @param destination: address of the target NLD instance
+    @type ip: string
+    @param ip: instance IP address to invalidate
+    @type link: string
+    @param link: link of the instance, or None if unknown
+
+    """
+    key = (cluster_name, destination)
+    self._pending.setdefault(key, {}).setdefault(link, set()).add(ip)
+    if key not in self._events:
+      self._events[key] = self._scheduler.enter(self._window, 1, self._Flush,
+                                                [key])
+
+  def _Flush(self, key):
+    """Send the route invalidations queued for a destination.
+
+    """
+    del self._events[key]
+    links = self._pending.pop(key, {})
+    (cluster_name, destination) = key
+    # Batch requests came before the protocol version 2
+    batch = (self._server.GetPeerVersion(cluster_name, destination) >=
+             constants.NLD_PROTOCOL_VERSION_2)
+    requests = []
+    for query in BuildRouteInvalidateBatches(links, self._max_size):
+      if batch:
+        requests.append(NLDClientRequest(
+          type=constants.NLD_REQ_ROUTE_INVALIDATE_BATCH,
+          query=query))
+      else:
+        for entry in query:
+          requests.append(NLDClientRequest(
+            type=constants.NLD_REQ_ROUTE_INVALIDATE,
+            query=entry))
+    for request in requests:
+      try:
+        self._server.SendRequest(request, cluster_name, destination)
+      except errors.NLDClientError, err:
+        logging.error("Cannot send route invalidations to %s: %s",
+                      destination, err)
 
 
 # UPCALL_REPLY: server reply upcall
@@ -466,6 +1096,8 @@ class NLDResponseCallback(object):
         self.HandlePingResponse,
       constants.NLD_REQ_ROUTE_INVALIDATE:
         self.HandleRouteInvalidateResponse,
+      constants.NLD_REQ_ROUTE_INVALIDATE_BATCH:
+        self.HandleRouteInvalidateResponse,
     }
 
   @staticmethod
@@ -497,4 +1129,10 @@ class NLDResponseCallback(object):
         dispatcher = self.dispatch_table[rtype]
       except KeyError, err: # pylint: disable-msg=W0612
         logging.warning("Unhandled NLD response type: %s", rtype)
+        return
       dispatcher(up)
+
+    elif up.type == UPCALL_EXPIRE:
+      logging.info("NLD request %s (type %s) to cluster %s expired without"
+                   " a reply", up.salt, up.orig_request.type,
+                   up.orig_request.cluster)
@@ -0,0 +1,311 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Binary encoding of the NLD protocol version 2
+
+Version 1 messages are JSON, wrapped in a signed JSON envelope. Version 2
+messages have a fixed binary header followed by the key selector (cluster
+name) and the body, all in network byte order:
+
+  - magic fourcc (4 bytes, L{constants.NLD_MAGIC_FOURCC_V2})
+  - protocol version (1 byte)
+  - flags (1 byte, L{_FLAG_REQUEST} for requests)
+  - request type or reply status (1 byte)
+  - key selector length (1 byte)
+  - request timestamp, 0 for replies (4 bytes)
+  - rsalt, as the 16 bytes of a UUID
+  - HMAC-SHA1 of the whole message but itself (20 bytes)
+
+Route invalidation request bodies are a list of entries, each made of the
+link length (1 byte, 0 for an unknown link), the link, the number of IP
+addresses (2 bytes) and the packed IPv4 addresses. Ping requests have no
+body, and reply bodies are the JSON encoded answer, as they're small and
+rare. Requests which can't be encoded this way (e.g. with IPv6 addresses)
+are sent with version 1.
+
+"""
+
+
+import binascii
+import socket
+import struct
+
+from ganeti_nbma import constants
+from ganeti_nbma import errors
+
+from ganeti import serializer
+from ganeti import utils
+
+
+_HEADER_FORMAT = "!4sBBBBI16s"
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_HMAC_SIZE = 20
+
+_FLAG_REQUEST = 0x01
+
+_ENTRY_HEADER_FORMAT = "!B"
+_ENTRY_COUNT_FORMAT = "!H"
+_MAX_ENTRY_IPS = 65535
+_MAX_LINK_LEN = 255
+
+
+def _PackRsalt(rsalt):
+  """Convert a UUID rsalt to its 16 bytes, or None if it isn't a UUID.
+
+  """
+  if not isinstance(rsalt, basestring):
+    return None
+  digits = rsalt.replace("-", "")
+  if len(digits) != 32 or len(rsalt) != 36:
+    return None
+  try:
+    return binascii.unhexlify(digits)
+  except TypeError:
+    return None
+
+
+def _UnpackRsalt(packed):
+  digits = binascii.hexlify(packed)
+  return "%s-%s-%s-%s-%s" % (digits[0:8], digits[8:12], digits[12:16],
+                             digits[16:20], digits[20:32])
+
+
+def _PackIPv4(ip):
+  if not isinstance(ip, basestring) or ip.count(".") != 3:
+    return None
+  try:
+    return socket.inet_aton(ip)
+  except socket.error:
+    return None
+
+
+def _EncodeInvalidations(entries):
+  """Encode route invalidation entries, or return None if not possible.
+
+  @type entries: list
+  @param entries: list of route invalidation query dicts
+
+  """
+  parts = []
+  for entry in entries:
+    if not isinstance(entry, dict):
+      return None
+    link = entry.get(constants.NLD_REQQ_LINK, None) or ""
+    ips = entry.get(constants.NLD_REQQ_IPLIST, None)
+    if (not isinstance(link, basestring) or len(link) > _MAX_LINK_LEN or
+        not isinstance(ips, list) or len(ips) > _MAX_ENTRY_IPS):
+      return None
+    parts.append(struct.pack(_ENTRY_HEADER_FORMAT, len(link)))
+    parts.append(link)
+    parts.append(struct.pack(_ENTRY_COUNT_FORMAT, len(ips)))
+    for ip in ips:
+      packed = _PackIPv4(ip)
+      if packed is None:
+        return None
+      parts.append(packed)
+  return "".join(parts)
+
+
+def _DecodeInvalidations(body):
+  """Decode route invalidation entries.
+
+  """
+  entries = []
+  pos = 0
+  try:
+    while pos < len(body):
+      (link_len, ) = struct.unpack(_ENTRY_HEADER_FORMAT, body[pos:pos + 1])
+      pos += 1
+      link = body[pos:pos + link_len]
+      pos += link_len
+      (count, ) = struct.unpack(_ENTRY_COUNT_FORMAT, body[pos:pos + 2])
+      pos += 2
+      packed = body[pos:pos + 4 * count]
+      pos += 4 * count
+      if len(packed) != 4 * count:
+        raise errors.NLDDecodeError("truncated route invalidation entry")
+      entry = {
+        constants.NLD_REQQ_IPLIST: [socket.inet_ntoa(packed[i:i + 4])
+                                    for i in range(0, len(packed), 4)],
+        }
+      if link:
+        entry[constants.NLD_REQQ_LINK] = link
+      entries.append(entry)
+  except struct.error, err:
+    raise errors.NLDDecodeError("truncated route invalidation entry: %s" %
+                                err)
+  return entries
+
+
+def _EncodeQuery(request_type, query):
+  """Encode a request query, or return None if not possible.
+
+  """
+  if request_type == constants.NLD_REQ_PING:
+    if query is not None:
+      return None
+    return ""
+  elif request_type == constants.NLD_REQ_ROUTE_INVALIDATE:
+    # Older senders' plain IP queries are left to version 1
+    if not isinstance(query, dict):
+      return None
+    return _EncodeInvalidations([query])
+  elif request_type == constants.NLD_REQ_ROUTE_INVALIDATE_BATCH:
+    if not isinstance(query, list):
+      return None
+    return _EncodeInvalidations(query)
+  return None
+
+
+def _DecodeQuery(request_type, body):
+  if request_type == constants.NLD_REQ_PING:
+    if body:
+      raise errors.NLDDecodeError("non-empty ping body")
+    return None
+  elif request_type == constants.NLD_REQ_ROUTE_INVALIDATE:
+    entries = _DecodeInvalidations(body)
+    if len(entries) != 1:
+      raise errors.NLDDecodeError("route invalidation with %d entries" %
+                                  len(entries))
+    return entries[0]
+  elif request_type == constants.NLD_REQ_ROUTE_INVALIDATE_BATCH:
+    return _DecodeInvalidations(body)
+  raise errors.NLDDecodeError("unknown request type %d" % request_type)
+
+
+def _Sign(key, header, selector, body):
+  return binascii.unhexlify(utils.Sha1Hmac(key, header + selector + body))
+
+
+def _Pack(key, flags, code, selector, timestamp, rsalt, body):
+  header = struct.pack(_HEADER_FORMAT, constants.NLD_MAGIC_FOURCC_V2,
+                       constants.NLD_PROTOCOL_VERSION_2, flags, code,
+                       len(selector), timestamp, rsalt)
+  return "".join([header, _Sign(key, header, selector, body), selector,
+                  body])
+
+
+def PackRequest(request, cluster_name, key, timestamp):
+  """Encode a request with the protocol version 2.
+
+  @type request: L{objects.NLDRequest}
+  @param request: the request
+  @type cluster_name: string
+  @param cluster_name: name of the cluster, used as key selector
+  @type key: string
+  @param key: hmac key of the cluster
+  @type timestamp: int
+  @param timestamp: request timestamp
+  @rtype: string
+  @return: the datagram, or None if the request can't be encoded with the
+      version 2 and has to be sent with the version 1
+
+  """
+  rsalt = _PackRsalt(request.rsalt)
+  body = _EncodeQuery(request.type, request.query)
+  if rsalt is None or body is None or len(cluster_name) > _MAX_LINK_LEN:
+    return None
+  return _Pack(key, _FLAG_REQUEST, request.type, cluster_name,
+               int(timestamp), rsalt, body)
+
+
+def PackReply(reply, rsalt, cluster_name, key):
+  """Encode a reply with the protocol version 2.
+
+  @type reply: L{objects.NLDReply}
+  @param reply: the reply
+  @type rsalt: string
+  @param rsalt: rsalt of the request
+  @type cluster_name: string
+  @param cluster_name: name of the cluster, used as key selector
+  @type key: string
+  @param key: hmac key of the cluster
+  @rtype: string
+
+  """
+  return _Pack(key, 0, reply.status, cluster_name, 0, _PackRsalt(rsalt),
+               serializer.DumpJson(reply.answer, indent=False))
+
+
+def UnpackDatagram(payload, cluster_keys, salt_fn):
+  """Decode and authenticate a version 2 datagram.
+
+  As for version 1, the cheap checks come first and the body is only
+  decoded once the HMAC matches.
+
+  @type payload: string
+  @param payload: datagram, including the magic fourcc
+  @type cluster_keys: dict
+  @param cluster_keys: cluster name to hmac key mapping
+  @type salt_fn: callable
+  @param salt_fn: function returning whether a salt is acceptable
+  @rtype: tuple
+  @return: (message dict, as for version 1, salt, cluster name)
+  @raise errors.NLDDecodeError: if the datagram is rejected
+
+  """
+  if len(payload) < _HEADER_SIZE + _HMAC_SIZE:
+    raise errors.NLDDecodeError("datagram too short (%d bytes)" %
+                                len(payload))
+  header = payload[:_HEADER_SIZE]
+  (magic, version, flags, code, selector_len, timestamp, packed_rsalt) = \
+    struct.unpack(_HEADER_FORMAT, header)
+  if magic != constants.NLD_MAGIC_FOURCC_V2:
+    raise errors.NLDDecodeError("unknown fourcc")
+  if version != constants.NLD_PROTOCOL_VERSION_2:
+    raise errors.NLDDecodeError("unsupported protocol version %d" % version)
+
+  pos = _HEADER_SIZE + _HMAC_SIZE
+  selector = payload[pos:pos + selector_len]
+  body = payload[pos + selector_len:]
+  hmac_key = cluster_keys.get(selector, None)
+  if not hmac_key:
+    raise errors.NLDDecodeError("unknown key selector '%s'" % selector)
+
+  rsalt = _UnpackRsalt(packed_rsalt)
+  is_request = bool(flags & _FLAG_REQUEST)
+  if is_request:
+    salt = "%d" % timestamp
+  else:
+    salt = rsalt
+  if not salt_fn(salt):
+    raise errors.NLDDecodeError("unexpected salt '%s'" % salt)
+
+  digest = binascii.hexlify(payload[_HEADER_SIZE:_HEADER_SIZE + _HMAC_SIZE])
+  if not utils.VerifySha1Hmac(hmac_key, header + selector + body, digest):
+    raise errors.NLDDecodeError("invalid signature")
+
+  message = {
+    "protocol": version,
+    "is_request": is_request,
+    "cluster": selector,
+    }
+  if is_request:
+    message["rsalt"] = rsalt
+    message["type"] = code
+    message["query"] = _DecodeQuery(code, body)
+  else:
+    message["status"] = code
+    try:
+      message["answer"] = serializer.LoadJson(body)
+    except ValueError, err:
+      raise errors.NLDDecodeError("invalid answer: %s" % err)
+  return (message, salt, selector)
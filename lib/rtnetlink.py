@@ -0,0 +1,494 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Minimal rtnetlink interface
+
+Module used to program the kernel Neighbour and Routing tables by talking
+directly to a NETLINK_ROUTE socket, instead of forking an external command for
+every change.
+
+Only the small subset of the protocol needed by NLD is implemented: IPv4
+neighbour entries and IPv4 host routes. Routes are in the main routing table
+unless another one is given.
+
+"""
+
+
+import errno
+import socket
+import struct
+
+from ganeti_nbma import errors
+
+
+NETLINK_ROUTE = 0
+
+# Generic netlink message types
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+# rtnetlink message types
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+
+# Netlink message flags
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+# Multicast groups
+RTMGRP_NEIGH = 0x4
+RTMGRP_IPV4_ROUTE = 0x40
+
+# Neighbour attributes and states
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_PERMANENT = 0x80
+
+# Route attributes and values
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+RT_TABLE_UNSPEC = 0
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+
+# Socket receive buffer size. Acks for a whole burst of changes are queued
+# here before we get the chance to read them.
+_RCVBUF_SIZE = 1024 * 1024
+
+# Maximum number of messages to send before collecting their acks
+_BURST_SIZE = 128
+
+_NLMSGHDR = "=IHHII"
+_NLMSGHDR_LEN = struct.calcsize(_NLMSGHDR)
+_NLMSGERR = "=i"
+_NLMSGERR_LEN = struct.calcsize(_NLMSGERR)
+_RTATTR = "=HH"
+_RTATTR_LEN = struct.calcsize(_RTATTR)
+_NDMSG = "=BBHiHBB"
+_NDMSG_LEN = struct.calcsize(_NDMSG)
+_RTMSG = "=BBBBBBBBI"
+_RTMSG_LEN = struct.calcsize(_RTMSG)
+
+
+def _Align(length):
+  """Round a length up to the netlink 4-byte alignment.
+
+  """
+  return (length + 3) & ~3
+
+
+def _PackAttr(attr_type, data):
+  """Pack a single route attribute, with padding.
+
+  @type attr_type: int
+  @param attr_type: attribute type
+  @type data: str
+  @param data: attribute payload
+
+  """
+  length = _RTATTR_LEN + len(data)
+  padding = "\0" * (_Align(length) - length)
+  return struct.pack(_RTATTR, length, attr_type) + data + padding
+
+
+def _UnpackAttrs(data):
+  """Unpack a sequence of route attributes.
+
+  @type data: str
+  @param data: the attributes part of a message
+  @rtype: dict
+  @return: attribute type to payload mapping
+
+  """
+  attrs = {}
+  offset = 0
+  while offset + _RTATTR_LEN <= len(data):
+    (length, attr_type) = struct.unpack(_RTATTR,
+                                        data[offset:offset + _RTATTR_LEN])
+    if length < _RTATTR_LEN:
+      break
+    attrs[attr_type] = data[offset + _RTATTR_LEN:offset + length]
+    offset += _Align(length)
+  return attrs
+
+
+def _PackAddress(address):
+  """Convert an "a.b.c.d[/len]" string to its packed form and prefix length.
+
+  """
+  if "/" in address:
+    (address, prefix_len) = address.split("/", 1)
+    prefix_len = int(prefix_len)
+  else:
+    prefix_len = 32
+  try:
+    return socket.inet_aton(address), prefix_len
+  except socket.error:
+    raise errors.NetlinkError("Invalid IPv4 address '%s'" % address)
+
+
+def GetInterfaceIndex(iface):
+  """Return the kernel index of a network interface.
+
+  @type iface: str
+  @param iface: interface name
+  @rtype: int
+
+  @raise errors.NetlinkError: if the interface doesn't exist
+
+  """
+  try:
+    fd = open("/sys/class/net/%s/ifindex" % iface)
+    try:
+      return int(fd.read().strip())
+    finally:
+      fd.close()
+  except (EnvironmentError, ValueError), err:
+    raise errors.NetlinkError("Cannot find interface %s: %s" % (iface, err),
+                              errno.ENODEV)
+
+
+def BuildNeighbourMessage(msg_type, ip_address, ifindex, lladdr=None):
+  """Build the body of an RTM_*NEIGH message.
+
+  @type msg_type: int
+  @param msg_type: one of RTM_NEWNEIGH, RTM_DELNEIGH
+  @type ip_address: str
+  @param ip_address: neighbour IP address
+  @type ifindex: int
+  @param ifindex: interface index
+  @type lladdr: str
+  @param lladdr: link layer address (an IPv4 address, on GRE interfaces)
+
+  """
+  (dst, _) = _PackAddress(ip_address)
+  if msg_type == RTM_NEWNEIGH:
+    state = NUD_PERMANENT
+  else:
+    state = 0
+  body = struct.pack(_NDMSG, socket.AF_INET, 0, 0, ifindex, state, 0, 0)
+  body += _PackAttr(NDA_DST, dst)
+  if lladdr is not None:
+    (lladdr_packed, _) = _PackAddress(lladdr)
+    body += _PackAttr(NDA_LLADDR, lladdr_packed)
+  return body
+
+
+def BuildRouteMessage(msg_type, ip_address, ifindex, gateway=None,
+                      table=RT_TABLE_MAIN):
+  """Build the body of an RTM_*ROUTE message.
+
+  @type msg_type: int
+  @param msg_type: one of RTM_NEWROUTE, RTM_DELROUTE
+  @type ip_address: str
+  @param ip_address: route destination, optionally with a prefix length
+  @type ifindex: int
+  @param ifindex: output interface index
+  @type gateway: str
+  @param gateway: next hop
+  @type table: int
+  @param table: routing table id
+
+  """
+  (dst, dst_len) = _PackAddress(ip_address)
+  if msg_type == RTM_NEWROUTE:
+    rtm_type = RTN_UNICAST
+  else:
+    rtm_type = 0
+  # Table ids which don't fit the header are passed as an attribute
+  if table < 256:
+    rtm_table = table
+  else:
+    rtm_table = RT_TABLE_UNSPEC
+  body = struct.pack(_RTMSG, socket.AF_INET, dst_len, 0, 0, rtm_table,
+                     RTPROT_BOOT, RT_SCOPE_UNIVERSE, rtm_type, 0)
+  if table != rtm_table:
+    body += _PackAttr(RTA_TABLE, struct.pack("=I", table))
+  body += _PackAttr(RTA_DST, dst)
+  body += _PackAttr(RTA_OIF, struct.pack("=i", ifindex))
+  if gateway is not None:
+    (gw_packed, _) = _PackAddress(gateway)
+    body += _PackAttr(RTA_GATEWAY, gw_packed)
+  return body
+
+
+def ParseNeighbourMessage(body):
+  """Parse the body of an RTM_*NEIGH message.
+
+  @rtype: tuple
+  @return: (ifindex, state, ip address, link layer address); the addresses
+      are None if not present or not IPv4
+
+  """
+  if len(body) < _NDMSG_LEN:
+    raise errors.NetlinkError("Neighbour message too short")
+  (family, _, _, ifindex, state, _, _) = struct.unpack(_NDMSG,
+                                                       body[:_NDMSG_LEN])
+  attrs = _UnpackAttrs(body[_NDMSG_LEN:])
+  dst = attrs.get(NDA_DST, None)
+  lladdr = attrs.get(NDA_LLADDR, None)
+  if family != socket.AF_INET or dst is None or len(dst) != 4:
+    dst = None
+  else:
+    dst = socket.inet_ntoa(dst)
+  if lladdr is not None and len(lladdr) == 4:
+    lladdr = socket.inet_ntoa(lladdr)
+  else:
+    lladdr = None
+  return (ifindex, state, dst, lladdr)
+
+
+def ParseRouteMessage(body):
+  """Parse the body of an RTM_*ROUTE message.
+
+  @rtype: tuple
+  @return: (routing table, output ifindex, destination, gateway); the
+      destination is in "a.b.c.d" form for host routes and "a.b.c.d/len"
+      otherwise, and is None for non-IPv4 routes
+
+  """
+  if len(body) < _RTMSG_LEN:
+    raise errors.NetlinkError("Route message too short")
+  fields = struct.unpack(_RTMSG, body[:_RTMSG_LEN])
+  (family, dst_len) = fields[:2]
+  table = fields[4]
+  attrs = _UnpackAttrs(body[_RTMSG_LEN:])
+  if RTA_TABLE in attrs:
+    (table, ) = struct.unpack("=I", attrs[RTA_TABLE])
+  oif = attrs.get(RTA_OIF, None)
+  if oif is not None:
+    (oif, ) = struct.unpack("=i", oif)
+  dst = attrs.get(RTA_DST, None)
+  gateway = attrs.get(RTA_GATEWAY, None)
+  if family != socket.AF_INET or dst is None:
+    dst = None
+  else:
+    dst = socket.inet_ntoa(dst)
+    if dst_len != 32:
+      dst = "%s/%d" % (dst, dst_len)
+  if gateway is not None:
+    gateway = socket.inet_ntoa(gateway)
+  return (table, oif, dst, gateway)
+
+
+def BuildNeighbourDumpRequest():
+  """Build the body of an RTM_GETNEIGH dump request for IPv4 entries.
+
+  """
+  return struct.pack(_NDMSG, socket.AF_INET, 0, 0, 0, 0, 0, 0)
+
+
+def BuildRouteDumpRequest():
+  """Build the body of an RTM_GETROUTE dump request for IPv4 routes.
+
+  """
+  return struct.pack(_RTMSG, socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+
+
+def DumpNeighbourTable(sock, ifindex):
+  """Dump the IPv4 neighbour entries of an interface.
+
+  @type sock: L{RtNetlinkSocket}
+  @param sock: a blocking socket to use for the dump
+  @type ifindex: int
+  @param ifindex: interface index
+  @rtype: dict
+  @return: address to link layer address mapping
+
+  """
+  table = {}
+  for (_, body) in sock.Dump(RTM_GETNEIGH, BuildNeighbourDumpRequest()):
+    (entry_ifindex, _, dst, lladdr) = ParseNeighbourMessage(body)
+    if entry_ifindex == ifindex and dst is not None:
+      table[dst] = lladdr
+  return table
+
+
+def DumpRouteTable(sock, ifindex, table=RT_TABLE_MAIN):
+  """Dump the IPv4 routes of a routing table going through an interface.
+
+  @type sock: L{RtNetlinkSocket}
+  @param sock: a blocking socket to use for the dump
+  @type ifindex: int
+  @param ifindex: output interface index
+  @type table: int
+  @param table: routing table id
+  @rtype: dict
+  @return: destination to gateway mapping
+
+  """
+  routes = {}
+  for (_, body) in sock.Dump(RTM_GETROUTE, BuildRouteDumpRequest()):
+    (rt_table, oif, dst, gateway) = ParseRouteMessage(body)
+    if rt_table == table and oif == ifindex and dst is not None:
+      routes[dst] = gateway
+  return routes
+
+
+class RtNetlinkSocket(object):
+  """A NETLINK_ROUTE socket.
+
+  The socket is kept open for the lifetime of the object, so that any number
+  of changes can be sent to the kernel without forking external commands.
+
+  """
+  def __init__(self, groups=0):
+    """Constructor for RtNetlinkSocket
+
+    @type groups: int
+    @param groups: bitmask of multicast groups to subscribe to
+
+    """
+    try:
+      self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 NETLINK_ROUTE)
+      self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            _RCVBUF_SIZE)
+      self._sock.bind((0, groups))
+    except (socket.error, AttributeError), err:
+      raise errors.NetlinkError("Cannot open rtnetlink socket: %s" % err)
+    self._seq = 0
+
+  def fileno(self):
+    return self._sock.fileno()
+
+  def close(self):
+    self._sock.close()
+
+  def _NextSeq(self):
+    self._seq = (self._seq + 1) & 0xffffffff
+    return self._seq
+
+  def Receive(self):
+    """Read one datagram from the socket and split it into messages.
+
+    @rtype: list
+    @return: list of (type, flags, seq, body) tuples
+
+    """
+    try:
+      data = self._sock.recv(65536)
+    except socket.error, err:
+      raise errors.NetlinkError("Error reading from rtnetlink: %s" % err,
+                                err.args[0])
+    messages = []
+    offset = 0
+    while offset + _NLMSGHDR_LEN <= len(data):
+      (length, msg_type, flags, seq, _) = \
+        struct.unpack(_NLMSGHDR, data[offset:offset + _NLMSGHDR_LEN])
+      if length < _NLMSGHDR_LEN:
+        break
+      messages.append((msg_type, flags, seq,
+                       data[offset + _NLMSGHDR_LEN:offset + length]))
+      offset += _Align(length)
+    return messages
+
+  def _Pack(self, msg_type, flags, body):
+    seq = self._NextSeq()
+    header = struct.pack(_NLMSGHDR, _NLMSGHDR_LEN + len(body), msg_type,
+                         flags | NLM_F_REQUEST, seq, 0)
+    return seq, header + body
+
+  def _Send(self, data):
+    try:
+      self._sock.send(data)
+    except socket.error, err:
+      raise errors.NetlinkError("Error writing to rtnetlink: %s" % err,
+                                err.args[0])
+
+  def Transaction(self, messages):
+    """Send a list of messages to the kernel and collect the results.
+
+    Messages are packed together in bursts, and each message gets its own
+    acknowledgement, so a failure doesn't prevent the rest from being
+    applied.
+
+    @type messages: list
+    @param messages: list of (type, flags, body) tuples
+    @rtype: list
+    @return: for each message, 0 on success or the (positive) errno
+
+    """
+    results = []
+    for start in range(0, len(messages), _BURST_SIZE):
+      burst = messages[start:start + _BURST_SIZE]
+      pending = {}
+      data = []
+      for (idx, (msg_type, flags, body)) in enumerate(burst):
+        (seq, packed) = self._Pack(msg_type, flags | NLM_F_ACK, body)
+        pending[seq] = idx
+        data.append(packed)
+      self._Send("".join(data))
+
+      burst_results = [0] * len(burst)
+      while pending:
+        for (msg_type, _, seq, body) in self.Receive():
+          if msg_type != NLMSG_ERROR or seq not in pending:
+            continue
+          (error, ) = struct.unpack(_NLMSGERR, body[:_NLMSGERR_LEN])
+          burst_results[pending.pop(seq)] = -error
+      results.extend(burst_results)
+    return results
+
+  def Dump(self, msg_type, body):
+    """Request a dump from the kernel.
+
+    @type msg_type: int
+    @param msg_type: one of the RTM_GET* message types
+    @type body: str
+    @param body: family specific request header
+    @rtype: list
+    @return: list of (type, body) tuples, one per dumped object
+
+    """
+    (seq, packed) = self._Pack(msg_type, NLM_F_DUMP, body)
+    self._Send(packed)
+    result = []
+    while True:
+      for (reply_type, _, reply_seq, reply_body) in self.Receive():
+        if reply_seq != seq:
+          continue
+        if reply_type == NLMSG_DONE:
+          return result
+        if reply_type == NLMSG_ERROR:
+          (error, ) = struct.unpack(_NLMSGERR, reply_body[:_NLMSGERR_LEN])
+          if error:
+            raise errors.NetlinkError("Dump failed: %s" %
+                                      errno.errorcode.get(-error, -error),
+                                      -error)
+          return result
+        result.append((reply_type, reply_body))
@@ -27,15 +27,47 @@ import logging
 
 from ganeti import errors
 
+from ganeti_nbma import constants
 from ganeti_nbma import iptables
 
 class PeerSetManager(object):
   """Merge the peer list from multiple sets
 
+  The same peer can belong to several sets, so each peer is reference
+  counted, and only the peers entering or leaving the global set are
+  committed to the firewall. Commits can be delayed, so that a burst of
+  updates from different sets results in a single firewall transaction.
+  Failed commits are retried, with exponential backoff.
+
   """
 
-  def __init__(self):
+  def __init__(self, firewall_mode=constants.DEFAULT_FIREWALL_MODE,
+               scheduler=None, commit_delay=0):
+    """Constructor for PeerSetManager
+
+    @type firewall_mode: string
+    @param firewall_mode: one of L{constants.FIREWALL_MODES}
+    @type scheduler: L{daemon.AsyncoreScheduler}
+    @param scheduler: scheduler used to delay and retry the commits
+    @type commit_delay: int
+    @param commit_delay: seconds to wait for further updates before
+        committing a change to the firewall; changes are committed
+        immediately if zero or if no scheduler is given
+
+    """
     self._peer_sets = {}
+    self._firewall_mode = firewall_mode
+    self._scheduler = scheduler
+    self._commit_delay = commit_delay
+    self._commit_event = None
+    # peer -> number of sets containing it
+    self._peer_refs = {}
+    # Changes to the global peer set not committed yet
+    self._pending_added = set()
+    self._pending_removed = set()
+    # Whether the whole set has to be committed, rather than just the delta
+    self._full_commit = True
+    self._retry_delay = constants.FIREWALL_COMMIT_RETRY_DELAY
 
   def RegisterPeerSet(self, name):
     """Register a peer set.
@@ -50,15 +82,84 @@ class PeerSetManager(object):
       raise errors.ProgrammerError("Double registration for set %s" % name)
     self._peer_sets[name] = None
 
+  def _AddPeer(self, peer):
+    count = self._peer_refs.get(peer, 0)
+    self._peer_refs[peer] = count + 1
+    if count == 0:
+      if peer in self._pending_removed:
+        self._pending_removed.remove(peer)
+      else:
+        self._pending_added.add(peer)
+
+  def _RemovePeer(self, peer):
+    count = self._peer_refs[peer] - 1
+    if count:
+      self._peer_refs[peer] = count
+      return
+    del self._peer_refs[peer]
+    if peer in self._pending_added:
+      self._pending_added.remove(peer)
+    else:
+      self._pending_removed.add(peer)
+
+  def _ScheduleCommit(self):
+    """Commit the pending changes, now or after the commit delay.
+
+    """
+    if self._scheduler is None or self._commit_delay <= 0:
+      self._UpdateIptablesRules()
+    elif self._commit_event is None:
+      self._commit_event = self._scheduler.enter(self._commit_delay, 1,
+                                                 self._UpdateIptablesRules,
+                                                 [])
+
   def _UpdateIptablesRules(self):
     """Update iptables rules, merging all remote sets.
 
     """
-    global_peer_list = []
-    for peer_list in self._peer_sets.values():
-      global_peer_list.extend(peer_list)
-    logging.debug("Updating trusted NBMA nodes: %s", global_peer_list)
-    iptables.UpdateIptablesRules(global_peer_list)
+    self._commit_event = None
+    added = sorted(self._pending_added)
+    removed = sorted(self._pending_removed)
+    if not (added or removed or self._full_commit):
+      return
+    global_peer_list = sorted(self._peer_refs)
+
+    try:
+      if self._firewall_mode == constants.FIREWALL_MODE_CHAIN:
+        logging.debug("Updating trusted NBMA nodes: %s", global_peer_list)
+        iptables.UpdateIptablesRules(global_peer_list)
+      elif self._full_commit:
+        logging.debug("Replacing trusted NBMA nodes set: %s",
+                      global_peer_list)
+        iptables.SyncIpsetRules(global_peer_list)
+      else:
+        logging.debug("Updating trusted NBMA nodes set, adding %s and"
+                      " removing %s", added, removed)
+        iptables.UpdateIpsetMembers(added, removed)
+    except (errors.CommandError, errors.ConfigurationError), err:
+      # A missing or modified trust chain may be fixed by the administrator,
+      # so it's retried like the command failures
+      logging.error("Cannot update the trusted NBMA nodes: %s", err)
+      self._full_commit = True
+      self._ScheduleRetry()
+    else:
+      self._full_commit = False
+      self._retry_delay = constants.FIREWALL_COMMIT_RETRY_DELAY
+    self._pending_added = set()
+    self._pending_removed = set()
+
+  def _ScheduleRetry(self):
+    """Schedule a full commit after a failed one.
+
+    """
+    if self._scheduler is None or self._commit_event is not None:
+      return
+    logging.info("Retrying to update the trusted NBMA nodes in %s seconds",
+                 self._retry_delay)
+    self._commit_event = self._scheduler.enter(self._retry_delay, 1,
+                                               self._UpdateIptablesRules, [])
+    self._retry_delay = min(2 * self._retry_delay,
+                            constants.FIREWALL_COMMIT_MAX_RETRY_DELAY)
 
   def UpdatePeerSetNodes(self, name, nodes):
     """Update a single set peer list, and keep a cache
@@ -70,10 +171,20 @@ class PeerSetManager(object):
 
     """
     assert isinstance(nodes, (tuple, list))
-    nodes = sorted(nodes)
     if name not in self._peer_sets:
       raise errors.ProgrammerError("Unknown peer set %s" % name)
-    if nodes == self._peer_sets[name]:
+    new_nodes = frozenset(nodes)
+    old_nodes = self._peer_sets[name]
+    if old_nodes is None:
+      old_nodes = frozenset()
+    elif new_nodes == old_nodes:
       return
-    self._peer_sets[name] = nodes
-    self._UpdateIptablesRules()
+    self._peer_sets[name] = new_nodes
+
+    for peer in new_nodes - old_nodes:
+      self._AddPeer(peer)
+    for peer in old_nodes - new_nodes:
+      self._RemovePeer(peer)
+
+    if self._pending_added or self._pending_removed or self._full_commit:
+      self._ScheduleCommit()
@@ -0,0 +1,227 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""NLD state snapshots
+
+The instance maps and the master and master candidate addresses learnt from
+confd are saved to disk, so that a restarted ganeti-nld can route the
+instances right away, instead of waiting for its first confd queries to
+complete.
+
+The state of a cluster is a dict with the following keys:
+  - links: link to {instance ip: node ip} mapping
+  - master: (master ip, master node ip), or None
+  - mcs: list of master candidate IPs, or None
+
+The addresses of all the kernel table entries written by ganeti-nld are
+saved too, as a (context, iface) to list of addresses mapping, so that the
+entries left by an earlier run can be removed without touching those written
+by others (see L{table_writer.TableWriter.GetInstalledEntries}).
+
+On disk the instance maps are stored per node, which is much smaller as many
+instances share a node.
+
+"""
+
+
+import logging
+import time
+
+from ganeti import serializer
+from ganeti import utils
+
+
+SNAPSHOT_VERSION = 1
+
+# Seconds to wait for further changes before writing a snapshot
+DEFAULT_WRITE_DELAY = 10
+
+
+def _CompactMap(link_map):
+  """Convert an instance->node map to a node->instances one.
+
+  """
+  nodes = {}
+  for (instance, node) in link_map.iteritems():
+    nodes.setdefault(node, []).append(instance)
+  for instances in nodes.values():
+    instances.sort()
+  return nodes
+
+
+def _ExpandMap(nodes):
+  """Convert a node->instances map back to an instance->node one.
+
+  """
+  link_map = {}
+  for (node, instances) in nodes.iteritems():
+    for instance in instances:
+      link_map[instance] = node
+  return link_map
+
+
+def DumpSnapshot(clusters, installed=None):
+  """Serialize the state of all the clusters.
+
+  @type clusters: dict
+  @param clusters: cluster name to cluster state mapping
+  @type installed: dict
+  @param installed: (context, iface) to list of addresses mapping of the
+      kernel table entries we wrote
+  @rtype: string
+
+  """
+  data = {}
+  for (cluster_name, state) in clusters.iteritems():
+    links = {}
+    for (link, link_map) in state["links"].iteritems():
+      links[link] = _CompactMap(link_map)
+    data[cluster_name] = {
+      "links": links,
+      "master": state["master"],
+      "mcs": state["mcs"],
+      }
+  tables = []
+  if installed:
+    for ((context, iface), addresses) in installed.iteritems():
+      tables.append([context, iface, sorted(addresses)])
+  return serializer.DumpJson({
+    "version": SNAPSHOT_VERSION,
+    "timestamp": time.time(),
+    "clusters": data,
+    "installed": tables,
+    }, indent=False)
+
+
+def LoadSnapshot(file_name):
+  """Load a snapshot file.
+
+  Missing, unreadable or invalid snapshots are ignored, as the whole state
+  is fetched from confd anyway.
+
+  @type file_name: string
+  @param file_name: snapshot file
+  @rtype: tuple
+  @return: cluster name to cluster state mapping, and (context, iface) to
+      list of addresses mapping of the kernel table entries we wrote
+
+  """
+  try:
+    data = serializer.LoadJson(utils.ReadFile(file_name))
+  except EnvironmentError, err:
+    logging.info("Not loading the state snapshot %s: %s", file_name, err)
+    return ({}, {})
+  except ValueError, err:
+    logging.warning("Invalid state snapshot %s: %s", file_name, err)
+    return ({}, {})
+
+  if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+    logging.warning("Unsupported state snapshot %s, ignoring it", file_name)
+    return ({}, {})
+
+  clusters = {}
+  try:
+    for (cluster_name, cluster_data) in data["clusters"].iteritems():
+      links = {}
+      for (link, nodes) in cluster_data["links"].iteritems():
+        links[link] = _ExpandMap(nodes)
+      master = cluster_data["master"]
+      if master is not None:
+        master = tuple(master)
+      clusters[cluster_name] = {
+        "links": links,
+        "master": master,
+        "mcs": cluster_data["mcs"],
+        }
+    # Snapshots written by older versions don't have the installed entries
+    installed = {}
+    for (context, iface, addresses) in data.get("installed", []):
+      installed[(context, iface)] = list(addresses)
+  except (KeyError, TypeError, AttributeError, ValueError), err:
+    logging.warning("Invalid state snapshot %s: %s", file_name, err)
+    return ({}, {})
+
+  logging.info("Loaded state snapshot %s, taken at %s", file_name,
+               time.ctime(data.get("timestamp", 0)))
+  return (clusters, installed)
+
+
+class SnapshotWriter(object):
+  """Write snapshots of the NLD state when it changes.
+
+  """
+  def __init__(self, file_name, scheduler, state_fn,
+               delay=DEFAULT_WRITE_DELAY, installed_fn=None):
+    """Constructor for SnapshotWriter
+
+    @type file_name: string
+    @param file_name: snapshot file
+    @type scheduler: L{daemon.AsyncoreScheduler}
+    @param scheduler: scheduler used to delay the writes
+    @type state_fn: callable
+    @param state_fn: function returning the cluster name to cluster state
+        mapping to be saved
+    @type delay: int
+    @param delay: seconds to wait for further changes before writing
+    @type installed_fn: callable
+    @param installed_fn: function returning the kernel table entries we
+        wrote, see L{DumpSnapshot}
+
+    """
+    self._file_name = file_name
+    self._scheduler = scheduler
+    self._state_fn = state_fn
+    self._installed_fn = installed_fn
+    self._delay = delay
+    self._write_event = None
+
+  def ScheduleWrite(self):
+    """Write a snapshot after the write delay.
+
+    """
+    if self._write_event is None:
+      self._write_event = self._scheduler.enter(self._delay, 1,
+                                                self._WriteExpired, [])
+
+  def _WriteExpired(self):
+    self._write_event = None
+    self.Write()
+
+  def Write(self):
+    """Write a snapshot now.
+
+    The file is replaced atomically, so that a crash never leaves a partial
+    snapshot behind.
+
+    """
+    if self._write_event is not None:
+      self._scheduler.cancel(self._write_event)
+      self._write_event = None
+    installed = None
+    if self._installed_fn is not None:
+      installed = self._installed_fn()
+    try:
+      utils.WriteFile(self._file_name,
+                      data=DumpSnapshot(self._state_fn(), installed=installed),
+                      mode=0600)
+    except EnvironmentError, err:
+      logging.error("Cannot write the state snapshot %s: %s",
+                    self._file_name, err)
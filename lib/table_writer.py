@@ -0,0 +1,457 @@
+#
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Asynchronous Neighbour and Routing table writer
+
+Writing to the kernel tables can take seconds when many entries change at
+once, so it's done by a worker thread instead of the asyncore mainloop. The
+mainloop only records the desired state of each entry; successive changes to
+the same entry are coalesced, and the outcome of each write is reported back
+to the mainloop through a pipe.
+
+The writer also remembers the desired state of all the entries it wrote, so
+that entries changed behind our back can be repaired (see L{RepairEntry}),
+and the entries it wrote but doesn't want anymore, so that they can be told
+apart from the entries written by others (see L{GetLeftoverEntries}).
+Tables can also be dumped from the worker thread (see L{DumpTable}), after
+the entries queued so far are written.
+
+"""
+
+
+import asyncore
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from ganeti_nbma import instancemap
+from ganeti_nbma import networktables
+
+from ganeti import errors as ganeti_errors
+
+
+# Maximum number of distinct entries waiting to be written
+DEFAULT_MAX_PENDING = 65536
+
+# Error reported to the callbacks of updates replaced by a later one with
+# another destination before being written
+ERROR_SUPERSEDED = "superseded by a later update"
+
+# After a failed repair of an entry, its next repair is delayed by this many
+# seconds, doubled after each consecutive failure up to the maximum; after
+# REPAIR_MAX_FAILURES failures the entry isn't repaired anymore, until it's
+# updated again
+REPAIR_RETRY_DELAY = 1
+REPAIR_MAX_RETRY_DELAY = 60
+REPAIR_MAX_FAILURES = 8
+
+
+def _SetNonBlocking(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _AsyncWakeup(asyncore.file_dispatcher):
+  """An asyncore dispatcher running a callback when woken up by a thread.
+
+  """
+  def __init__(self, callback):
+    (self._read_fd, self._write_fd) = os.pipe()
+    _SetNonBlocking(self._write_fd)
+    asyncore.file_dispatcher.__init__(self, self._read_fd)
+    self._callback = callback
+
+  def Wakeup(self):
+    """Wake up the mainloop. Can be called from any thread.
+
+    """
+    try:
+      os.write(self._write_fd, "x")
+    except OSError, err:
+      # A full pipe means a wakeup is pending already
+      if err.errno != errno.EAGAIN:
+        raise
+
+  def handle_read(self):
+    try:
+      self.recv(4096)
+    except (OSError, IOError), err:
+      if err.errno != errno.EAGAIN:
+        raise
+    self._callback()
+
+  # We don't need to check for the pipe to be ready for writing
+  def writable(self):
+    return False
+
+
+class TableWriter(object):
+  """Write Neighbour and Routing table entries from a worker thread.
+
+  """
+  def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+    """Constructor for TableWriter
+
+    @type max_pending: int
+    @param max_pending: maximum number of distinct entries waiting to be
+        written; further updates are rejected until the queue drains
+
+    """
+    self._max_pending = max_pending
+    self._cond = threading.Condition(threading.Lock())
+    # (context, iface, ip address) -> (destination, list of (requested
+    # destination, callback))
+    self._pending = {}
+    self._results = []
+    # (context, iface, callback) of the table dumps to run
+    self._dumps = []
+    self._dump_results = []
+    # (context, iface) -> L{instancemap.InstanceNodeMap} of the destinations
+    # we want, only used by the mainloop
+    self._desired = {}
+    # (context, iface) -> addresses of the entries we wrote and don't want
+    # anymore, which may still be in the kernel table; only used by the
+    # mainloop
+    self._leftovers = {}
+    # (context, iface, ip address) -> (consecutive failures, time before
+    # which the entry isn't repaired again), for the entries whose last
+    # repair failed; only used by the mainloop
+    self._repair_failures = {}
+    self._wakeup = _AsyncWakeup(self._ProcessResults)
+    self._thread = threading.Thread(target=self._Run, name="TableWriter")
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def _Enqueue(self, ip_address, dest_address, context, iface, callback):
+    key = (context, iface, ip_address)
+    self._cond.acquire()
+    try:
+      if key in self._pending:
+        callbacks = self._pending[key][1]
+      elif len(self._pending) >= self._max_pending:
+        logging.warning("Table writer queue full, dropping update for %s"
+                        " [%s %s]", ip_address, context, iface)
+        return False
+      else:
+        callbacks = []
+      if callback is not None:
+        callbacks.append((dest_address, callback))
+      self._pending[key] = (dest_address, callbacks)
+      self._cond.notify()
+    finally:
+      self._cond.release()
+
+    if dest_address is None:
+      table = self._desired.get((context, iface), None)
+      if table is not None and ip_address in table:
+        del table[ip_address]
+        # Until its removal succeeds the entry is still ours
+        self._leftovers.setdefault((context, iface), set()).add(ip_address)
+    else:
+      table = self._desired.setdefault((context, iface),
+                                       instancemap.InstanceNodeMap())
+      table[ip_address] = dest_address
+      self._leftovers.get((context, iface), set()).discard(ip_address)
+    return True
+
+  def UpdateEntry(self, ip_address, dest_address, context, iface,
+                  callback=None):
+    """Queue an update (or addition) of a table entry.
+
+    If an update for the same entry is already queued, it is replaced; the
+    callbacks of the replaced updates are still called once the entry is
+    written, with L{ERROR_SUPERSEDED} as error if they asked for another
+    destination.
+
+    @type ip_address: str
+    @param ip_address: IP address to be updated
+    @type dest_address: str
+    @param dest_address: new destination address
+    @type context: str
+    @param context: one of L{networktables.CONTEXTS}
+    @type iface: str
+    @param iface: network interface to use
+    @type callback: callable
+    @param callback: function called in the mainloop when the entry has been
+        written, with the IP address, the destination address and an error
+        message (None on success) as arguments
+    @rtype: boolean
+    @return: whether the update was queued
+
+    """
+    self._repair_failures.pop((context, iface, ip_address), None)
+    return self._Enqueue(ip_address, dest_address, context, iface, callback)
+
+  def RemoveEntry(self, ip_address, context, iface, callback=None):
+    """Queue the removal of a table entry.
+
+    See L{UpdateEntry} for the meaning of the arguments; the callback
+    receives None as the destination address.
+
+    """
+    self._repair_failures.pop((context, iface, ip_address), None)
+    return self._Enqueue(ip_address, None, context, iface, callback)
+
+  def GetDesiredEntry(self, ip_address, context, iface):
+    """Return the destination we want for an entry.
+
+    @rtype: str
+    @return: the destination address, or None if we don't manage the entry
+
+    """
+    table = self._desired.get((context, iface), None)
+    if table is None:
+      return None
+    return table.get(ip_address, None)
+
+  def GetDesiredTable(self, context, iface):
+    """Return all the entries we want in a table.
+
+    @rtype: dict
+    @return: address to destination mapping
+
+    """
+    return dict(self._desired.get((context, iface), {}).iteritems())
+
+  def GetLeftoverEntries(self, context, iface):
+    """Return the entries we wrote and don't want anymore.
+
+    These are the entries whose removal failed or is still queued, and those
+    restored by L{LoadInstalledEntries} which weren't wanted again; entries
+    written by others are never part of them.
+
+    @rtype: set
+    @return: addresses of the entries
+
+    """
+    return set(self._leftovers.get((context, iface), ()))
+
+  def GetInstalledEntries(self):
+    """Return all the entries we wrote, to be saved in a snapshot.
+
+    @rtype: dict
+    @return: (context, iface) to list of addresses mapping
+
+    """
+    installed = {}
+    for (key, table) in self._desired.iteritems():
+      installed[key] = list(table.iterkeys())
+    for (key, leftovers) in self._leftovers.iteritems():
+      installed.setdefault(key, []).extend(leftovers)
+    return installed
+
+  def LoadInstalledEntries(self, installed):
+    """Restore the entries written by an earlier run.
+
+    The entries we don't want (yet) are remembered as leftovers; those
+    wanted again by L{UpdateEntry} are dropped from them.
+
+    @type installed: dict
+    @param installed: see L{GetInstalledEntries}
+
+    """
+    for ((context, iface), addresses) in installed.iteritems():
+      table = self._desired.get((context, iface), {})
+      leftovers = self._leftovers.setdefault((context, iface), set())
+      for ip_address in addresses:
+        if ip_address not in table:
+          leftovers.add(ip_address)
+
+  def RepairEntry(self, ip_address, context, iface, now=None):
+    """Queue a rewrite of an entry with the destination we want for it.
+
+    Entries whose repairs keep failing are repaired with backoff, and given
+    up after L{REPAIR_MAX_FAILURES} failures, until they're updated again.
+
+    @rtype: boolean
+    @return: whether a rewrite was queued
+
+    """
+    dest_address = self.GetDesiredEntry(ip_address, context, iface)
+    if dest_address is None:
+      return False
+    key = (context, iface, ip_address)
+    if now is None:
+      now = time.time()
+    (failures, next_repair) = self._repair_failures.get(key, (0, now))
+    if failures >= REPAIR_MAX_FAILURES or now < next_repair:
+      return False
+
+    def _Callback(_, requested, error):
+      self._RepairDone(key, requested, error)
+    return self._Enqueue(ip_address, dest_address, context, iface, _Callback)
+
+  def _RepairDone(self, key, dest_address, error):
+    """Account for the outcome of a repair.
+
+    """
+    if error is None or error == ERROR_SUPERSEDED:
+      self._repair_failures.pop(key, None)
+      return
+    failures = self._repair_failures.get(key, (0, None))[0] + 1
+    if failures >= REPAIR_MAX_FAILURES:
+      logging.warning("Giving up repairing %s entry %s on %s (wanted: %s)"
+                      " after %d failures: %s", key[0], key[2], key[1],
+                      dest_address, failures, error)
+    delay = min(REPAIR_RETRY_DELAY * 2 ** (failures - 1),
+                REPAIR_MAX_RETRY_DELAY)
+    self._repair_failures[key] = (failures, time.time() + delay)
+
+  def DumpTable(self, context, iface, callback):
+    """Queue a dump of a table.
+
+    The table is read by the worker thread, once the entries already queued
+    are written.
+
+    @type context: str
+    @param context: one of L{networktables.CONTEXTS}
+    @type iface: str
+    @param iface: network interface to use
+    @type callback: callable
+    @param callback: function called in the mainloop with the address to
+        destination mapping (None on failure) and an error message (None on
+        success) as arguments
+
+    """
+    self._cond.acquire()
+    try:
+      self._dumps.append((context, iface, callback))
+      self._cond.notify()
+    finally:
+      self._cond.release()
+
+  def _Run(self):
+    """Worker thread main loop.
+
+    """
+    while True:
+      self._cond.acquire()
+      try:
+        while not self._pending and not self._dumps:
+          self._cond.wait()
+        batch = self._pending
+        self._pending = {}
+        dumps = self._dumps
+        self._dumps = []
+      finally:
+        self._cond.release()
+
+      try:
+        results = self._WriteBatch(batch)
+      # pylint: disable-msg=W0703
+      except Exception, err:
+        logging.exception("Unexpected error in the table writer")
+        results = [(context, iface, ip_address, dest_address, callbacks,
+                    str(err))
+                   for ((context, iface, ip_address),
+                        (dest_address, callbacks)) in batch.iteritems()]
+      dump_results = [self._Dump(context, iface, callback)
+                      for (context, iface, callback) in dumps]
+
+      self._cond.acquire()
+      try:
+        self._results.extend(results)
+        self._dump_results.extend(dump_results)
+      finally:
+        self._cond.release()
+      self._wakeup.Wakeup()
+
+  # pylint: disable-msg=R0201
+  def _WriteBatch(self, batch):
+    """Write a batch of entries, grouped by table.
+
+    @rtype: list
+    @return: list of (context, iface, ip address, destination, callbacks,
+        error) tuples
+
+    """
+    tables = {}
+    for ((context, iface, ip_address), value) in batch.iteritems():
+      tables.setdefault((context, iface), {})[ip_address] = value
+
+    results = []
+    for ((context, iface), entries) in tables.iteritems():
+      changes = [(ip_address, dest_address)
+                 for (ip_address, (dest_address, _)) in entries.iteritems()]
+      try:
+        failures = dict(networktables.ApplyNetworkChanges(changes, context,
+                                                          iface))
+      except ganeti_errors.CommandError, err:
+        failures = dict([(ip_address, str(err))
+                         for (ip_address, _) in changes])
+      if failures:
+        logging.warning("Failed to write %d of %d entries [%s %s]",
+                        len(failures), len(changes), context, iface)
+      logging.debug("Wrote %d entries [%s %s]",
+                    len(changes) - len(failures), context, iface)
+      for (ip_address, (dest_address, callbacks)) in entries.iteritems():
+        results.append((context, iface, ip_address, dest_address, callbacks,
+                        failures.get(ip_address, None)))
+    return results
+
+  # pylint: disable-msg=R0201
+  def _Dump(self, context, iface, callback):
+    """Dump a table.
+
+    @rtype: tuple
+    @return: (context, iface, callback, table or None, error or None)
+
+    """
+    try:
+      return (context, iface, callback,
+              networktables.GetNetworkTable(context, iface), None)
+    # pylint: disable-msg=W0703
+    except Exception, err:
+      if not isinstance(err, ganeti_errors.CommandError):
+        logging.exception("Unexpected error in the table writer")
+      return (context, iface, callback, None, str(err))
+
+  def _ProcessResults(self):
+    """Report the worker thread results to their callbacks, in the mainloop.
+
+    """
+    self._cond.acquire()
+    try:
+      results = self._results
+      self._results = []
+      dump_results = self._dump_results
+      self._dump_results = []
+    finally:
+      self._cond.release()
+
+    for (context, iface, ip_address, dest_address, callbacks,
+         error) in results:
+      if dest_address is None and error is None:
+        self._leftovers.get((context, iface), set()).discard(ip_address)
+      for (requested, callback) in callbacks:
+        if requested == dest_address:
+          callback(ip_address, dest_address, error)
+        else:
+          callback(ip_address, requested, ERROR_SUPERSEDED)
+    for (context, iface, callback, table, error) in dump_results:
+      # Leftovers which are gone from the kernel are forgotten
+      leftovers = self._leftovers.get((context, iface), None)
+      if table is not None and leftovers:
+        leftovers.intersection_update(table.iterkeys())
+      callback(table, error)
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the confd_peers module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import unittest
+
+from ganeti_nbma import confd_peers
+
+from ganeti import confd
+
+# pylint: disable-msg=W0611
+import ganeti.confd.client
+
+
+class _FakeScheduler(object):
+  def __init__(self):
+    self.events = []
+
+  def enter(self, delay, priority, action, args):
+    event = (delay, priority, action, args)
+    self.events.append(event)
+    return event
+
+  def cancel(self, event):
+    self.events.remove(event)
+
+  def RunAll(self):
+    events = self.events
+    self.events = []
+    for (_, _, action, args) in events:
+      action(*args)
+
+
+class _FakeConfdClient(object):
+  """Records the requests, instead of sending them.
+
+  """
+  def __init__(self, hmac_key, peers, callback, logger=None):
+    # pylint: disable-msg=W0613
+    self.peers = peers
+    self.callback = callback
+    # list of (request, peers)
+    self.sent = []
+
+  def UpdatePeerList(self, peers):
+    self.peers = peers
+
+  def SendRequest(self, request, args=None, coverage=None):
+    # pylint: disable-msg=W0613
+    self.sent.append((request, self.peers[:coverage]))
+
+  def Upcall(self, upcall_type, request, peer=None):
+    up = confd.client.ConfdUpcallPayload(salt=request.rsalt,
+                                         type=upcall_type,
+                                         orig_request=request,
+                                         server_reply=None,
+                                         server_ip=peer,
+                                         server_port=None,
+                                         extra_args=None,
+                                         client=self)
+    self.callback(up)
+
+
+class TestLatencyAwareConfdClient(unittest.TestCase):
+
+  def setUp(self):
+    self._orig_client = confd.client.ConfdClient
+    confd.client.ConfdClient = _FakeConfdClient
+    self._orig_explore = confd_peers.EXPLORE_PROBABILITY
+    confd_peers.EXPLORE_PROBABILITY = 0
+    self.upcalls = []
+    self.scheduler = _FakeScheduler()
+    self.client = confd_peers.LatencyAwareConfdClient(
+      "key", ["10.0.0.1", "10.0.0.2", "10.0.0.3"], self.upcalls.append,
+      self.scheduler, preferred=1)
+    self.raw = self.client._client # pylint: disable-msg=W0212
+
+  def tearDown(self):
+    confd.client.ConfdClient = self._orig_client
+    confd_peers.EXPLORE_PROBABILITY = self._orig_explore
+
+  def testPreferFastPeers(self):
+    stats = self.client._stats # pylint: disable-msg=W0212
+    stats["10.0.0.1"].AddReply(0.5)
+    stats["10.0.0.2"].AddReply(0.01)
+    stats["10.0.0.3"].AddReply(0.01)
+    stats["10.0.0.3"].AddLoss()
+    request = confd.client.ConfdClientRequest(type=1)
+    self.client.SendRequest(request, args="args")
+    self.assertEqual(self.raw.sent, [(request, ["10.0.0.2"])])
+
+    self.raw.Upcall(confd.client.UPCALL_REPLY, request, "10.0.0.2")
+    self.assertEqual(len(self.upcalls), 1)
+    self.assertEqual(self.upcalls[0].extra_args, "args")
+    self.assertTrue(self.upcalls[0].client is self.client)
+    # No hedged copy once answered
+    self.assertEqual(self.scheduler.events, [])
+    self.assertEqual(self.client.GetPeerStats()["10.0.0.2"]["replies"], 2)
+
+  def testHedge(self):
+    request = confd.client.ConfdClientRequest(type=1)
+    self.client.SendRequest(request, args="args")
+    self.scheduler.RunAll()
+    self.assertEqual(len(self.raw.sent), 2)
+    (first, first_peers) = self.raw.sent[0]
+    (hedge, hedge_peers) = self.raw.sent[1]
+    self.assertTrue(first is request)
+    self.assertNotEqual(hedge.rsalt, request.rsalt)
+    self.assertNotEqual(hedge_peers, first_peers)
+
+    # The reply to the copy looks like a reply to the original request
+    self.raw.Upcall(confd.client.UPCALL_REPLY, hedge, hedge_peers[0])
+    self.assertEqual(self.upcalls[-1].salt, request.rsalt)
+    self.assertTrue(self.upcalls[-1].orig_request is request)
+
+    # The request only expires with its last copy, and the unanswered peer
+    # is counted as a loss
+    self.raw.Upcall(confd.client.UPCALL_EXPIRE, request)
+    self.assertEqual(len(self.upcalls), 1)
+    self.raw.Upcall(confd.client.UPCALL_EXPIRE, hedge)
+    self.assertEqual(len(self.upcalls), 2)
+    self.assertEqual(self.upcalls[-1].type, confd.client.UPCALL_EXPIRE)
+    self.assertEqual(self.upcalls[-1].salt, request.rsalt)
+    stats = self.client.GetPeerStats()
+    self.assertEqual(stats[first_peers[0]]["lost"], 1)
+    self.assertEqual(stats[hedge_peers[0]]["lost"], 0)
+
+  def testUpdatePeerList(self):
+    self.client._stats["10.0.0.1"].AddReply(0.1) # pylint: disable-msg=W0212
+    self.client.UpdatePeerList(["10.0.0.1", "10.0.0.4"])
+    stats = self.client.GetPeerStats()
+    self.assertEqual(sorted(stats.keys()), ["10.0.0.1", "10.0.0.4"])
+    self.assertEqual(stats["10.0.0.1"]["rtt"], 0.1)
+    self.assertEqual(stats["10.0.0.4"]["rtt"], None)
+
+
+if __name__ == '__main__':
+  unittest.main()
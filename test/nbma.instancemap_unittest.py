@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the instancemap module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import random
+import unittest
+
+from ganeti_nbma import instancemap
+
+
+class TestInstanceNodeMap(unittest.TestCase):
+
+  def testDictInterface(self):
+    imap = instancemap.InstanceNodeMap({"192.0.2.1": "10.0.0.1"})
+    imap["192.0.2.2"] = "10.0.0.2"
+    imap["2001:db8::1"] = "10.0.0.1"
+    self.assertEqual(len(imap), 3)
+    self.assertEqual(imap["192.0.2.1"], "10.0.0.1")
+    self.assertEqual(imap.get("2001:db8::1"), "10.0.0.1")
+    self.assertEqual(imap.get("192.0.2.3"), None)
+    self.assertEqual(imap.get("192.0.2.3", "x"), "x")
+    self.failUnless("192.0.2.2" in imap)
+    self.failIf("192.0.2.3" in imap)
+    self.assertRaises(KeyError, imap.__getitem__, "192.0.2.3")
+
+    imap["192.0.2.1"] = "10.0.0.3"
+    del imap["192.0.2.2"]
+    del imap["2001:db8::1"]
+    self.assertRaises(KeyError, imap.__delitem__, "192.0.2.2")
+    self.assertEqual(len(imap), 1)
+    self.assertEqual(imap.items(), [("192.0.2.1", "10.0.0.3")])
+
+  def testCompaction(self):
+    expected = {}
+    imap = instancemap.InstanceNodeMap()
+    rnd = random.Random(42)
+    for _ in range(10000):
+      instance = "10.%d.%d.%d" % (rnd.randint(0, 3), rnd.randint(0, 255),
+                                  rnd.randint(0, 255))
+      if instance in expected and rnd.random() < 0.3:
+        del expected[instance]
+        del imap[instance]
+      else:
+        node = "192.168.0.%d" % rnd.randint(1, 20)
+        expected[instance] = node
+        imap[instance] = node
+    self.assertEqual(len(imap), len(expected))
+    self.assertEqual(dict(imap.iteritems()), expected)
+    for (instance, node) in expected.items():
+      self.assertEqual(imap[instance], node)
+    self.assertEqual(imap.copy(), imap)
+
+
+if __name__ == '__main__':
+  unittest.main()
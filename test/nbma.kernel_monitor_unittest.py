@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Script for unittesting the kernel_monitor module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import errno
+import os
+import unittest
+
+from ganeti_nbma import errors
+from ganeti_nbma import kernel_monitor
+from ganeti_nbma import networktables
+from ganeti_nbma import rtnetlink
+
+
+_NEIGH = networktables.NEIGHBOUR_CONTEXT
+_IFINDEX = 7
+
+
+class _FakeSocket(object):
+  """rtnetlink socket stand-in, returning the queued events.
+
+  """
+  def __init__(self, groups=0):
+    (self._read_fd, self._write_fd) = os.pipe()
+    self.events = []
+    self.error = None
+
+  def fileno(self):
+    return self._read_fd
+
+  def close(self):
+    os.close(self._read_fd)
+    os.close(self._write_fd)
+
+  def Receive(self):
+    if self.error is not None:
+      raise self.error
+    events = self.events
+    self.events = []
+    return events
+
+
+class _FakeTableWriter(object):
+  def __init__(self):
+    self.desired = {}
+    self.repairs = []
+
+  def GetDesiredEntry(self, ip_address, context, iface):
+    return self.desired.get(ip_address, None)
+
+  def GetDesiredTable(self, context, iface):
+    if context != _NEIGH:
+      return {}
+    return dict(self.desired)
+
+  def RepairEntry(self, ip_address, context, iface):
+    self.repairs.append(ip_address)
+    return True
+
+
+class TestAsyncKernelTableMonitor(unittest.TestCase):
+
+  def setUp(self):
+    self._saved = (rtnetlink.RtNetlinkSocket, rtnetlink.GetInterfaceIndex,
+                   rtnetlink.DumpNeighbourTable, rtnetlink.DumpRouteTable)
+    self.sockets = []
+    def _NewSocket(groups=0):
+      sock = _FakeSocket(groups=groups)
+      self.sockets.append(sock)
+      return sock
+    rtnetlink.RtNetlinkSocket = _NewSocket
+    rtnetlink.GetInterfaceIndex = lambda iface: _IFINDEX
+    self.kernel = {"192.0.2.1": "10.0.0.1"}
+    rtnetlink.DumpNeighbourTable = lambda sock, ifindex: dict(self.kernel)
+    rtnetlink.DumpRouteTable = lambda sock, ifindex: {}
+    self.writer = _FakeTableWriter()
+    self.writer.desired = {"192.0.2.1": "10.0.0.1"}
+    self.monitor = kernel_monitor.AsyncKernelTableMonitor(["gtun0"],
+                                                          self.writer)
+    # The first socket gets the events, the others are used for dumps
+    self.events = self.sockets[0]
+
+  def tearDown(self):
+    (rtnetlink.RtNetlinkSocket, rtnetlink.GetInterfaceIndex,
+     rtnetlink.DumpNeighbourTable, rtnetlink.DumpRouteTable) = self._saved
+    self.monitor.close()
+    self.events.close()
+
+  def _Event(self, msg_type, ip_address, lladdr=None, ifindex=_IFINDEX):
+    body = rtnetlink.BuildNeighbourMessage(msg_type, ip_address, ifindex,
+                                           lladdr=lladdr)
+    self.events.events.append((msg_type, 0, 0, body))
+
+  def testDrift(self):
+    self.assertEqual(self.writer.repairs, [])
+    self._Event(rtnetlink.RTM_NEWNEIGH, "192.0.2.1", lladdr="10.0.0.1")
+    # Entries we don't manage, or on other interfaces, are left alone
+    self._Event(rtnetlink.RTM_NEWNEIGH, "192.0.2.2", lladdr="10.0.0.1")
+    self._Event(rtnetlink.RTM_DELNEIGH, "192.0.2.1", ifindex=_IFINDEX + 1)
+    self.monitor.handle_read()
+    self.assertEqual(self.writer.repairs, [])
+
+    self._Event(rtnetlink.RTM_NEWNEIGH, "192.0.2.1", lladdr="10.0.0.9")
+    self._Event(rtnetlink.RTM_DELNEIGH, "192.0.2.1")
+    self.monitor.handle_read()
+    self.assertEqual(self.writer.repairs, ["192.0.2.1", "192.0.2.1"])
+    self.assertEqual(self.monitor.GetShadowTable(_NEIGH, "gtun0"),
+                     {"192.0.2.2": "10.0.0.1"})
+
+  def testResync(self):
+    # Events were lost, and the entry was removed meanwhile
+    self.kernel = {}
+    self.events.error = errors.NetlinkError("No buffer space available",
+                                            errno.ENOBUFS)
+    self.monitor.handle_read()
+    self.assertEqual(self.writer.repairs, ["192.0.2.1"])
+    self.assertEqual(self.monitor.GetShadowTable(_NEIGH, "gtun0"), {})
+    # Other errors don't trigger a resync
+    self.events.error = errors.NetlinkError("Interrupted", errno.EINTR)
+    self.monitor.handle_read()
+    self.assertEqual(self.writer.repairs, ["192.0.2.1"])
+
+
+if __name__ == '__main__':
+  unittest.main()
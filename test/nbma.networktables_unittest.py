@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the networktables module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import unittest
+
+from ganeti_nbma import networktables
+
+
+class TestParseNetworkTable(unittest.TestCase):
+
+  def testNeighbours(self):
+    output = ("192.168.42.1 lladdr 172.16.1.1 PERMANENT\n"
+              "\n"
+              "192.168.42.2 lladdr 172.16.1.2 PERMANENT\n"
+              "192.168.42.3  FAILED\n")
+    table = networktables.ParseNetworkTable(output,
+                                            networktables.NEIGHBOUR_CONTEXT)
+    self.assertEquals(table, {
+      "192.168.42.1": "172.16.1.1",
+      "192.168.42.2": "172.16.1.2",
+      "192.168.42.3": None,
+      })
+
+  def testRoutes(self):
+    output = ("192.168.43.0/24  proto kernel  scope link  src 192.168.43.1\n"
+              "192.168.42.5 via 172.16.1.5 \n")
+    table = networktables.ParseNetworkTable(output,
+                                            networktables.ROUTING_CONTEXT)
+    self.assertEquals(table, {
+      "192.168.43.0/24": None,
+      "192.168.42.5": "172.16.1.5",
+      })
+
+  def testEmpty(self):
+    self.assertEquals(networktables.ParseNetworkTable("", "neigh"), {})
+
+
+class TestComputeNetworkTableChanges(unittest.TestCase):
+
+  def setUp(self):
+    self.current = {
+      "192.168.42.1": "172.16.1.1",
+      "192.168.42.2": "172.16.1.2",
+      "192.168.42.3": None,
+      "192.168.42.4": "172.16.1.4",
+      }
+    self.desired = {
+      "192.168.42.1": "172.16.1.1",
+      "192.168.42.2": "172.16.1.3",
+      "192.168.42.3": "172.16.1.3",
+      "192.168.42.5": "172.16.1.5",
+      }
+
+  def testUpToDate(self):
+    self.assertEquals(
+      networktables.ComputeNetworkTableChanges(self.current, self.current,
+                                               prune=True), [])
+
+  def testAddReplace(self):
+    changes = networktables.ComputeNetworkTableChanges(self.current,
+                                                       self.desired)
+    self.assertEquals(changes, [
+      ("192.168.42.2", "172.16.1.3"),
+      ("192.168.42.3", "172.16.1.3"),
+      ("192.168.42.5", "172.16.1.5"),
+      ])
+
+  def testPrune(self):
+    changes = networktables.ComputeNetworkTableChanges(self.current,
+                                                       self.desired,
+                                                       prune=True)
+    self.assert_(("192.168.42.4", None) in changes)
+    self.assertEquals(len(changes), 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,540 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the nld_confd module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import unittest
+
+from ganeti_nbma import nld_confd
+
+from ganeti import confd
+from ganeti import constants as gnt_constants
+from ganeti import objects
+
+# pylint: disable-msg=W0611
+import ganeti.confd.client
+
+
+_CLUSTER = "cluster"
+_LINK = "br0"
+_TUNNEL = "gtun0"
+
+
+class _FakeConfig(object):
+  def __init__(self):
+    self.clusters = {
+      _CLUSTER: {
+        "master_neighbour_interface": _TUNNEL,
+        "mc_list_update": False,
+        "mapping_pipeline_depth": 2,
+        "update_min_interval": 2,
+        "update_max_interval": 600,
+        },
+      }
+    self.tables_tunnels = {_LINK: _TUNNEL}
+
+
+class _FakePeerManager(object):
+  def RegisterPeerSet(self, name):
+    pass
+
+
+class _FakeTableWriter(object):
+  """Table writer stand-in, writing to a single kernel table at once.
+
+  """
+  def __init__(self):
+    self.updates = []
+    # The kernel table, including the entries written by others
+    self.table = {}
+    self.desired = {}
+    self.leftovers = set()
+
+  def UpdateEntry(self, ip_address, dest_address, context, iface,
+                  callback=None):
+    self.updates.append((ip_address, dest_address, callback))
+    self.table[ip_address] = dest_address
+    self.desired[ip_address] = dest_address
+    self.leftovers.discard(ip_address)
+    return True
+
+  def RemoveEntry(self, ip_address, context, iface, callback=None):
+    self.updates.append((ip_address, None, callback))
+    self.table.pop(ip_address, None)
+    self.desired.pop(ip_address, None)
+    self.leftovers.discard(ip_address)
+    return True
+
+  def GetDesiredTable(self, context, iface):
+    return dict(self.desired)
+
+  def GetLeftoverEntries(self, context, iface):
+    return set(self.leftovers)
+
+  def DumpTable(self, context, iface, callback):
+    callback(dict(self.table), None)
+
+
+class _FakeScheduler(object):
+  def __init__(self):
+    self.events = []
+
+  def enter(self, delay, priority, action, args):
+    event = (delay, priority, action, args)
+    self.events.append(event)
+    return event
+
+  def cancel(self, event):
+    self.events.remove(event)
+
+
+class _FakeMainloop(object):
+  def __init__(self):
+    self.scheduler = _FakeScheduler()
+
+
+class _FakeConfdClient(object):
+  """Records the requests, instead of sending them.
+
+  """
+  def __init__(self, hmac_key, peers, callback, logger=None):
+    # pylint: disable-msg=W0613
+    self.sent = []
+
+  def UpdatePeerList(self, peers):
+    pass
+
+  def SendRequest(self, request, args=None, coverage=None):
+    # pylint: disable-msg=W0613
+    self.sent.append(request)
+
+
+class _FakeConfd(object):
+  """Local confd stand-in, answering the requests sent by the callback.
+
+  """
+  def __init__(self, callback):
+    self.callback = callback
+    self.sent = []
+    self.serial = 1
+    # instance ip -> node ip
+    self.instances = {}
+    # rsalts of the requests to lose
+    self.lost = set()
+    self.max_mapping_queries = 0
+    self.mcs = ["10.0.0.1"]
+    self.peers = None
+
+  def SendRequest(self, request, args=None):
+    self.sent.append((request, args))
+    in_flight = [req for (req, _) in self.sent
+                 if req.type == gnt_constants.CONFD_REQ_NODE_PIP_BY_INSTANCE_IP]
+    self.max_mapping_queries = max(self.max_mapping_queries, len(in_flight))
+
+  def UpdatePeerList(self, peers):
+    self.peers = peers
+
+  def _Reply(self, request, args, answer):
+    reply = objects.ConfdReply(protocol=1,
+                               status=gnt_constants.CONFD_REPL_STATUS_OK,
+                               answer=answer, serial=self.serial)
+    up = confd.client.ConfdUpcallPayload(salt=request.rsalt,
+                                         type=confd.client.UPCALL_REPLY,
+                                         orig_request=request,
+                                         server_reply=reply,
+                                         server_ip="127.0.0.1",
+                                         server_port=1814,
+                                         extra_args=args,
+                                         client=self)
+    self.callback(up)
+
+  def _Expire(self, request, args):
+    up = confd.client.ConfdUpcallPayload(salt=request.rsalt,
+                                         type=confd.client.UPCALL_EXPIRE,
+                                         orig_request=request,
+                                         extra_args=args,
+                                         client=self)
+    self.callback(up)
+
+  def AnswerAll(self):
+    """Answer the outstanding requests, and those they trigger.
+
+    """
+    while self.sent:
+      (request, args) = self.sent.pop(0)
+      if request.rsalt in self.lost:
+        self._Expire(request, args)
+        continue
+      if request.type == gnt_constants.CONFD_REQ_INSTANCES_IPS_LIST:
+        answer = sorted(self.instances.keys())
+      elif request.type == gnt_constants.CONFD_REQ_MC_PIP_LIST:
+        answer = self.mcs
+      else:
+        iplist = request.query[gnt_constants.CONFD_REQQ_IPLIST]
+        answer = []
+        for ip in iplist:
+          if ip in self.instances:
+            answer.append((gnt_constants.CONFD_REPL_STATUS_OK,
+                           self.instances[ip]))
+          else:
+            answer.append((gnt_constants.CONFD_REPL_STATUS_ERROR,
+                           gnt_constants.CONFD_ERROR_UNKNOWN_ENTRY))
+      self._Reply(request, args, answer)
+
+  def Refresh(self):
+    request = confd.client.ConfdClientRequest(
+      type=gnt_constants.CONFD_REQ_INSTANCES_IPS_LIST, query=_LINK)
+    self.sent.append((request, None))
+    self.AnswerAll()
+
+
+class TestNLDConfdCallback(unittest.TestCase):
+
+  def setUp(self):
+    self.writer = _FakeTableWriter()
+    self.callback = nld_confd.NLDConfdCallback(_CLUSTER, _FakeConfig(),
+                                               _FakePeerManager(), {},
+                                               self.writer)
+    self.confd = _FakeConfd(self.callback)
+    self.confd.instances = {
+      "192.0.2.1": "10.0.0.1",
+      "192.0.2.2": "10.0.0.2",
+      }
+
+  def _CountMappingQueries(self):
+    self.requests = []
+    orig_send = self.confd.SendRequest
+    def _Record(request, args=None):
+      if request.type == gnt_constants.CONFD_REQ_NODE_PIP_BY_INSTANCE_IP:
+        self.requests.append(request)
+      orig_send(request, args=args)
+    self.confd.SendRequest = _Record
+
+  def testUnchangedSerial(self):
+    self._CountMappingQueries()
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 1)
+    self.assertEqual(len(self.writer.updates), 2)
+    self.confd.Refresh()
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 1)
+
+  def testSerialChange(self):
+    self._CountMappingQueries()
+    self.confd.Refresh()
+    self.confd.instances["192.0.2.2"] = "10.0.0.3"
+    self.confd.serial += 1
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 2)
+    self.assertEqual(self.writer.updates[-1][:2], ("192.0.2.2", "10.0.0.3"))
+
+  def testMCListChange(self):
+    self._CountMappingQueries()
+    self.confd.Refresh()
+    request = confd.client.ConfdClientRequest(
+      type=gnt_constants.CONFD_REQ_MC_PIP_LIST)
+    self.confd.sent.append((request, None))
+    self.confd.AnswerAll()
+    self.assertEqual(self.confd.peers, ["10.0.0.1"])
+    # The instance map is fully fetched again, despite the unchanged serial
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 2)
+    self.confd.sent.append((request, None))
+    self.confd.AnswerAll()
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 2)
+
+  def testWriteFailure(self):
+    self._CountMappingQueries()
+    self.confd.Refresh()
+    (ip_address, dest_address, callback) = self.writer.updates[0]
+    callback(ip_address, dest_address, "failed")
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 2)
+    self.assertEqual(self.writer.updates[-1][:2], (ip_address, dest_address))
+
+  def testChunks(self):
+    saved_size = nld_confd.MAPPING_QUERY_MAX_SIZE
+    nld_confd.MAPPING_QUERY_MAX_SIZE = \
+      3 * (len("192.0.2.10") + nld_confd.MAPPING_QUERY_ENTRY_OVERHEAD)
+    try:
+      self.confd.instances = {}
+      for i in range(10, 20):
+        self.confd.instances["192.0.2.%d" % i] = "10.0.0.%d" % i
+      self._CountMappingQueries()
+      lose = []
+      orig_send = self.confd.SendRequest
+      def _LoseFirst(request, args=None):
+        if not lose and request.query != _LINK:
+          lose.append(request.query[gnt_constants.CONFD_REQQ_IPLIST])
+          self.confd.lost.add(request.rsalt)
+        orig_send(request, args=args)
+      self.confd.SendRequest = _LoseFirst
+      self.confd.Refresh()
+    finally:
+      nld_confd.MAPPING_QUERY_MAX_SIZE = saved_size
+
+    self.assertEqual(len(self.requests), 4)
+    self.assertEqual(self.confd.max_mapping_queries, 2)
+    written = [ip_address for (ip_address, _, _) in self.writer.updates]
+    self.assertEqual(len(written), 7)
+    for ip_address in lose[0]:
+      self.failIf(ip_address in written)
+
+    # Only the lost chunk is fetched again
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 5)
+    self.assertEqual(self.requests[-1].query[gnt_constants.CONFD_REQQ_IPLIST],
+                     lose[0])
+    self.assertEqual(len(self.writer.updates), 10)
+    self.confd.Refresh()
+    self.assertEqual(len(self.requests), 5)
+
+  def _Lookup(self, ip):
+    done = []
+    lookup = nld_confd.InstanceLookup(_LINK, ip, done.append)
+    request = confd.client.ConfdClientRequest(
+      type=gnt_constants.CONFD_REQ_NODE_PIP_BY_INSTANCE_IP,
+      query={gnt_constants.CONFD_REQQ_IPLIST: [ip],
+             gnt_constants.CONFD_REQQ_LINK: _LINK})
+    lookup.rsalt = request.rsalt
+    self.confd.sent.append((request, lookup))
+    self.confd.AnswerAll()
+    self.assertEqual(done, [lookup])
+    return lookup
+
+  def testForgetInstance(self):
+    self.confd.Refresh()
+    # An instance still known is written again
+    self.callback.ForgetInstance(_LINK, "192.0.2.1")
+    self.failUnless(self._Lookup("192.0.2.1").found)
+    self.assertEqual(self.writer.updates[-1][:2], ("192.0.2.1", "10.0.0.1"))
+    # The entry of an instance which disappeared is removed
+    del self.confd.instances["192.0.2.2"]
+    self.callback.ForgetInstance(_LINK, "192.0.2.2")
+    self.failIf(self._Lookup("192.0.2.2").found)
+    self.assertEqual(self.writer.updates[-1][:2], ("192.0.2.2", None))
+    # ... only once
+    updates = len(self.writer.updates)
+    self._Lookup("192.0.2.2")
+    self.assertEqual(len(self.writer.updates), updates)
+
+  def testSweep(self):
+    self.confd.Refresh()
+    del self.confd.instances["192.0.2.2"]
+    for _ in range(nld_confd.STALE_ENTRY_GRACE_GENERATIONS):
+      self.confd.Refresh()
+    # Missing from enough replies, but not for long enough
+    self.failUnless("192.0.2.2" in self.writer.table)
+    saved_period = nld_confd.STALE_ENTRY_GRACE_PERIOD
+    nld_confd.STALE_ENTRY_GRACE_PERIOD = 0
+    try:
+      self.confd.instances["192.0.2.2"] = "10.0.0.2"
+      self.confd.Refresh()
+      del self.confd.instances["192.0.2.2"]
+      for _ in range(nld_confd.STALE_ENTRY_GRACE_GENERATIONS - 1):
+        self.confd.Refresh()
+      self.failUnless("192.0.2.2" in self.writer.table)
+      self.confd.Refresh()
+    finally:
+      nld_confd.STALE_ENTRY_GRACE_PERIOD = saved_period
+    self.failIf("192.0.2.2" in self.writer.table)
+    self.failUnless("192.0.2.1" in self.writer.table)
+
+  def testReconcile(self):
+    reconciler = nld_confd.KernelTableReconciler(_FakeConfig(), self.writer)
+    self.callback = nld_confd.NLDConfdCallback(_CLUSTER, _FakeConfig(),
+                                               _FakePeerManager(), {},
+                                               self.writer,
+                                               reconciler=reconciler)
+    self.confd.callback = self.callback
+    # An entry left by an earlier run, which no cluster wants
+    self.writer.table["198.51.100.1"] = "10.0.0.9"
+    self.writer.leftovers.add("198.51.100.1")
+    # The endpoint entry set up by gre_setup, which we didn't write
+    self.writer.table["192.0.2.254"] = "203.0.113.1"
+    # Clusters which didn't refresh the link hold the reconciliation
+    reconciler.RegisterCluster("other")
+    saved_period = nld_confd.STALE_ENTRY_GRACE_PERIOD
+    nld_confd.STALE_ENTRY_GRACE_PERIOD = 0
+    try:
+      for _ in range(nld_confd.STALE_ENTRY_GRACE_GENERATIONS):
+        self.confd.Refresh()
+      self.failUnless("198.51.100.1" in self.writer.table)
+      for _ in range(nld_confd.STALE_ENTRY_GRACE_GENERATIONS - 1):
+        reconciler.LinkRefreshed("other", _LINK)
+        self.confd.Refresh()
+        self.failUnless("198.51.100.1" in self.writer.table)
+      reconciler.LinkRefreshed("other", _LINK)
+    finally:
+      nld_confd.STALE_ENTRY_GRACE_PERIOD = saved_period
+    self.failIf("198.51.100.1" in self.writer.table)
+    self.assertEqual(sorted(self.writer.table.keys()),
+                     ["192.0.2.1", "192.0.2.2", "192.0.2.254"])
+    self.assertEqual(self.writer.table["192.0.2.254"], "203.0.113.1")
+
+  def testChunkInstances(self):
+    iplist = ["192.0.2.%d" % i for i in range(100)]
+    chunks = nld_confd.ChunkInstances(iplist, max_size=1000)
+    self.assertEqual(sum(chunks, []), iplist)
+    for chunk in chunks:
+      size = sum([len(ip) + nld_confd.MAPPING_QUERY_ENTRY_OVERHEAD
+                  for ip in chunk])
+      self.failUnless(size <= 1000)
+    self.assertEqual(nld_confd.ChunkInstances([]), [])
+
+  def testRefreshCycle(self):
+    done = []
+    cycle = nld_confd.InstanceRefreshCycle([_LINK], done.append)
+    request = confd.client.ConfdClientRequest(
+      type=gnt_constants.CONFD_REQ_INSTANCES_IPS_LIST, query=_LINK)
+    cycle.SetRequest(_LINK, request.rsalt)
+    self.confd.sent.append((request, cycle))
+    self.confd.AnswerAll()
+    self.assertEqual(done, [cycle])
+    self.assertEqual(cycle.failed_links, [])
+
+    # A cycle with an unchanged serial completes without a mapping query
+    cycle = nld_confd.InstanceRefreshCycle([_LINK], done.append)
+    request = confd.client.ConfdClientRequest(
+      type=gnt_constants.CONFD_REQ_INSTANCES_IPS_LIST, query=_LINK)
+    cycle.SetRequest(_LINK, request.rsalt)
+    self.confd.sent.append((request, cycle))
+    self.confd.AnswerAll()
+    self.assertEqual(done[-1], cycle)
+
+
+class TestNLDPeriodicUpdater(unittest.TestCase):
+
+  def setUp(self):
+    self._orig_client = confd.client.ConfdClient
+    confd.client.ConfdClient = _FakeConfdClient
+
+  def tearDown(self):
+    confd.client.ConfdClient = self._orig_client
+
+  def _NewUpdater(self, startup_delay):
+    mainloop = _FakeMainloop()
+    updater = nld_confd.NLDPeriodicUpdater(_CLUSTER, mainloop, _FakeConfig(),
+                                           "key", ["10.0.0.1"],
+                                           _FakePeerManager(), {},
+                                           _FakeTableWriter(),
+                                           startup_delay=startup_delay)
+    return (updater, mainloop.scheduler)
+
+  def testStartupDelay(self):
+    stagger = nld_confd.CLUSTER_STARTUP_STAGGER
+    for index in range(3):
+      (_, scheduler) = self._NewUpdater(index * stagger)
+      self.assertEqual(len(scheduler.events), 4)
+      for (delay, _, _, _) in scheduler.events:
+        self.failUnless(index * stagger <= delay <=
+                        index * stagger + nld_confd.STARTUP_JITTER)
+
+  def testIntervals(self):
+    (updater, scheduler) = self._NewUpdater(0)
+    intervals = updater.GetIntervals()
+    self.assertEqual(intervals[nld_confd.UPDATE_INSTANCES],
+                     nld_confd.INSTANCE_MAP_UPDATE_TIMEOUT)
+    self.assertEqual(intervals[nld_confd.UPDATE_MCS],
+                     nld_confd.MC_LIST_UPDATE_TIMEOUT)
+    # Updates without changes back off
+    # pylint: disable-msg=W0212
+    updater._UpdateDone(nld_confd.UPDATE_INSTANCES, False)
+    self.assertEqual(updater.GetIntervals()[nld_confd.UPDATE_INSTANCES],
+                     nld_confd.INSTANCE_MAP_UPDATE_TIMEOUT *
+                     nld_confd.UPDATE_BACKOFF_FACTOR)
+    # Running an update schedules the next one at the current interval
+    for event in scheduler.events[:]:
+      (_, _, action, args) = event
+      if args == [nld_confd.UPDATE_MCS]:
+        scheduler.events.remove(event)
+        action(*args)
+    delays = [delay for (delay, _, _, args) in scheduler.events
+              if args == [nld_confd.UPDATE_MCS]]
+    self.assertEqual(len(delays), 1)
+    self.failUnless(delays[0] >= nld_confd.MC_LIST_UPDATE_TIMEOUT *
+                    (1 - nld_confd.UPDATE_JITTER))
+
+
+class TestAdaptiveInterval(unittest.TestCase):
+
+  def testBackoff(self):
+    interval = nld_confd.AdaptiveInterval(5, 2, 600)
+    self.assertEqual(interval.GetInterval(), 5)
+    for _ in range(10):
+      interval.Backoff()
+    self.assertEqual(interval.GetInterval(), 5 * nld_confd.UPDATE_MAX_BACKOFF)
+    interval.Reset()
+    self.assertEqual(interval.GetInterval(), 5)
+    interval.Tighten()
+    self.assertEqual(interval.GetInterval(), 2)
+    interval.Backoff()
+    self.assertEqual(interval.GetInterval(), 4)
+
+  def testBounds(self):
+    interval = nld_confd.AdaptiveInterval(30, 40, 100)
+    self.assertEqual(interval.GetInterval(), 40)
+    for _ in range(10):
+      interval.Backoff()
+    self.assertEqual(interval.GetInterval(), 100)
+    delay = interval.GetDelay()
+    self.failUnless(100 * (1 - nld_confd.UPDATE_JITTER) <= delay <=
+                    100 * (1 + nld_confd.UPDATE_JITTER))
+
+
+class TestNegativeLookupCache(unittest.TestCase):
+
+  def testExpiry(self):
+    cache = nld_confd.NegativeLookupCache(ttl=10, max_size=100)
+    cache.Add("a", now=100)
+    self.failUnless(cache.Lookup("a", now=105))
+    self.failIf(cache.Lookup("a", now=110))
+    self.failIf(cache.Lookup("b", now=105))
+    self.assertEqual(cache.GetStats(), {"hits": 1, "misses": 2, "size": 1})
+    cache.Add("b", now=120)
+    self.assertEqual(cache.GetStats()["size"], 1)
+
+  def testSize(self):
+    cache = nld_confd.NegativeLookupCache(ttl=10, max_size=2)
+    cache.Add("a", now=100)
+    cache.Add("b", now=101)
+    cache.Add("a", now=102)
+    cache.Add("c", now=103)
+    self.failIf(cache.Contains("b", now=104))
+    self.failUnless(cache.Contains("a", now=104))
+    self.failUnless(cache.Contains("c", now=104))
+
+  def testSerial(self):
+    cache = nld_confd.NegativeLookupCache()
+    cache.SetSerial(1)
+    cache.Add("a")
+    cache.SetSerial(1)
+    self.failUnless(cache.Contains("a"))
+    cache.SetSerial(2)
+    self.failIf(cache.Contains("a"))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,403 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the nld_nld module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import time
+import unittest
+
+from ganeti_nbma import constants
+from ganeti_nbma import errors
+from ganeti_nbma import nld_nld
+
+from ganeti import serializer
+
+
+class _FakeUpdater(object):
+  def __init__(self):
+    self.invalidated = []
+    self.misroutes = 0
+
+  def InvalidateInstances(self, ips, link=None):
+    self.invalidated.append((ips, link))
+
+  def ReportMisroute(self):
+    self.misroutes += 1
+
+
+class _FakeScheduler(object):
+  def __init__(self):
+    self.events = []
+
+  def enter(self, delay, priority, action, args):
+    event = (delay, priority, action, args)
+    self.events.append(event)
+    return event
+
+  def cancel(self, event):
+    self.events.remove(event)
+
+  def RunAll(self):
+    events = self.events
+    self.events = []
+    for (_, _, action, args) in events:
+      action(*args)
+
+
+class TestUnpackEnvelope(unittest.TestCase):
+
+  def setUp(self):
+    self.keys = {"cluster1": "key1"}
+
+  def _Pack(self, salt, key="key1", cluster="cluster1"):
+    request = nld_nld.NLDClientRequest(type=constants.NLD_REQ_PING,
+                                       cluster=cluster)
+    return nld_nld.PackMagic(serializer.DumpSignedJson(request.ToDict(), key,
+                                                       salt,
+                                                       key_selector=cluster))
+
+  def _Unpack(self, payload):
+    return nld_nld.UnpackEnvelope(payload, self.keys, nld_nld.CheckTimestamp)
+
+  def testValid(self):
+    salt = "%d" % time.time()
+    envelope = self._Unpack(self._Pack(salt))
+    self.assertEqual(envelope.salt, salt)
+    self.assertEqual(envelope.cluster, "cluster1")
+    self.assertEqual(envelope.message["type"], constants.NLD_REQ_PING)
+
+  def testInvalid(self):
+    now = "%d" % time.time()
+    stale = "%d" % (time.time() - 2 * constants.NLD_MAX_CLOCK_SKEW)
+    for payload in ["", "junk", nld_nld.PackMagic("{"),
+                    nld_nld.PackMagic("x" * 200),
+                    nld_nld.PackMagic("[]"),
+                    nld_nld.PackMagic('{"msg": 1, "salt": "", "hmac": ""}'),
+                    self._Pack(now, cluster="cluster2"),
+                    self._Pack(now, key="key2"),
+                    self._Pack(stale)]:
+      self.assertRaises(errors.NLDDecodeError, self._Unpack, payload)
+
+
+class TestNLDRequestProcessor(unittest.TestCase):
+
+  def setUp(self):
+    self.updaters = {
+      "cluster1": _FakeUpdater(),
+      "cluster2": _FakeUpdater(),
+      }
+    self.processor = nld_nld.NLDRequestProcessor({"cluster1": "key1",
+                                                  "cluster2": "key2"},
+                                                 self.updaters)
+
+  def _Process(self, query, cluster):
+    request = nld_nld.NLDClientRequest(
+      type=constants.NLD_REQ_ROUTE_INVALIDATE, query=query, cluster=cluster)
+    (reply, _) = self.processor.ProcessRequest(request)
+    return reply.status
+
+  def testTargetedInvalidation(self):
+    query = {
+      constants.NLD_REQQ_IPLIST: ["192.0.2.1"],
+      constants.NLD_REQQ_LINK: "br0",
+      }
+    self.assertEqual(self._Process(query, "cluster1"),
+                     constants.NLD_REPL_STATUS_OK)
+    self.assertEqual(self.updaters["cluster1"].invalidated,
+                     [(["192.0.2.1"], "br0")])
+    self.assertEqual(self.updaters["cluster2"].invalidated, [])
+    self.assertEqual(self.updaters["cluster1"].misroutes, 0)
+
+  def testUnknownCluster(self):
+    query = {constants.NLD_REQQ_IPLIST: ["192.0.2.1"]}
+    self.assertEqual(self._Process(query, "default"),
+                     constants.NLD_REPL_STATUS_OK)
+    for updater in self.updaters.values():
+      self.assertEqual(updater.invalidated, [(["192.0.2.1"], None)])
+
+  def testOldSender(self):
+    self.assertEqual(self._Process("192.0.2.1", "cluster1"),
+                     constants.NLD_REPL_STATUS_OK)
+    for updater in self.updaters.values():
+      self.assertEqual(updater.misroutes, 1)
+      self.assertEqual(updater.invalidated, [])
+
+  def testBatch(self):
+    query = [
+      {constants.NLD_REQQ_IPLIST: ["192.0.2.1", "192.0.2.2"],
+       constants.NLD_REQQ_LINK: "br0"},
+      {constants.NLD_REQQ_IPLIST: ["192.0.2.3"]},
+      ]
+    request = nld_nld.NLDClientRequest(
+      type=constants.NLD_REQ_ROUTE_INVALIDATE_BATCH, query=query,
+      cluster="cluster2")
+    (reply, _) = self.processor.ProcessRequest(request)
+    self.assertEqual(reply.status, constants.NLD_REPL_STATUS_OK)
+    self.assertEqual(self.updaters["cluster2"].invalidated,
+                     [(["192.0.2.1", "192.0.2.2"], "br0"),
+                      (["192.0.2.3"], None)])
+
+  def testInvalidQuery(self):
+    for query in [{constants.NLD_REQQ_LINK: "br0"},
+                  {constants.NLD_REQQ_IPLIST: ["192.0.2.1", 1]},
+                  {constants.NLD_REQQ_IPLIST: [["192.0.2.1"]]},
+                  {constants.NLD_REQQ_IPLIST: ["192.0.2.1"],
+                   constants.NLD_REQQ_LINK: ["br0"]},
+                  {constants.NLD_REQQ_IPLIST: ["192.0.2.1"],
+                   constants.NLD_REQQ_LINK: {}}]:
+      self.assertEqual(self._Process(query, "cluster1"),
+                       constants.NLD_REPL_STATUS_ERROR)
+      request = nld_nld.NLDClientRequest(
+        type=constants.NLD_REQ_ROUTE_INVALIDATE_BATCH, query=[query],
+        cluster="cluster1")
+      (reply, _) = self.processor.ProcessRequest(request)
+      self.assertEqual(reply.status, constants.NLD_REPL_STATUS_ERROR)
+    for updater in self.updaters.values():
+      self.assertEqual(updater.invalidated, [])
+
+  def testMalformedRequest(self):
+    request = nld_nld.NLDClientRequest(
+      type=constants.NLD_REQ_PING, cluster="cluster1")
+    for (name, value) in [("type", "0"), ("type", [0]), ("protocol", [1]),
+                          ("rsalt", ["x"]), ("rsalt", 1)]:
+      message = request.ToDict()
+      message[name] = value
+      datagram = nld_nld.PackMagic(serializer.DumpSignedJson(
+        message, "key1", "%d" % time.time(), key_selector="cluster1"))
+      envelope = nld_nld.UnpackEnvelope(datagram, self.processor.cluster_keys,
+                                        nld_nld.CheckTimestamp)
+      self.assertEqual(self.processor.ExecQuery(envelope, "127.0.0.1", 0),
+                       None)
+
+  def _Exec(self, ip):
+    request = nld_nld.NLDClientRequest(
+      type=constants.NLD_REQ_ROUTE_INVALIDATE, cluster="cluster1",
+      query={constants.NLD_REQQ_IPLIST: [ip]})
+    datagram = nld_nld.PackMagic(serializer.DumpSignedJson(
+      request.ToDict(), "key1", "%d" % time.time(), key_selector="cluster1"))
+    return lambda: self.processor.ExecQuery(
+      nld_nld.UnpackEnvelope(datagram, self.processor.cluster_keys,
+                             nld_nld.CheckTimestamp), "127.0.0.1", 0)
+
+  def testReplay(self):
+    self.processor = nld_nld.NLDRequestProcessor(self.processor.cluster_keys,
+                                                 self.updaters,
+                                                 reply_cache_size=1)
+    first = self._Exec("192.0.2.1")
+    reply = first()
+    # A replayed request gets the same reply, without being processed again
+    self.assertEqual(first(), reply)
+    self.assertEqual(self.updaters["cluster1"].invalidated,
+                     [(["192.0.2.1"], None)])
+    # The cache is bounded
+    self._Exec("192.0.2.2")()
+    first()
+    self.assertEqual(len(self.updaters["cluster1"].invalidated), 3)
+
+
+class TestBuildRouteInvalidateBatches(unittest.TestCase):
+
+  def testPacking(self):
+    ips = ["10.%d.%d.%d" % (i >> 16, (i >> 8) & 255, i & 255)
+           for i in range(10000)]
+    links = {
+      "br0": set(ips[:6000]),
+      None: set(ips[6000:]),
+      }
+    max_size = 16384
+    queries = nld_nld.BuildRouteInvalidateBatches(links, max_size)
+    self.assertTrue(len(queries) > 1)
+    found = {}
+    for query in queries:
+      request = nld_nld.NLDClientRequest(
+        type=constants.NLD_REQ_ROUTE_INVALIDATE_BATCH, query=query,
+        cluster="cluster1")
+      payload = serializer.DumpSignedJson(request.ToDict(), "key",
+                                          "1234567890",
+                                          key_selector="cluster1")
+      self.assertTrue(len(nld_nld.PackMagic(payload)) <= max_size)
+      for entry in query:
+        link = entry.get(constants.NLD_REQQ_LINK, None)
+        found.setdefault(link, set()).update(entry[constants.NLD_REQQ_IPLIST])
+    self.assertEqual(found, links)
+
+
+class _TestServer(nld_nld.NLDAsyncUDPServer):
+  """Records the datagrams, instead of sending them.
+
+  """
+  def __init__(self, *args, **kwargs):
+    nld_nld.NLDAsyncUDPServer.__init__(self, *args, **kwargs)
+    self.sent = []
+
+  def enqueue_send(self, ip, port, payload):
+    self.sent.append(payload)
+
+
+class TestNLDAsyncUDPServer(unittest.TestCase):
+
+  def setUp(self):
+    self.keys = {"cluster1": "key1"}
+    self.processor = nld_nld.NLDRequestProcessor(self.keys, {})
+    self.upcalls = []
+    self.scheduler = _FakeScheduler()
+    self.server = _TestServer("127.0.0.1", 0, self.processor,
+                              self.upcalls.append, self.keys, self.scheduler,
+                              max_requests=3)
+    self._orig_timeout = constants.NLD_CLIENT_EXPIRE_TIMEOUT
+    self._orig_retry_timeout = constants.NLD_CLIENT_RETRY_TIMEOUT
+
+  def tearDown(self):
+    constants.NLD_CLIENT_EXPIRE_TIMEOUT = self._orig_timeout
+    constants.NLD_CLIENT_RETRY_TIMEOUT = self._orig_retry_timeout
+    self.server.close()
+
+  def _Send(self):
+    request = nld_nld.NLDClientRequest(type=constants.NLD_REQ_PING)
+    self.server.SendRequest(request, "cluster1", "127.0.0.1")
+    return request
+
+  def _Answer(self, datagram):
+    """Answer a datagram sent by the server, as a peer would.
+
+    """
+    envelope = nld_nld.UnpackEnvelope(datagram, self.keys,
+                                      nld_nld.CheckTimestamp)
+    reply = self.processor.ExecQuery(envelope, "127.0.0.1", 0)
+    self.server.handle_datagram(reply, "127.0.0.1", 0)
+
+  def testReply(self):
+    request = self._Send()
+    # The first request to a peer comes with a version probe
+    self.assertEqual(len(self.server.sent), 2)
+    self._Answer(self.server.sent[1])
+    self.assertEqual(len(self.upcalls), 1)
+    self.assertEqual(self.upcalls[0].type, nld_nld.UPCALL_REPLY)
+    self.assertTrue(self.upcalls[0].orig_request is request)
+    # Answered requests don't expire
+    constants.NLD_CLIENT_EXPIRE_TIMEOUT = -1
+    self.scheduler.RunAll()
+    self.assertFalse(request in [up.orig_request for up in self.upcalls
+                                 if up.type == nld_nld.UPCALL_EXPIRE])
+
+  def testExpireAndCap(self):
+    constants.NLD_CLIENT_EXPIRE_TIMEOUT = -1
+    first = self._Send()
+    self._Send()
+    self.assertRaises(errors.NLDClientError, self._Send)
+    # Expiry is driven by the scheduler alone
+    self.assertEqual(len(self.scheduler.events), 1)
+    self.scheduler.RunAll()
+    self.assertEqual([up.type for up in self.upcalls],
+                     [nld_nld.UPCALL_EXPIRE] * 3)
+    self.assertTrue(first in [up.orig_request for up in self.upcalls])
+    self._Send()
+
+  def testRetransmit(self):
+    constants.NLD_CLIENT_RETRY_TIMEOUT = -1
+    self._Send()
+    self.assertEqual(len(self.server.sent), 2)
+    datagram = self.server.sent[1]
+    self.scheduler.RunAll()
+    # Retransmissions are the same datagram, sent a bounded number of times
+    self.assertEqual(self.server.sent.count(datagram),
+                     1 + constants.NLD_CLIENT_MAX_RETRIES)
+    self._Answer(datagram)
+    self.assertEqual([up.type for up in self.upcalls], [nld_nld.UPCALL_REPLY])
+    # Duplicate replies are discarded
+    self._Answer(datagram)
+    self.assertEqual(len(self.upcalls), 1)
+
+  def testDuplicates(self):
+    self._Send()
+    sent = len(self.server.sent)
+    # An identical request isn't sent again, but gets the same reply
+    duplicate = self._Send()
+    self.assertEqual(len(self.server.sent), sent)
+    self._Answer(self.server.sent[1])
+    self.assertEqual(len(self.upcalls), 2)
+    self.assertEqual([up.salt for up in self.upcalls
+                      if up.orig_request is duplicate], [duplicate.rsalt])
+
+  def _Invalidate(self, batcher):
+    """Queue and flush route invalidations, and return the datagrams sent.
+
+    """
+    self.server.sent = []
+    batcher.Add("cluster1", "127.0.0.1", "192.0.2.1", link="br0")
+    batcher.Add("cluster1", "127.0.0.1", "192.0.2.2", link="br0")
+    batcher.Add("cluster1", "127.0.0.1", "192.0.2.3")
+    self.scheduler.RunAll()
+    return self.server.sent
+
+  def _Type(self, datagram):
+    envelope = nld_nld.UnpackEnvelope(datagram, self.keys,
+                                      nld_nld.CheckTimestamp)
+    return envelope.message["type"]
+
+  def testBatchVersions(self):
+    batcher = nld_nld.RouteInvalidationBatcher(self.server, self.scheduler)
+    # Peers not known to speak the version 2 get one request per link
+    sent = self._Invalidate(batcher)
+    self.assertEqual([self._Type(datagram) for datagram in sent],
+                     [constants.NLD_REQ_PING] +
+                     [constants.NLD_REQ_ROUTE_INVALIDATE] * 2)
+    for datagram in sent[1:]:
+      self.assertTrue(datagram.startswith(constants.NLD_MAGIC_FOURCC))
+    # Once the version probe is answered, they get batch requests
+    self._Answer(sent[0])
+    sent = self._Invalidate(batcher)
+    self.assertEqual([self._Type(datagram) for datagram in sent],
+                     [constants.NLD_REQ_ROUTE_INVALIDATE_BATCH])
+
+  def testMergedVersionProbe(self):
+    # pylint: disable-msg=W0212
+    request = self._Send()
+    self._Answer(self.server.sent[0])
+    # A new probe merged with the ping still waiting is answered with it
+    (version, _) = self.server._peer_versions["127.0.0.1"]
+    self.server._peer_versions["127.0.0.1"] = (version, 0)
+    self.server.GetPeerVersion("cluster1", "127.0.0.1")
+    self.assertEqual(self.server._version_probes.keys(), [request.rsalt])
+    self._Answer(self.server.sent[1])
+    self.assertEqual(self.server._version_probes, {})
+
+  def testVersionNegotiation(self):
+    self._Send()
+    for datagram in self.server.sent:
+      self.assertTrue(datagram.startswith(constants.NLD_MAGIC_FOURCC))
+      self._Answer(datagram)
+    self.server.sent = []
+    request = self._Send()
+    self.assertEqual(len(self.server.sent), 1)
+    self.assertTrue(self.server.sent[0].startswith(
+      constants.NLD_MAGIC_FOURCC_V2))
+    self._Answer(self.server.sent[0])
+    self.assertTrue(self.upcalls[-1].orig_request is request)
+    self.assertEqual(self.upcalls[-1].server_reply.protocol,
+                     constants.NLD_PROTOCOL_VERSION_2)
+
+
+if __name__ == '__main__':
+  unittest.main()
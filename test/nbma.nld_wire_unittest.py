@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the nld_wire module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import time
+import unittest
+
+from ganeti_nbma import constants
+from ganeti_nbma import errors
+from ganeti_nbma import nld_nld
+from ganeti_nbma import nld_wire
+from ganeti_nbma import objects
+
+
+class TestNLDWire(unittest.TestCase):
+
+  def setUp(self):
+    self.keys = {"cluster1": "key1"}
+    self.now = int(time.time())
+
+  def _Unpack(self, datagram, salt_fn=nld_nld.CheckTimestamp):
+    return nld_wire.UnpackDatagram(datagram, self.keys, salt_fn)
+
+  def testRequestRoundTrip(self):
+    query = [
+      {constants.NLD_REQQ_IPLIST: ["192.0.2.1", "192.0.2.2"],
+       constants.NLD_REQQ_LINK: "br0"},
+      {constants.NLD_REQQ_IPLIST: ["198.51.100.7"]},
+      ]
+    request = nld_nld.NLDClientRequest(
+      type=constants.NLD_REQ_ROUTE_INVALIDATE_BATCH, query=query,
+      cluster="cluster1")
+    datagram = nld_wire.PackRequest(request, "cluster1", "key1", self.now)
+    self.assertTrue(datagram.startswith(constants.NLD_MAGIC_FOURCC_V2))
+    (message, salt, cluster) = self._Unpack(datagram)
+    self.assertEqual(salt, "%d" % self.now)
+    self.assertEqual(cluster, "cluster1")
+    decoded = objects.NLDRequest.FromDict(message)
+    self.assertEqual(decoded.query, query)
+    self.assertEqual(decoded.rsalt, request.rsalt)
+    self.assertEqual(decoded.type, request.type)
+    self.assertTrue(decoded.is_request)
+
+  def testPing(self):
+    request = nld_nld.NLDClientRequest(type=constants.NLD_REQ_PING)
+    datagram = nld_wire.PackRequest(request, "cluster1", "key1", self.now)
+    (message, _, _) = self._Unpack(datagram)
+    self.assertEqual(message["query"], None)
+
+  def testReplyRoundTrip(self):
+    rsalt = "0123abcd-0000-4000-8000-00000000beef"
+    reply = objects.NLDReply(protocol=constants.NLD_PROTOCOL_VERSION_2,
+                             status=constants.NLD_REPL_STATUS_OK,
+                             answer="done")
+    datagram = nld_wire.PackReply(reply, rsalt, "cluster1", "key1")
+    (message, salt, _) = self._Unpack(datagram,
+                                      salt_fn=lambda salt: salt == rsalt)
+    self.assertEqual(salt, rsalt)
+    decoded = objects.NLDReply.FromDict(message)
+    self.assertEqual(decoded.answer, "done")
+    self.assertFalse(decoded.is_request)
+
+  def testNotEncodable(self):
+    for query in ["192.0.2.1", {constants.NLD_REQQ_IPLIST: ["2001:db8::1"]}]:
+      request = nld_nld.NLDClientRequest(
+        type=constants.NLD_REQ_ROUTE_INVALIDATE, query=query)
+      self.assertEqual(nld_wire.PackRequest(request, "cluster1", "key1",
+                                            self.now), None)
+
+  def testRejected(self):
+    request = nld_nld.NLDClientRequest(
+      type=constants.NLD_REQ_ROUTE_INVALIDATE,
+      query={constants.NLD_REQQ_IPLIST: ["192.0.2.1"]})
+    datagram = nld_wire.PackRequest(request, "cluster1", "key1", self.now)
+    tampered = datagram[:-1] + chr(ord(datagram[-1]) ^ 1)
+    stale = nld_wire.PackRequest(request, "cluster1", "key1",
+                                 self.now - 2 * constants.NLD_MAX_CLOCK_SKEW)
+    foreign = nld_wire.PackRequest(request, "cluster2", "key1", self.now)
+    for payload in [datagram[:20], tampered, stale, foreign,
+                    datagram[:-2]]:
+      self.assertRaises(errors.NLDDecodeError, self._Unpack, payload)
+
+
+if __name__ == '__main__':
+  unittest.main()
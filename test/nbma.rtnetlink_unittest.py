@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Script for unittesting the rtnetlink module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+# Disable 'Access to a protected member' lint warning, to test the attribute
+# packing
+# pylint: disable-msg=W0212
+
+import socket
+import struct
+import unittest
+
+from ganeti_nbma import errors
+from ganeti_nbma import rtnetlink
+
+
+class _FakeDumpSocket(object):
+  """Socket stand-in, returning the same messages to every dump.
+
+  """
+  def __init__(self, messages):
+    self.messages = messages
+
+  def Dump(self, msg_type, body):
+    # pylint: disable-msg=W0613
+    return self.messages
+
+
+class TestAttrs(unittest.TestCase):
+
+  def testRoundTrip(self):
+    data = "".join([rtnetlink._PackAttr(1, "\x0a\x00\x00\x01"),
+                    rtnetlink._PackAttr(2, "abc"),
+                    rtnetlink._PackAttr(3, "")])
+    # Attributes are padded to 4 bytes
+    self.assertEqual(len(data), 8 + 8 + 4)
+    self.assertEqual(rtnetlink._UnpackAttrs(data),
+                     {1: "\x0a\x00\x00\x01", 2: "abc", 3: ""})
+
+  def testTruncated(self):
+    data = rtnetlink._PackAttr(1, "abcd") + struct.pack("=HH", 2, 5)
+    self.assertEqual(rtnetlink._UnpackAttrs(data), {1: "abcd"})
+    self.assertEqual(rtnetlink._UnpackAttrs("\x01"), {})
+
+
+class TestMessages(unittest.TestCase):
+
+  def testNeighbour(self):
+    body = rtnetlink.BuildNeighbourMessage(rtnetlink.RTM_NEWNEIGH,
+                                           "192.0.2.1", 7,
+                                           lladdr="10.0.0.1")
+    self.assertEqual(rtnetlink.ParseNeighbourMessage(body),
+                     (7, rtnetlink.NUD_PERMANENT, "192.0.2.1", "10.0.0.1"))
+    body = rtnetlink.BuildNeighbourMessage(rtnetlink.RTM_DELNEIGH,
+                                           "192.0.2.1", 7)
+    self.assertEqual(rtnetlink.ParseNeighbourMessage(body),
+                     (7, 0, "192.0.2.1", None))
+
+  def testNeighbourNotIPv4(self):
+    body = struct.pack(rtnetlink._NDMSG, socket.AF_INET6, 0, 0, 7, 0, 0, 0)
+    body += rtnetlink._PackAttr(rtnetlink.NDA_DST, "\0" * 16)
+    body += rtnetlink._PackAttr(rtnetlink.NDA_LLADDR, "\0" * 6)
+    self.assertEqual(rtnetlink.ParseNeighbourMessage(body), (7, 0, None, None))
+
+  def testRoute(self):
+    body = rtnetlink.BuildRouteMessage(rtnetlink.RTM_NEWROUTE, "192.0.2.1",
+                                       3, gateway="10.0.0.1")
+    self.assertEqual(rtnetlink.ParseRouteMessage(body),
+                     (rtnetlink.RT_TABLE_MAIN, 3, "192.0.2.1", "10.0.0.1"))
+    body = rtnetlink.BuildRouteMessage(rtnetlink.RTM_DELROUTE,
+                                       "198.51.100.0/24", 3)
+    self.assertEqual(rtnetlink.ParseRouteMessage(body),
+                     (rtnetlink.RT_TABLE_MAIN, 3, "198.51.100.0/24", None))
+
+  def testRouteTableAttr(self):
+    body = rtnetlink.BuildRouteMessage(rtnetlink.RTM_NEWROUTE, "192.0.2.1", 3)
+    body += rtnetlink._PackAttr(rtnetlink.RTA_TABLE, struct.pack("=I", 1000))
+    self.assertEqual(rtnetlink.ParseRouteMessage(body)[0], 1000)
+
+  def testRouteTable(self):
+    for table in [100, 1000]:
+      body = rtnetlink.BuildRouteMessage(rtnetlink.RTM_NEWROUTE, "192.0.2.1",
+                                         3, gateway="10.0.0.1", table=table)
+      self.assertEqual(rtnetlink.ParseRouteMessage(body),
+                       (table, 3, "192.0.2.1", "10.0.0.1"))
+
+  def testDumpRouteTable(self):
+    routes = [
+      rtnetlink.BuildRouteMessage(rtnetlink.RTM_NEWROUTE, "192.0.2.1", 3,
+                                  gateway="10.0.0.1"),
+      rtnetlink.BuildRouteMessage(rtnetlink.RTM_NEWROUTE, "192.0.2.2", 3,
+                                  gateway="10.0.0.2", table=100),
+      rtnetlink.BuildRouteMessage(rtnetlink.RTM_NEWROUTE, "192.0.2.3", 4,
+                                  gateway="10.0.0.3", table=100),
+      ]
+    sock = _FakeDumpSocket([(rtnetlink.RTM_NEWROUTE, body)
+                            for body in routes])
+    self.assertEqual(rtnetlink.DumpRouteTable(sock, 3),
+                     {"192.0.2.1": "10.0.0.1"})
+    self.assertEqual(rtnetlink.DumpRouteTable(sock, 3, table=100),
+                     {"192.0.2.2": "10.0.0.2"})
+
+  def testInvalid(self):
+    self.assertRaises(errors.NetlinkError, rtnetlink.ParseNeighbourMessage,
+                      "\0" * 4)
+    self.assertRaises(errors.NetlinkError, rtnetlink.ParseRouteMessage,
+                      "\0" * 4)
+    self.assertRaises(errors.NetlinkError, rtnetlink.BuildNeighbourMessage,
+                      rtnetlink.RTM_NEWNEIGH, "192.0.2.256", 7)
+
+
+if __name__ == '__main__':
+  unittest.main()
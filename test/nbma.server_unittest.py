@@ -0,0 +1,168 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the server module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import unittest
+
+from ganeti_nbma import constants
+from ganeti_nbma import iptables
+from ganeti_nbma import server
+
+from ganeti import errors
+
+
+class _FakeScheduler(object):
+  def __init__(self):
+    self.events = []
+
+  def enter(self, delay, priority, action, args):
+    event = (delay, priority, action, args)
+    self.events.append(event)
+    return event
+
+  def RunAll(self):
+    events = self.events
+    self.events = []
+    for (_, _, action, args) in events:
+      action(*args)
+
+
+class TestPeerSetManager(unittest.TestCase):
+
+  def setUp(self):
+    self.calls = []
+    self.fail = False
+    self.error = errors.CommandError
+    self._saved = (iptables.UpdateIptablesRules, iptables.SyncIpsetRules,
+                   iptables.UpdateIpsetMembers)
+    iptables.UpdateIptablesRules = self._Recorder("chain")
+    iptables.SyncIpsetRules = self._Recorder("sync")
+    iptables.UpdateIpsetMembers = self._Recorder("update")
+
+  def tearDown(self):
+    (iptables.UpdateIptablesRules, iptables.SyncIpsetRules,
+     iptables.UpdateIpsetMembers) = self._saved
+
+  def _Recorder(self, name):
+    def fn(*args):
+      self.calls.append((name, ) + args)
+      if self.fail:
+        raise self.error("failed")
+    return fn
+
+  def _NewManager(self, mode, scheduler=None, commit_delay=0):
+    mgr = server.PeerSetManager(mode, scheduler=scheduler,
+                                commit_delay=commit_delay)
+    mgr.RegisterPeerSet("a")
+    mgr.RegisterPeerSet("b")
+    return mgr
+
+  def testDoubleRegistration(self):
+    mgr = self._NewManager(constants.FIREWALL_MODE_CHAIN)
+    self.assertRaises(errors.ProgrammerError, mgr.RegisterPeerSet, "a")
+    self.assertRaises(errors.ProgrammerError, mgr.UpdatePeerSetNodes,
+                      "c", [])
+
+  def testChainDeduplication(self):
+    mgr = self._NewManager(constants.FIREWALL_MODE_CHAIN)
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1", "2.2.2.2"])
+    mgr.UpdatePeerSetNodes("b", ["2.2.2.2", "3.3.3.3"])
+    self.assertEquals(self.calls, [
+      ("chain", ["1.1.1.1", "2.2.2.2"]),
+      ("chain", ["1.1.1.1", "2.2.2.2", "3.3.3.3"]),
+      ])
+
+  def testNoChange(self):
+    mgr = self._NewManager(constants.FIREWALL_MODE_CHAIN)
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1"])
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1"])
+    # Moving a peer shared by both sets doesn't change the global set
+    mgr.UpdatePeerSetNodes("b", ["1.1.1.1"])
+    mgr.UpdatePeerSetNodes("a", [])
+    self.assertEquals(self.calls, [("chain", ["1.1.1.1"])])
+
+  def testIpsetDelta(self):
+    mgr = self._NewManager(constants.FIREWALL_MODE_IPSET)
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1", "2.2.2.2"])
+    mgr.UpdatePeerSetNodes("b", ["2.2.2.2", "3.3.3.3"])
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1"])
+    mgr.UpdatePeerSetNodes("b", ["4.4.4.4"])
+    self.assertEquals(self.calls, [
+      ("sync", ["1.1.1.1", "2.2.2.2"]),
+      ("update", ["3.3.3.3"], []),
+      ("update", ["4.4.4.4"], ["2.2.2.2", "3.3.3.3"]),
+      ])
+
+  def testIpsetFailure(self):
+    scheduler = _FakeScheduler()
+    mgr = self._NewManager(constants.FIREWALL_MODE_IPSET, scheduler=scheduler)
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1"])
+    self.fail = True
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1", "2.2.2.2"])
+    # Failed commits are retried, with backoff
+    self.assertEquals(len(scheduler.events), 1)
+    delay = scheduler.events[0][0]
+    scheduler.RunAll()
+    self.assertEquals(len(scheduler.events), 1)
+    self.failUnless(scheduler.events[0][0] > delay)
+    self.fail = False
+    scheduler.RunAll()
+    self.assertEquals(self.calls[-1], ("sync", ["1.1.1.1", "2.2.2.2"]))
+    self.assertEquals(scheduler.events, [])
+    mgr.UpdatePeerSetNodes("b", ["3.3.3.3"])
+    self.assertEquals(self.calls[-1], ("update", ["3.3.3.3"], []))
+
+  def testMissingChain(self):
+    scheduler = _FakeScheduler()
+    mgr = self._NewManager(constants.FIREWALL_MODE_CHAIN, scheduler=scheduler)
+    self.fail = True
+    self.error = errors.ConfigurationError
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1"])
+    self.assertEquals(len(scheduler.events), 1)
+    self.fail = False
+    mgr.UpdatePeerSetNodes("b", ["2.2.2.2"])
+    scheduler.RunAll()
+    self.assertEquals(self.calls[-1], ("chain", ["1.1.1.1", "2.2.2.2"]))
+    self.assertEquals(scheduler.events, [])
+
+  def testDebounce(self):
+    scheduler = _FakeScheduler()
+    mgr = self._NewManager(constants.FIREWALL_MODE_IPSET, scheduler=scheduler,
+                           commit_delay=5)
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1"])
+    scheduler.RunAll()
+    mgr.UpdatePeerSetNodes("a", ["1.1.1.1", "2.2.2.2"])
+    mgr.UpdatePeerSetNodes("b", ["3.3.3.3", "4.4.4.4"])
+    mgr.UpdatePeerSetNodes("b", ["3.3.3.3"])
+    self.assertEquals(len(scheduler.events), 1)
+    scheduler.RunAll()
+    self.assertEquals(self.calls, [
+      ("sync", ["1.1.1.1"]),
+      ("update", ["2.2.2.2", "3.3.3.3"], []),
+      ])
+
+
+if __name__ == '__main__':
+  unittest.main()
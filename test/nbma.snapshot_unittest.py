@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Script for unittesting the snapshot module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ganeti_nbma import snapshot
+
+from ganeti import utils
+
+
+class TestSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.file_name = os.path.join(self.tmpdir, "state")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testRoundTrip(self):
+    state = {
+      "cluster1": {
+        "links": {
+          "br0": {
+            "192.0.2.1": "10.0.0.1",
+            "192.0.2.2": "10.0.0.1",
+            "192.0.2.3": "10.0.0.2",
+            },
+          },
+        "master": ("192.0.2.254", "10.0.0.1"),
+        "mcs": ["10.0.0.1", "10.0.0.2"],
+        },
+      "cluster2": {
+        "links": {},
+        "master": None,
+        "mcs": None,
+        },
+      }
+    installed = {
+      ("neigh", "gtun0"): ["192.0.2.1", "192.0.2.9"],
+      }
+    writer = snapshot.SnapshotWriter(self.file_name, None, lambda: state,
+                                     installed_fn=lambda: installed)
+    writer.Write()
+    self.assertEqual(snapshot.LoadSnapshot(self.file_name),
+                     (state, installed))
+    # Snapshots without the installed entries are still loaded
+    writer = snapshot.SnapshotWriter(self.file_name, None, lambda: state)
+    writer.Write()
+    self.assertEqual(snapshot.LoadSnapshot(self.file_name), (state, {}))
+
+  def testInvalid(self):
+    self.assertEqual(snapshot.LoadSnapshot(self.file_name), ({}, {}))
+    utils.WriteFile(self.file_name, data="{")
+    self.assertEqual(snapshot.LoadSnapshot(self.file_name), ({}, {}))
+    utils.WriteFile(self.file_name, data='{"version": 0, "clusters": {}}')
+    self.assertEqual(snapshot.LoadSnapshot(self.file_name), ({}, {}))
+    utils.WriteFile(self.file_name,
+                    data='{"version": 1, "clusters": {"c": {}}}')
+    self.assertEqual(snapshot.LoadSnapshot(self.file_name), ({}, {}))
+
+
+if __name__ == '__main__':
+  unittest.main()
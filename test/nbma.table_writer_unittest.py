@@ -0,0 +1,239 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2010 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Script for unittesting the table_writer module"""
+
+# Disable 'Invalid name' lint warning
+# pylint: disable-msg=C0103
+
+# Disable 'Access to a protected member' lint warning, to run the worker
+# thread steps from the test
+# pylint: disable-msg=W0212
+
+import time
+import unittest
+
+from ganeti_nbma import networktables
+from ganeti_nbma import table_writer
+
+from ganeti import errors
+
+
+_NEIGH = networktables.NEIGHBOUR_CONTEXT
+
+
+class _FakeThread(object):
+  """Thread stand-in, so that the queue can be tested on its own.
+
+  """
+  def __init__(self, target=None, name=None):
+    pass
+
+  def setDaemon(self, daemonic):
+    pass
+
+  def start(self):
+    pass
+
+
+class TestTableWriter(unittest.TestCase):
+
+  def setUp(self):
+    self._saved = (table_writer.threading.Thread,
+                   networktables.ApplyNetworkChanges,
+                   networktables.GetNetworkTable)
+    table_writer.threading.Thread = _FakeThread
+    networktables.ApplyNetworkChanges = self._Apply
+    networktables.GetNetworkTable = lambda context, iface: dict(self.kernel)
+    self.kernel = {}
+    self.applied = []
+    self.failures = []
+    self.writer = table_writer.TableWriter(max_pending=2)
+    self.results = []
+
+  def tearDown(self):
+    (table_writer.threading.Thread,
+     networktables.ApplyNetworkChanges,
+     networktables.GetNetworkTable) = self._saved
+    self.writer._wakeup.close()
+
+  def _Apply(self, changes, context, iface):
+    self.applied.append((sorted(changes), context, iface))
+    return self.failures
+
+  def _Callback(self, ip_address, dest_address, error):
+    self.results.append((ip_address, dest_address, error))
+
+  def _RunWorker(self):
+    """Do what the worker thread does with the queued entries.
+
+    """
+    batch = self.writer._pending
+    self.writer._pending = {}
+    dumps = self.writer._dumps
+    self.writer._dumps = []
+    self.writer._results.extend(self.writer._WriteBatch(batch))
+    self.writer._dump_results.extend([self.writer._Dump(*dump)
+                                      for dump in dumps])
+    self.writer._ProcessResults()
+
+  def testCoalescing(self):
+    self.failUnless(self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH,
+                                            "gtun0", callback=self._Callback))
+    self.failUnless(self.writer.UpdateEntry("192.0.2.1", "10.0.0.2", _NEIGH,
+                                            "gtun0", callback=self._Callback))
+    self.failUnless(self.writer.UpdateEntry("192.0.2.1", "10.0.0.2", _NEIGH,
+                                            "gtun0", callback=self._Callback))
+    self.assertEqual(len(self.writer._pending), 1)
+    self.assertEqual(self.writer.GetDesiredEntry("192.0.2.1", _NEIGH,
+                                                 "gtun0"), "10.0.0.2")
+    self._RunWorker()
+    # Only the last destination is written, and all the callbacks are called
+    # with the outcome of their own update
+    self.assertEqual(self.applied,
+                     [([("192.0.2.1", "10.0.0.2")], _NEIGH, "gtun0")])
+    self.assertEqual(self.results,
+                     [("192.0.2.1", "10.0.0.1", table_writer.ERROR_SUPERSEDED),
+                      ("192.0.2.1", "10.0.0.2", None),
+                      ("192.0.2.1", "10.0.0.2", None)])
+
+  def testRemove(self):
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0")
+    self.writer.RemoveEntry("192.0.2.1", _NEIGH, "gtun0",
+                            callback=self._Callback)
+    self.assertEqual(self.writer.GetDesiredEntry("192.0.2.1", _NEIGH,
+                                                 "gtun0"), None)
+    self.assertEqual(self.writer.GetDesiredTable(_NEIGH, "gtun0"), {})
+    self._RunWorker()
+    self.assertEqual(self.applied, [([("192.0.2.1", None)], _NEIGH, "gtun0")])
+    self.assertEqual(self.results, [("192.0.2.1", None, None)])
+
+  def testMaxPending(self):
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0")
+    self.writer.UpdateEntry("192.0.2.2", "10.0.0.1", _NEIGH, "gtun0")
+    self.failIf(self.writer.UpdateEntry("192.0.2.3", "10.0.0.1", _NEIGH,
+                                        "gtun0"))
+    self.assertEqual(self.writer.GetDesiredEntry("192.0.2.3", _NEIGH,
+                                                 "gtun0"), None)
+    # Entries already queued can still be replaced
+    self.failUnless(self.writer.UpdateEntry("192.0.2.2", "10.0.0.2", _NEIGH,
+                                            "gtun0"))
+    self._RunWorker()
+    self.failUnless(self.writer.UpdateEntry("192.0.2.3", "10.0.0.1", _NEIGH,
+                                            "gtun0"))
+
+  def testFailures(self):
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0",
+                            callback=self._Callback)
+    self.writer.UpdateEntry("192.0.2.2", "10.0.0.1", _NEIGH, "gtun0",
+                            callback=self._Callback)
+    self.failures = [("192.0.2.2", "File exists")]
+    self._RunWorker()
+    self.assertEqual(sorted(self.results),
+                     [("192.0.2.1", "10.0.0.1", None),
+                      ("192.0.2.2", "10.0.0.1", "File exists")])
+
+  def testBatchError(self):
+    def _Fail(changes, context, iface):
+      raise errors.CommandError("no such device")
+    networktables.ApplyNetworkChanges = _Fail
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0",
+                            callback=self._Callback)
+    self._RunWorker()
+    self.assertEqual(self.results,
+                     [("192.0.2.1", "10.0.0.1", "no such device")])
+
+  def testRepair(self):
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0")
+    self._RunWorker()
+    self.failUnless(self.writer.RepairEntry("192.0.2.1", _NEIGH, "gtun0"))
+    # Entries we don't manage, or don't want any more, aren't rewritten
+    self.failIf(self.writer.RepairEntry("192.0.2.2", _NEIGH, "gtun0"))
+    self.failIf(self.writer.RepairEntry("192.0.2.1", _NEIGH, "gtun1"))
+    self._RunWorker()
+    self.assertEqual(self.applied,
+                     [([("192.0.2.1", "10.0.0.1")], _NEIGH, "gtun0")] * 2)
+    self.writer.RemoveEntry("192.0.2.1", _NEIGH, "gtun0")
+    self.failIf(self.writer.RepairEntry("192.0.2.1", _NEIGH, "gtun0"))
+
+  def testRepairBackoff(self):
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0")
+    self._RunWorker()
+    self.failures = [("192.0.2.1", "Operation not permitted")]
+    self.failUnless(self.writer.RepairEntry("192.0.2.1", _NEIGH, "gtun0",
+                                            now=0))
+    self._RunWorker()
+    # Failed repairs are retried with backoff, and eventually given up
+    now = time.time()
+    self.failIf(self.writer.RepairEntry("192.0.2.1", _NEIGH, "gtun0",
+                                        now=now))
+    attempts = 1
+    while self.writer.RepairEntry("192.0.2.1", _NEIGH, "gtun0",
+                                  now=now + 3600):
+      self._RunWorker()
+      attempts += 1
+    self.assertEqual(attempts, table_writer.REPAIR_MAX_FAILURES)
+    # Updating the entry allows repairing it again
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0")
+    self.failUnless(self.writer.RepairEntry("192.0.2.1", _NEIGH, "gtun0"))
+
+  def testLeftovers(self):
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0")
+    self._RunWorker()
+    self.assertEqual(self.writer.GetLeftoverEntries(_NEIGH, "gtun0"), set())
+    # Removing an entry we didn't write doesn't make it ours
+    self.writer.RemoveEntry("192.0.2.9", _NEIGH, "gtun0")
+    self.writer.RemoveEntry("192.0.2.1", _NEIGH, "gtun0")
+    self.failures = [("192.0.2.1", "Operation not permitted")]
+    self._RunWorker()
+    self.assertEqual(self.writer.GetLeftoverEntries(_NEIGH, "gtun0"),
+                     set(["192.0.2.1"]))
+    self.writer.RemoveEntry("192.0.2.1", _NEIGH, "gtun0")
+    self.failures = []
+    self._RunWorker()
+    self.assertEqual(self.writer.GetLeftoverEntries(_NEIGH, "gtun0"), set())
+
+  def testInstalledEntries(self):
+    self.writer.LoadInstalledEntries({
+      (_NEIGH, "gtun0"): ["192.0.2.1", "192.0.2.2", "192.0.2.3"],
+      })
+    self.writer.UpdateEntry("192.0.2.1", "10.0.0.1", _NEIGH, "gtun0")
+    self.writer.UpdateEntry("192.0.2.4", "10.0.0.1", _NEIGH, "gtun0")
+    self.assertEqual(self.writer.GetLeftoverEntries(_NEIGH, "gtun0"),
+                     set(["192.0.2.2", "192.0.2.3"]))
+    installed = self.writer.GetInstalledEntries()
+    self.assertEqual(installed.keys(), [(_NEIGH, "gtun0")])
+    self.assertEqual(sorted(installed[(_NEIGH, "gtun0")]),
+                     ["192.0.2.1", "192.0.2.2", "192.0.2.3", "192.0.2.4"])
+    # Leftovers gone from the kernel are forgotten when the table is dumped
+    self.kernel = {"192.0.2.1": "10.0.0.1", "192.0.2.2": "10.0.0.2"}
+    dumps = []
+    self.writer.DumpTable(_NEIGH, "gtun0",
+                          lambda table, error: dumps.append(table))
+    self._RunWorker()
+    self.assertEqual(dumps, [self.kernel])
+    self.assertEqual(self.writer.GetLeftoverEntries(_NEIGH, "gtun0"),
+                     set(["192.0.2.2"]))
+
+
+if __name__ == '__main__':
+  unittest.main()